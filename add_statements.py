@@ -4,10 +4,18 @@ import os
 import sys
 sys.path.append(os.environ['PYWIKIBOT_DIR'])
 
-import re
+import csv
+import json
 import pywikibot
 import get_statements2
 import outreachyscript
+import claim_index
+import pattern_registry
+import parse_pool
+import result_sinks
+import text_store
+
+from result_store import ResultStore
 
 def main():
     enwiki = pywikibot.Site('en', 'wikipedia')
@@ -25,7 +33,7 @@ def add_statements(enwiki):
 
     @param enwiki pywikibot.Site
     """
-    statements_found = []
+    statements_found = ResultStore()
     # Commonly used regex
     netflix_id_regx = r'(https?:\/\/www\.netflix\.com\/(title|watch))\/(\d{6,8})'
 
@@ -50,10 +58,14 @@ def add_statements(enwiki):
         ['Lismore (Parliament of Ireland constituency)', '(abolished|disestablished)', 'P2043', 'infobox'], # date
     ]
 
+    # Fetch the texts of all the articles at once
+    text_store.prefetch(enwiki, [title for title, regex, p_id, location in data])
+
     # Loop over the data and query each article for the statement
     for title, regex, p_id, location in data:
         result = get_statements2.get_statement(enwiki, title, regex, p_id, location, True)
-        statements_found.append(result)
+        if result:
+            statements_found.append(result)
 
     print('Found %s potential statements to add' % len(statements_found))
 
@@ -61,7 +73,7 @@ def add_statements(enwiki):
     # Iterate over the statements and actually push them to the repo
     # Report back the number of statements added and/or skipped
     for result in statements_found:
-        if result and result['repo_value']:
+        if result['repo_value']:
             print('Repo already has the value for %s: %s' %(result['id'], result['repo_value']))
             exists += 1
             continue
@@ -72,6 +84,15 @@ def add_statements(enwiki):
 
     if added: print('Done. Added %s statements' % added)
     if exists: print('%s statements were skipped' % exists)
+    if claim_index.stats['avoided']:
+        print('%s writes were avoided because the claims already exist' % claim_index.stats['avoided'])
+
+    # Show which rules cost the most scan time
+    pattern_registry.report()
+    get_statements2.report_tiers()
+    text_store.report()
+
+    statements_found.close()
 
     return 1
 
@@ -88,26 +109,11 @@ def add_statement(page, value, p_id):
     repo = page.site.data_repository()
     page_item = page.data_item().title()
 
-    # Strip all internal and interwiki link
-    # formattings because we attempt to search
-    # for the local page. [[example]] -> example
-    def strip_wikilinks(title):
-        match = re.search(r'\[\[(.*?)\]\]', title)
-        if match:
-            title = match.group(1)
-
-        match = re.search(r'..?:+(.*)', title)
-        if match:
-            title = match.group(1)
-
-        match = re.match(r'\{\{(.*)\|(.*)\}\}', title)
-        if match:
-              title = match.group(2)
-
-        return title
-
     if isinstance(value, str):
-        title =  strip_wikilinks(value)
+        # Strip all internal and interwiki link
+        # formattings because we attempt to search
+        # for the local page. [[example]] -> example
+        title = parse_pool.strip_wikilinks(value)
         value_page = pywikibot.Page(page.site, title)
     else:
        value_page = None
@@ -119,6 +125,18 @@ def add_statement(page, value, p_id):
             if value_page.exists():
                 value = value_page.data_item().title()
 
+    # The index holds the targets of the repo claims, so compare the
+    # value once converted to the datatype of the property, as it'd be saved
+    try:
+        target = outreachyscript.convert_value(repo, outreachyscript.get_datatype(repo, p_id), value)
+    except (ValueError, TypeError, ArithmeticError, pywikibot.Error) as e:
+        print('Error converting the value of %s: %s' % (p_id, str(e)))
+        return 0
+
+    if claim_index.is_duplicate(page_item, p_id, claim_index.normalize_value(target)):
+        print('Skipping %s: %s already has the claim' % (page.title(), p_id))
+        return 0
+
     try:
         outreachyscript.add_claim_to_item(repo, page_item, p_id, value, summary=u"Adding claim")
         return 1
@@ -176,5 +194,108 @@ def add_references(enwiki):
 
     return 1
 
+# Fields of the rows of add_claim_details():
+# item - id of the item
+# property - property id of the claim
+# claim - optional GUID or value of the claim, the first claim of the property if empty
+# type - 'qualifier' or 'reference'
+# prop - property id of the qualifier or reference
+# value - raw value of the qualifier or reference; 'lat,lon' for coordinates
+#   and 'text,language' for monolingual texts (or a list in JSON lines)
+CLAIM_DETAIL_FIELDS = ['item', 'property', 'claim', 'type', 'prop', 'value']
+
+def split_value(datatype, value):
+    """
+    Split the value of a CSV cell into the two parts the coordinates and
+    the monolingual texts are made of, see outreachyscript.convert_value()
+
+    @param datatype: datatype of the property
+    @param value: raw value, a string or already a list
+    @return the value, a list of two strings for the datatypes made of two parts
+    @raises ValueError if the value doesn't have two parts
+    """
+    if datatype not in ('globe-coordinate', 'monolingualtext') or not isinstance(value, str):
+        return value
+
+    # The text may have commas, the language code can't
+    parts = value.split(',') if datatype == 'globe-coordinate' else value.rsplit(',', 1)
+    parts = [part.strip() for part in parts]
+    if len(parts) != 2 or not all(parts):
+        raise ValueError('%s needs two comma separated parts: %s' % (datatype, value))
+
+    return parts
+
+def read_rows(path):
+    """
+    Read rows one at a time from a CSV file (with a header line) or,
+    if the name ends with .jsonl, from a JSON lines file
+
+    @param path: path of the file
+    @return generator of dictionaries
+    """
+    with open(path, encoding='utf-8', newline='') as file:
+        if path.endswith('.jsonl'):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(file)
+
+def add_claim_details(path, summary=u'Adding qualifiers and references.'):
+    """
+    Add the qualifiers and references listed in a file (see
+    CLAIM_DETAIL_FIELDS) to existing claims. The rows are grouped by
+    item so that every item is loaded once and all its changes are saved
+    in a single edit, see outreachyscript.apply_claim_changes().
+
+    @param path: path of the CSV or JSON lines file
+    @param summary: Edit summary
+    """
+    repo = pywikibot.Site('en', 'wikipedia').data_repository()
+
+    # Only the rows are kept in memory, the items are loaded one by one
+    changes = {}
+    invalid = 0
+    for row in read_rows(path):
+        if not all(row.get(field) for field in CLAIM_DETAIL_FIELDS if field != 'claim') \
+                or row['type'] not in ('qualifier', 'reference'):
+            print('Skipping invalid row: %s' % row)
+            invalid += 1
+            continue
+
+        try:
+            datatype = outreachyscript.get_datatype(repo, row['prop'])
+            target = outreachyscript.convert_value(repo, datatype, split_value(datatype, row['value']))
+        except (ValueError, TypeError, ArithmeticError, pywikibot.Error) as e:
+            # ArithmeticError: decimal.InvalidOperation of a bad quantity
+            print('Skipping row, the value cannot be converted: %s (%s)' % (row, str(e)))
+            invalid += 1
+            continue
+
+        changes.setdefault(row['item'], []).append(
+            (row['property'], row.get('claim') or None, row['type'], row['prop'], target))
+
+    print('Found %s changes to make on %s items' % (sum(map(len, changes.values())), len(changes)))
+
+    added = skipped = edits = 0
+    for item_id, item_changes in changes.items():
+        try:
+            result = outreachyscript.apply_claim_changes(repo, item_id, item_changes, summary)
+        except pywikibot.Error as e:
+            result_sinks.report('error', 'Error saving the changes of %s: %s' % (item_id, str(e)),
+                qid=item_id, error=str(e))
+            skipped += len(item_changes)
+            continue
+
+        added += result['added']
+        skipped += result['skipped']
+        edits += 1 if result['added'] else 0
+
+    print('Done. Added %s qualifiers and references in %s edits' % (added, edits))
+    if skipped: print('%s qualifiers and references were skipped' % skipped)
+    if invalid: print('%s rows were invalid' % invalid)
+
+    return 1
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,612 @@
+#!/usr/bin/env python3
+"""
+Asyncio counterparts of the core functions, for async services.
+
+get_statement(), check_repo(), check_repo_batch(), add_claim_to_item() and
+get_all_pages() talk to the MediaWiki and Wikibase APIs with aiohttp (an
+optional dependency, imported when a Client is opened) instead of the
+blocking pywikibot calls, and return the same results as their sync
+versions. All the calls share the connection pool of one Client:
+
+    async with async_api.Client() as client:
+        results = await asyncio.gather(*(async_api.get_statement(client, 'en',
+            title, 'architect', 'P84', 'infobox') for title in titles))
+
+Thousands of calls can be in flight at once: the Client caps the
+concurrent requests (MAX_IN_FLIGHT) and the connections per host, and
+the entity and page reads made in the same turn of the event loop are
+merged into batched requests of up to BATCH_SIZE ids or titles. Every
+request goes through the retry budget and circuit breaker of its host
+(see resilience.py). The value parsing is the same as in the sync code
+(infobox_index, parse_pool) and can be moved to a parse_pool.ParsePool.
+"""
+import asyncio
+import decimal
+import json
+import re
+
+import infobox_index
+import parse_pool
+import resilience
+import result_sinks
+
+WIKIDATA_HOST = 'www.wikidata.org'
+# Requests in flight at once, and open connections per host
+MAX_IN_FLIGHT = 2000
+CONNECTIONS_PER_HOST = 50
+# Maximum number of ids or titles per API request
+BATCH_SIZE = 50
+# maxlag sent with every request, and retries of a request refused for lag
+MAXLAG = 5
+MAXLAG_RETRIES = 10
+USER_AGENT = 'OutreachyProposal async_api (aiohttp)'
+
+PRECISIONS = {'year': 9, 'month': 10, 'day': 11}
+CALENDAR = 'http://www.wikidata.org/entity/Q1985727'
+EARTH = 'http://www.wikidata.org/entity/Q2'
+
+_TIMESTAMP = re.compile(r'([+-]?\d+)-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)Z')
+
+class APIError(Exception):
+    """An error returned by the API"""
+    def __init__(self, code, info=''):
+        super().__init__('%s: %s' % (code, info))
+        self.code = code
+
+class NoPage(Exception):
+    """The page doesn't exist or has no data item, like pywikibot.NoPage"""
+
+def wiki_host(lang):
+    """Host of the Wikipedia of a language"""
+    return '%s.wikipedia.org' % lang
+
+class Client:
+    """
+    Shared session to the APIs: connection pool, cap on the requests in
+    flight, login cookies, tokens and the batching of concurrent reads.
+    """
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, connections_per_host=CONNECTIONS_PER_HOST,
+            timeout=resilience.TIMEOUT, user_agent=USER_AGENT):
+        """
+        @param max_in_flight: maximum number of requests sent at once
+        @param connections_per_host: maximum number of connections to a host
+        @param timeout: (connect, read) timeouts in seconds
+        @param user_agent: User-Agent header of the requests
+        """
+        self.max_in_flight = max_in_flight
+        self.connections_per_host = connections_per_host
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.session = None
+        self.semaphore = None
+        self.tokens = {}
+        self.datatypes = {}
+        self.labels = {}
+        self.pending = {}
+
+    async def open(self):
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError('The async API needs aiohttp: pip install aiohttp')
+
+        # Created here so that they belong to the running event loop
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0, limit_per_host=self.connections_per_host),
+            timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]),
+            headers={'User-Agent': self.user_agent})
+        return self
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _fetch(self, url, post, params):
+        """Send one request, raising HTTPStatusError on 429 and 5xx"""
+        async with self.semaphore:
+            if post:
+                response = self.session.post(url, data=params)
+            else:
+                response = self.session.get(url, params=params)
+            async with response:
+                if response.status == 429 or response.status >= 500:
+                    raise resilience.HTTPStatusError(url, response.status)
+                return await response.json(content_type=None)
+
+    async def request(self, host, post=False, idempotent=True, **params):
+        """
+        Call the API of a host, the async version of resilience.call():
+        transient failures are retried with backoff within the retry budget
+        of the host, and requests refused for replication lag are sent
+        again once the lag is expected to be gone.
+
+        @param host: host of the wiki, e.g. 'en.wikipedia.org'
+        @param post: Send a POST request (needed for edits and long texts)
+        @param idempotent: False for edits: a timeout or a 5xx may come after
+            the edit was saved, so only the failures that surely happened
+            before the API got the request (see _not_sent()) are retried
+        @param params: the API parameters
+        @raises APIError, CircuitOpenError or the last error of aiohttp
+        @return the decoded response
+        """
+        params = dict(params, format='json', formatversion=2)
+        params.setdefault('maxlag', MAXLAG)
+        url = 'https://%s/w/api.php' % host
+        target = resilience.host(host)
+        attempt = lagged = 0
+
+        while True:
+            attempt += 1
+            target.allow()
+            try:
+                data = await self._fetch(url, post, params)
+            except Exception as e:
+                if not resilience.is_transient(e):
+                    target.success()
+                    raise
+                target.failure()
+                if attempt >= resilience.MAX_ATTEMPTS or not target.allow_retry():
+                    raise
+                if not idempotent and not _not_sent(e):
+                    raise
+                await asyncio.sleep(resilience.backoff_delay(attempt))
+                continue
+
+            target.success()
+            error = data.get('error')
+            if error and error.get('code') == 'maxlag' and lagged < MAXLAG_RETRIES:
+                lagged += 1
+                attempt -= 1
+                await asyncio.sleep(min(resilience.MAX_DELAY, max(1.0, float(error.get('lag', MAXLAG)))))
+                continue
+            elif error:
+                raise APIError(error.get('code'), error.get('info', ''))
+
+            return data
+
+    async def batched(self, key, item, load):
+        """
+        Load an item together with the other items of the same key
+        requested in this turn of the event loop, BATCH_SIZE at a time
+
+        @param key: hashable key of the batch, e.g. the props of wbgetentities
+        @param item: the item, e.g. an entity id
+        @param load: coroutine function taking a list of items and
+            returning a dictionary of {item: result}
+        @return the result of the item, None if load() didn't return it
+        """
+        loop = asyncio.get_event_loop()
+        pending = self.pending.setdefault(key, {})
+        if item not in pending:
+            pending[item] = loop.create_future()
+            if len(pending) == 1:
+                loop.call_soon(self._flush, key, load)
+            elif len(pending) >= BATCH_SIZE:
+                self._flush(key, load)
+        return await pending[item]
+
+    def _flush(self, key, load):
+        batch = self.pending.pop(key, None)
+        if batch:
+            asyncio.ensure_future(self._load(batch, load))
+
+    async def _load(self, batch, load):
+        try:
+            results = await load(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for item, future in batch.items():
+            if not future.done():
+                future.set_result(results.get(item))
+
+    async def get_entities(self, ids, props, **params):
+        """
+        Get many entities with wbgetentities, BATCH_SIZE per request,
+        the requests being sent concurrently
+
+        @param ids: iterable of entity ids
+        @param props: the props of wbgetentities, e.g. 'claims'
+        @return dictionary of {id: entity}, missing entities have a 'missing' key
+        """
+        ids = list(dict.fromkeys(ids))
+        batches = [ids[i:i + BATCH_SIZE] for i in range(0, len(ids), BATCH_SIZE)]
+        responses = await asyncio.gather(*(self.request(WIKIDATA_HOST, action='wbgetentities',
+            ids='|'.join(batch), props=props, **params) for batch in batches))
+
+        entities = {}
+        for data in responses:
+            for key, entity in data.get('entities', {}).items():
+                # Redirected ids are returned under the id of the target
+                entities[entity.get('redirects', {}).get('from', key)] = entity
+
+        return entities
+
+    async def get_entity(self, entity_id, props, languages=None):
+        """
+        Get one entity, batched with the other entities requested with
+        the same props at the same time
+
+        @return the entity as returned by wbgetentities
+        """
+        params = {'languages': languages} if languages else {}
+
+        async def load(ids):
+            return await self.get_entities(ids, props, **params)
+
+        return await self.batched(('entity', props, languages), entity_id, load) or {'missing': ''}
+
+    async def get_page(self, lang, title):
+        """
+        Get the wikitext, revision and data item of an article, batched
+        with the other articles of the wiki requested at the same time.
+        Redirects are followed.
+
+        @raises NoPage if the page doesn't exist
+        @return dictionary of {'title', 'text', 'revid', 'qid'}
+        """
+        async def load(titles):
+            data = await self.request(wiki_host(lang), action='query', titles='|'.join(titles),
+                prop='revisions|pageprops', rvprop='content|ids', rvslots='main',
+                ppprop='wikibase_item', redirects=1)
+            query = data.get('query', {})
+            pages = {page['title']: page for page in query.get('pages', [])}
+
+            # Follow the normalization and the redirects of every title
+            moves = {move['from']: move['to']
+                for move in query.get('normalized', []) + query.get('redirects', [])}
+            result = {}
+            for title in titles:
+                target = title
+                for i in range(3):
+                    target = moves.get(target, target)
+                result[title] = pages.get(target)
+            return result
+
+        page = await self.batched(('page', lang), title, load)
+        if not page or page.get('missing') or page.get('invalid') or not page.get('revisions'):
+            raise NoPage('%s does not exist on %s' % (title, wiki_host(lang)))
+
+        revision = page['revisions'][0]
+        return {
+            'title': page['title'],
+            'text': revision['slots']['main']['content'],
+            'revid': revision['revid'],
+            'qid': page.get('pageprops', {}).get('wikibase_item'),
+        }
+
+    async def login(self, username, password, host=WIKIDATA_HOST):
+        """
+        Log in with a bot password (Special:BotPasswords), needed for edits
+
+        @raises APIError if the login failed
+        """
+        data = await self.request(host, action='query', meta='tokens', type='login')
+        data = await self.request(host, post=True, action='login', lgname=username,
+            lgpassword=password, lgtoken=data['query']['tokens']['logintoken'])
+        if data.get('login', {}).get('result') != 'Success':
+            raise APIError('login-failed', data.get('login', {}).get('reason', ''))
+
+    async def get_token(self, host=WIKIDATA_HOST, refresh=False):
+        """Return the CSRF token of the session on a host"""
+        if refresh or host not in self.tokens:
+            data = await self.request(host, action='query', meta='tokens', type='csrf')
+            self.tokens[host] = data['query']['tokens']['csrftoken']
+        return self.tokens[host]
+
+    async def edit(self, host=WIKIDATA_HOST, **params):
+        """
+        Send an edit, getting a new token once if the session's one expired.
+        Edits are not idempotent (sending wbcreateclaim twice adds the claim
+        twice), so an edit that timed out or got a 5xx is not sent again:
+        the error is raised and the caller has to check the item first.
+        """
+        try:
+            return await self.request(host, post=True, idempotent=False,
+                token=await self.get_token(host), **params)
+        except APIError as e:
+            if e.code != 'badtoken':
+                raise
+            return await self.request(host, post=True, idempotent=False,
+                token=await self.get_token(host, True), **params)
+
+def _not_sent(error):
+    """
+    Tell whether a failed request surely didn't reach the API: refused
+    with HTTP 429, or the connection couldn't be opened
+    """
+    if getattr(error, 'code', None) == 429:
+        return True
+    return any(cls.__name__ == 'ClientConnectorError' for cls in type(error).__mro__)
+
+async def _scan(pool, func, text, *args):
+    """Run a parse_pool scan function in the pool, if any, without blocking the loop"""
+    if pool is None:
+        return func(text, *args)
+    return await asyncio.get_event_loop().run_in_executor(None, pool.run, func, text, *args)
+
+async def get_label(client, qid, lang='en'):
+    """
+    Get the label of an entity, see label_cache.get_label()
+
+    @return string label or None if the entity has no label in lang
+    """
+    if (qid, lang) not in client.labels:
+        entity = await client.get_entity(qid, 'labels', lang)
+        client.labels[(qid, lang)] = entity.get('labels', {}).get(lang, {}).get('value')
+    return client.labels[(qid, lang)]
+
+async def get_datatype(client, prop_id):
+    """Return the datatype of a property, asking the repo only once per property"""
+    if prop_id not in client.datatypes:
+        entity = await client.get_entity(prop_id, 'datatype')
+        client.datatypes[prop_id] = entity.get('datatype')
+    return client.datatypes[prop_id]
+
+async def get_all_pages(client, lang, cat_title):
+    """
+    Retrieve all pages from a given category of a Wikipedia, see
+    base_import_script.get_all_pages(). The pages are given by title.
+
+    @param lang: language of the Wikipedia
+    @param cat_title: Plain name of the category without the namespace prefix
+    @return dictionary of {'pages': list of titles, 'count', 'title'}
+    """
+    title = 'Category:%s' % cat_title
+    params = {'action': 'query', 'list': 'categorymembers', 'cmtitle': title,
+        'cmtype': 'page|file', 'cmlimit': 'max'}
+    pages = []
+
+    while True:
+        data = await client.request(wiki_host(lang), **params)
+        pages.extend(member['title'] for member in data.get('query', {}).get('categorymembers', []))
+        if 'continue' not in data:
+            break
+        params.update(data['continue'])
+
+    return {'pages': pages, 'count': len(pages), 'title': title}
+
+async def _snak_value(client, claim, lang):
+    """The value of a claim, as check_repo() gives it"""
+    snak = claim['mainsnak']
+    if snak.get('snaktype') != 'value':
+        return None
+
+    datavalue = snak['datavalue']
+    value = datavalue['value']
+    kind = datavalue['type']
+    if kind == 'quantity':
+        return decimal.Decimal(value['amount'])
+    elif kind == 'globecoordinate':
+        return str(value['latitude']) + ', ' + str(value['longitude'])
+    elif kind == 'time':
+        year, month, day, hour, minute, second = map(int, _TIMESTAMP.match(value['time']).groups())
+        return '%04d-%02d-%02dT%02d:%02d:%02dZ' % (year, month or 1, day or 1, hour, minute, second)
+    elif kind == 'wikibase-entityid':
+        qid = value['id']
+        return await get_label(client, qid, lang) or qid
+    elif kind == 'monolingualtext':
+        return value['text']
+    elif snak.get('datatype') == 'commonsMedia':
+        return 'File:' + value
+
+    return value
+
+async def check_repo(client, qid, p_id, lang='en', claims=None):
+    """
+    Check the repo for the value of a claim of an item, see
+    get_statements2.check_repo()
+
+    @param qid: id of the item
+    @param p_id: the property id
+    @param lang: language of the label used when the value is an item
+    @param claims: the claims of the property, as in the JSON of the item,
+        if already fetched
+    @return value of the first claim, None if there's none
+    """
+    if claims is None:
+        entity = await client.get_entity(qid, 'claims')
+        claims = entity.get('claims', {}).get(p_id, [])
+
+    for claim in claims:
+        return await _snak_value(client, claim, lang)
+
+    return None
+
+async def check_repo_batch(client, qids, p_id, lang='en'):
+    """
+    Variant of check_repo() for many items, see get_statements2.check_repo_batch()
+
+    @return dictionary of {qid: value} for every item
+    """
+    qids = list(dict.fromkeys(qids))
+    values = await asyncio.gather(*(check_repo(client, qid, p_id, lang) for qid in qids))
+    return dict(zip(qids, values))
+
+def _first_value(result, key):
+    """Pick the value out of the matches of the infobox key, as get_statement_from_infobox() does"""
+    for value in result:
+        if isinstance(value, tuple):
+            value = _first_value(value, key)
+        if value and not (isinstance(value, str) and value in key):
+            return value
+    return None
+
+async def get_statement_from_infobox(client, lang, title, key, pid, pool=None):
+    """
+    Get the value of an infobox key of an article and the value of the
+    repo, see get_statements2.get_statement_from_infobox()
+
+    @param client: Client
+    @param lang: language of the Wikipedia
+    @param title: The article title
+    @param key: The key to search for (a simple string or subregex)
+    @param pid: The property id
+    @param pool: parse_pool.ParsePool to parse the text in, None to parse it here
+    @raises NoPage if the article doesn't exist or has no data item
+    @return dictionary of {'id', 'title', 'value', 'repo_value'} or None
+        if the key was not found
+    """
+    page = await client.get_page(lang, title)
+    index = await _scan(pool, infobox_index.parse_templates, page['text'])
+    value = infobox_index.find_param(index, key)
+    if not value:
+        value = _first_value(await _scan(pool, parse_pool.scan_infobox_key, page['text'], key), key)
+
+    if not value:
+        return None
+    if not page['qid']:
+        raise NoPage('%s has no data item' % title)
+
+    value = value.strip()
+    if '{{coord|' in value or '{{Coord|' in value:
+        value = parse_pool.coord_digits(value)
+
+    return {
+        'id': pid,
+        'title': title,
+        'value': value,
+        'repo_value': await check_repo(client, page['qid'], pid),
+    }
+
+async def search_text(client, lang, page, regexes, pool=None):
+    """
+    Search the text of a page for several regexes, expanding it only when
+    a template may produce a missing value, see get_statements2.search_text()
+
+    @param page: dictionary returned by Client.get_page()
+    @return dictionary of {key: value} of the regexes found
+    """
+    found, missing = await _scan(pool, parse_pool.scan_wikitext, page['text'], regexes)
+    if missing:
+        data = await client.request(wiki_host(lang), post=True, action='expandtemplates',
+            title=page['title'], text=page['text'], prop='wikitext')
+        found.update(await _scan(pool, parse_pool.scan_text, data['expandtemplates']['wikitext'],
+            {key: regexes[key] for key in missing}))
+    return found
+
+async def get_statements_from_text(client, lang, title, regexes, pool=None):
+    """
+    Look for several properties in the text of an article, see
+    get_statements2.get_statements_from_text()
+
+    @param regexes: dictionary of {property id: regex}
+    @raises NoPage if the article doesn't exist or has no data item
+    @return dictionary of {property id: {'id', 'title', 'value', 'repo_value'}}
+        for every property whose value was found in the article
+    """
+    page = await client.get_page(lang, title)
+    if not page['qid']:
+        raise NoPage('%s has no data item' % title)
+
+    matches = await search_text(client, lang, page, regexes, pool)
+    entity = await client.get_entity(page['qid'], 'claims') if matches else {}
+
+    found = {}
+    for pid, value in matches.items():
+        found[pid] = {
+            'id': pid,
+            'title': title,
+            'value': value,
+            'repo_value': await check_repo(client, page['qid'], pid,
+                claims=entity.get('claims', {}).get(pid, [])),
+        }
+
+    return found
+
+async def get_statement_from_text(client, lang, title, regex, pid, pool=None):
+    """
+    Variant of get_statement_from_infobox() which searches the whole page
+    text, see get_statements2.get_statement_from_text()
+
+    @return dictionary of {'id', 'title', 'value', 'repo_value'} or None
+    """
+    return (await get_statements_from_text(client, lang, title, {pid: regex}, pool)).get(pid)
+
+async def get_statement(client, lang, title, key, pid, source=None, pool=None):
+    """
+    Async version of get_statements2.get_statement() with ret=True
+
+    @param source: likely location to find the fact, 'infobox' or 'text'
+    @return dictionary of {'id', 'title', 'value', 'repo_value'} or None
+    """
+    if source == 'infobox':
+        return await get_statement_from_infobox(client, lang, title, key, pid, pool)
+    elif source == 'text':
+        return await get_statement_from_text(client, lang, title, key, pid, pool)
+    return None
+
+def _decimals(value):
+    """Number of decimals of a number given as a string"""
+    return len(str(value).partition('.')[2])
+
+def to_datavalue(datatype, value):
+    """
+    Convert a raw value to the JSON value of a claim of the datatype,
+    see outreachyscript.convert_value()
+
+    @param datatype: datatype of the property
+    @param value: the raw value
+    @raises ValueError on unknown datatype or invalid value
+    @return value of the 'value' parameter of wbcreateclaim
+    """
+    if datatype == 'wikibase-item':
+        return {'entity-type': 'item', 'numeric-id': int(value.upper().lstrip('Q'))}
+    elif datatype == 'commonsMedia':
+        return re.sub(r'^(?i:file|image):', '', value).strip()
+    elif datatype == 'globe-coordinate':
+        return {'latitude': float(value[0]), 'longitude': float(value[1]), 'globe': EARTH,
+            'precision': 10 ** -max(_decimals(value[0]), _decimals(value[1]))}
+    elif datatype == 'quantity':
+        try:
+            amount = str(decimal.Decimal(str(value)))
+        except decimal.InvalidOperation:
+            raise ValueError('Invalid quantity: %s' % value)
+        return {'amount': amount if amount.startswith('-') else '+' + amount, 'unit': '1'}
+    elif datatype == 'time':
+        precision, date = parse_pool.parse_date(value)
+        return {'time': '+%04d-%02d-%02dT00:00:00Z' % (date['year'], date.get('month', 1), date.get('day', 1)),
+            'timezone': 0, 'before': 0, 'after': 0, 'precision': PRECISIONS[precision],
+            'calendarmodel': CALENDAR}
+    elif datatype == 'monolingualtext':
+        return {'text': value[0], 'language': value[1]}
+    elif datatype == 'url':
+        if 'https://' not in value and 'http://' not in value:
+            # ensure scheme exists to avoid errors
+            value = 'https://' + value
+        return value
+    elif datatype in ['math', 'external-id', 'musical-notation', 'string', 'geo-shape', 'tabular-data']:
+        return value
+
+    raise ValueError('Unknown datatype: %s' % datatype)
+
+async def add_claim_to_item(client, qid, prop_id, value, summary):
+    """
+    Add a new claim to an item, converting the value to the datatype
+    of the property, see outreachyscript.add_claim_to_item(). The client
+    has to be logged in, see Client.login().
+
+    @param qid: id of the item
+    @param prop_id: the property id of the claim
+    @param value: the raw value
+    @param summary: Edit summary
+    @raises ValueError on unknown datatype, APIError if the edit failed,
+        the error of aiohttp if it timed out (the claim may have been saved)
+    @return 1
+    """
+    datavalue = to_datavalue(await get_datatype(client, prop_id), value)
+    await client.edit(action='wbcreateclaim', entity=qid, property=prop_id, snaktype='value',
+        value=json.dumps(datavalue), summary=summary, bot=1)
+    result_sinks.report('claim_saved', 'New claim saved!', qid=qid, id=prop_id)
+    return 1
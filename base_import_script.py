@@ -2,34 +2,110 @@
 
 import os
 import sys
+import itertools
 sys.path.append(os.environ['PYWIKIBOT_DIR'])
 
 import pywikibot
 import outreachyscript
+import claim_index
+import result_sinks
 
-def get_all_pages(wiki, cat_title):
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Category namespace
+CATEGORY_NAMESPACE = 14
+# Values converted at once by add_claims_to_item(), see outreachyscript.convert_values()
+CONVERT_CHUNK_SIZE = 500
+
+def get_all_pages(wiki, cat_title, depth=0, workers=4, generate=False):
     """
     Retrieve all pages from a given category and
     return a dictionary with the following keys:
 
-    'pages': A list of pywikibot.Page objects
+    'pages': A list (or generator) of pywikibot.Page objects
     'count': The total number of pages found
     'title': Title of the category for display
 
     @param wiki: Pywikibot.Site
     @param cat_title: Plain name of the category
     without the namespace prefix.
+    @param depth: Also retrieve the pages of the subcategories down to this
+        depth, see walk_category()
+    @param workers: Number of categories fetched concurrently (with depth)
+    @param generate: Give the pages as they are listed instead of a list,
+        so that large categories are not held in memory. The count is
+        then None with depth
     @return dictionary with the keys mentioned above
     """
     category = pywikibot.Category(wiki, cat_title)
-    count = category.categoryinfo['pages']
     title = category.title()
-    pages = [*category.articles()]
+
+    if depth:
+        pages = walk_category(wiki, cat_title, depth, workers)
+        if not generate:
+            pages = [*pages]
+        count = None if generate else len(pages)
+    else:
+        count = category.categoryinfo['pages']
+        pages = category.articles() if generate else [*category.articles()]
 
     result = {'pages': pages, 'count': count, 'title': title}
 
     return result
 
+def walk_category(wiki, cat_title, depth=1, workers=4, namespaces=(0,)):
+    """
+    Walk a category tree and yield every page in it once. Subcategories
+    are fetched concurrently, each as soon as it's found, and the pages
+    are yielded as their categories come in, so importers can start on
+    the first pages while the rest of the tree is enumerated.
+
+    Categories already visited are not visited again (category trees can
+    have cycles) and pages found in several categories are yielded only
+    once, by page ID.
+
+    @param wiki: Pywikibot.Site
+    @param cat_title: Plain name of the root category
+    @param depth: Levels of subcategories to walk, 0 for the root only
+    @param workers: Number of categories fetched concurrently
+    @param namespaces: Namespaces of the pages to yield
+    @return generator of pywikibot.Page
+    """
+    def fetch(category, with_subcategories):
+        # Pages and subcategories come from the same listing
+        pages, subcategories = [], []
+        members = category.members(namespaces=list(namespaces)
+            + ([CATEGORY_NAMESPACE] if with_subcategories else []))
+        for member in members:
+            if member.namespace() == CATEGORY_NAMESPACE:
+                subcategories.append(pywikibot.Category(member))
+            if member.namespace() in namespaces:
+                pages.append(member)
+        return pages, subcategories
+
+    root = pywikibot.Category(wiki, cat_title)
+    seen_categories = {root.title()}
+    seen_pages = set()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {executor.submit(fetch, root, depth > 0): 0}
+        while running:
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                level = running.pop(future)
+                pages, subcategories = future.result()
+
+                for subcategory in subcategories:
+                    if subcategory.title() not in seen_categories:
+                        seen_categories.add(subcategory.title())
+                        running[executor.submit(fetch, subcategory, level + 1 < depth)] = level + 1
+
+                for page in pages:
+                    key = page.pageid or page.title()
+                    if key not in seen_pages:
+                        seen_pages.add(key)
+                        yield page
+
 def add_claims_to_item(repo, items, prop_id, summary=''):
     """
     Push claims to the data repository, add reference to each claim,
@@ -38,15 +114,20 @@ def add_claims_to_item(repo, items, prop_id, summary=''):
     'added': The number of claims successfuly published
     'skipped': The number of claims which could not be saved
     due to duplication or other error (if any)
+    'avoided': The number of claims not sent at all because
+    the repo data fetched earlier shows they already exist
     'iteml': The items of the pages edited
 
     @param repo: DataSite object
-    @param items: List of [id, page]; add id to the data item of page
+    @param items: Iterable of [id, page]; add id to the data item of page.
+        page can also be the title of an English Wikipedia page. The ids
+        are converted to the datatype of the property CONVERT_CHUNK_SIZE
+        at a time, see outreachyscript.convert_values()
     @param prop_id: The property ID
     @param summary: Optional edit summary to use
     @return dictionary with the keys mentioned above
     """
-    added = skipped = 0
+    added = skipped = avoided = 0
     itemlist = list()
 
     # For adding references
@@ -55,26 +136,47 @@ def add_claims_to_item(repo, items, prop_id, summary=''):
     enwiki_data_item = enwiki_page.data_item()
     ref_id = 'P143' # imported from Wikimedia project
 
-    for i, page in items:
-        if not isinstance(page, pywikibot.ItemPage):
-            page_item = page.data_item()
-        else:
-            page_item = page
-
-        qid = page_item.title()
-
-        try:
-            # Add the claim
-            outreachyscript.add_claim_to_item(repo, page_item, prop_id, i, summary)
-            # Also add a reference
-            outreachyscript.add_reference(repo, qid, prop_id, ref_id, enwiki_data_item)
-            added += 1
-            itemlist.append(qid)
-        except (pywikibot.Error, pywikibot.data.api.APIError) as e:
-            skipped += 1
-            print('Error: Adding claim to %s failed: %s' % (qid, str(e)))
-
-    return {'added': added, 'skipped': skipped, 'items': itemlist}
+    items = iter(items)
+    for chunk in iter(lambda: list(itertools.islice(items, CONVERT_CHUNK_SIZE)), []):
+        targets = outreachyscript.convert_values(repo, prop_id, [i for i, page in chunk])
+        for (i, page), target in zip(chunk, targets):
+            if target is None:
+                skipped += 1
+                result_sinks.report('error', 'Error: %s is not a valid value of %s' % (i, prop_id),
+                    id=prop_id, value=i, error='invalid value')
+                continue
+
+            if isinstance(page, str):
+                page = pywikibot.Page(wiki, page)
+
+            if not isinstance(page, pywikibot.ItemPage):
+                page_item = page.data_item()
+            else:
+                page_item = page
+
+            qid = page_item.title()
+
+            if claim_index.is_duplicate(qid, prop_id, target):
+                avoided += 1
+                continue
+
+            try:
+                # Add the claim
+                outreachyscript.add_claim_to_item(repo, page_item, prop_id, target, summary, convert=False)
+                # Also add a reference
+                outreachyscript.add_reference(repo, qid, prop_id, ref_id, enwiki_data_item)
+                added += 1
+                itemlist.append(qid)
+                result_sinks.report('claim_added', qid=qid, id=prop_id, value=i)
+            except (pywikibot.Error, pywikibot.data.api.APIError) as e:
+                skipped += 1
+                result_sinks.report('error', 'Error: Adding claim to %s failed: %s' % (qid, str(e)),
+                    qid=qid, id=prop_id, value=i, error=str(e))
+
+    if avoided:
+        print('%s claims were not sent because they already exist' % avoided)
+
+    return {'added': added, 'skipped': skipped, 'avoided': avoided, 'items': itemlist}
 
 
 def record_pages_without_items(titles, file_name):
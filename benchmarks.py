@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the scripts. They are run from the command line, e.g.
+
+    python cli.py bench-startup
+    python cli.py bench-convert
+"""
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules that must only be imported by the commands that need them
+HEAVY_MODULES = ['pywikibot', 'requests', 'bs4', 'sclib']
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def _time_run(code):
+    """Return the wall time of running the code in a fresh interpreter"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=HERE, check=True,
+        stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def bench_startup(runs=5, budget=0.1):
+    """
+    Measure how long it takes to start the command line (parse the
+    arguments of `--help`) compared to a bare interpreter, and check
+    that none of HEAVY_MODULES is imported at startup.
+
+    @param runs: Number of runs to take the median of
+    @param budget: Allowed startup time in seconds on top of the
+        bare interpreter
+    @return True if within the budget, False otherwise
+    """
+    startup = 'import cli; cli.build_parser().format_help()'
+    check = 'import sys, cli; cli.build_parser(); print(" ".join(m for m in %r if m in sys.modules))' \
+        % HEAVY_MODULES
+
+    bare = statistics.median(_time_run('pass') for i in range(runs))
+    total = statistics.median(_time_run(startup) for i in range(runs))
+    overhead = total - bare
+
+    loaded = subprocess.run([sys.executable, '-c', check], cwd=HERE, check=True,
+        stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+
+    print('Interpreter: %.3fs. Command line: %.3fs. Overhead: %.3fs (budget %.3fs)'
+        % (bare, total, overhead, budget))
+
+    if loaded:
+        print('Heavy modules imported at startup: %s' % ', '.join(loaded))
+
+    ok = overhead <= budget and not loaded
+    print('OK' if ok else 'FAILED')
+
+    return ok
+
+def value_corpus(count, seed=0):
+    """
+    Build a realistic corpus of raw infobox values: many values repeat
+    (countries, languages, years...) and a few are unique.
+
+    @param count: Number of values for each datatype
+    @param seed: Seed of the random generator
+    @return dictionary of {datatype: list of raw values}
+    """
+    rng = random.Random(seed)
+    months = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+        'August', 'September', 'October', 'November', 'December']
+
+    def pick(make, common):
+        # 80% of the values come from a small pool of common values
+        pool = [make() for i in range(common)]
+        return [rng.choice(pool) if rng.random() < 0.8 else make() for i in range(count)]
+
+    return {
+        'time': pick(lambda: rng.choice([
+            '%s %s %s' % (rng.randint(1, 28), rng.choice(months), rng.randint(1800, 2021)),
+            '%s %s' % (rng.choice(months), rng.randint(1800, 2021)),
+            str(rng.randint(1800, 2021))]), 200),
+        'wikibase-item': pick(lambda: 'Q%s' % rng.randint(1, 10 ** 8), 100),
+        'globe-coordinate': pick(lambda: ['%.4f' % rng.uniform(-90, 90), '%.4f' % rng.uniform(-180, 180)], 50),
+        'quantity': pick(lambda: rng.randint(0, 10 ** 6), 100),
+        'url': pick(lambda: 'www.example%s.org' % rng.randint(0, 10 ** 6), 20),
+        'commonsMedia': pick(lambda: 'Example %s.jpg' % rng.randint(0, 10 ** 6), 20),
+    }
+
+def _convert_value_one_by_one(repo, datatype, value):
+    """
+    Convert a raw value the way add_claim_to_item() did before the bulk
+    conversion: a commons site asked for every file and dates parsed
+    with strptime() in the format guessed from their number of words
+    """
+    import pywikibot
+    import outreachyscript
+    from datetime import datetime
+
+    if datatype == 'commonsMedia':
+        return pywikibot.FilePage(pywikibot.Site('commons', 'commons'), value)
+    elif datatype == 'time':
+        style = {3: '%d %B %Y', 2: '%B %Y'}.get(len(value.split()), '%Y')
+        date = datetime.strptime(value, style)
+        return pywikibot.WbTime(date.year, date.month, date.day, site=repo)
+
+    return outreachyscript.convert_value(repo, datatype, value)
+
+def bench_value_conversion(count=10000):
+    """
+    Compare converting raw values one by one, the way add_claim_to_item()
+    did before (see _convert_value_one_by_one()), with the bulk conversion
+    of outreachyscript.convert_values(). No request is made, the
+    datatypes are given.
+
+    @param count: Number of values for each datatype
+    """
+    import pywikibot
+    import outreachyscript
+
+    repo = pywikibot.Site('wikidata', 'wikidata')
+    corpus = value_corpus(count)
+
+    print('%-18s %12s %12s %8s' % ('datatype', 'one by one', 'bulk', 'speedup'))
+    for datatype, values in corpus.items():
+        start = time.perf_counter()
+        for value in values:
+            _convert_value_one_by_one(repo, datatype, value)
+        single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        outreachyscript.convert_values(repo, None, values, datatype)
+        bulk = time.perf_counter() - start
+
+        print('%-18s %11.0f/s %11.0f/s %7.1fx' % (datatype, len(values) / single,
+            len(values) / bulk, single / bulk))
+
+if __name__ == '__main__':
+    sys.exit(0 if bench_startup() else 1)
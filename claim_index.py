@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Local index of the claims known to exist in the repo.
+
+check_repo() records the claims of every item it reads, so the repo
+data already fetched during the extraction can be used to drop exact
+duplicate (QID, property, value) claims before writing them, instead
+of spending an edit (or a failed request) on each one.
+"""
+import os
+import sys
+sys.path.append(os.environ['PYWIKIBOT_DIR'])
+
+import threading
+import pywikibot
+
+_claims = set()
+_lock = threading.Lock()
+
+# Number of writes skipped because the claim already existed
+stats = {'avoided': 0}
+
+def normalize_value(value):
+    """
+    Reduce a claim target or a raw value culled from an article
+    to a comparable form.
+
+    @param value: pywikibot claim target, string or list of coordinates
+    @return hashable value
+    """
+    if isinstance(value, pywikibot.ItemPage):
+        return value.getID()
+    elif isinstance(value, pywikibot.FilePage):
+        return value.title(with_ns=False)
+    elif isinstance(value, pywikibot.Coordinate):
+        return (float(value.lat), float(value.lon))
+    elif isinstance(value, pywikibot.WbQuantity):
+        return str(value.amount)
+    elif isinstance(value, (list, tuple)):
+        try:
+            return tuple(float(v) for v in value)
+        except (TypeError, ValueError):
+            return tuple(value)
+    elif isinstance(value, str):
+        value = value.strip()
+        if value.lower().startswith('file:'):
+            value = value[len('file:'):].strip()
+        return value
+
+    return str(value)
+
+def record_claims(qid, p_id, claims):
+    """
+    Record existing claims of an item
+
+    @param qid: id of the item
+    @param p_id: property id of the claims
+    @param claims: list of pywikibot.Claim
+    """
+    with _lock:
+        for claim in claims:
+            _claims.add((qid, p_id, normalize_value(claim.getTarget())))
+
+def record(qid, p_id, value):
+    """
+    Record a single claim, e.g. after it was saved
+
+    @param qid: id of the item
+    @param p_id: property id
+    @param value: value of the claim
+    """
+    with _lock:
+        _claims.add((qid, p_id, normalize_value(value)))
+
+def is_duplicate(qid, p_id, value):
+    """
+    Check whether the claim is already known to exist. If it does, the
+    write is counted in stats['avoided'].
+
+    @param qid: id of the item
+    @param p_id: property id
+    @param value: value of the claim
+    @return True if the claim exists
+    """
+    with _lock:
+        if (qid, p_id, normalize_value(value)) in _claims:
+            stats['avoided'] += 1
+            return True
+
+    return False
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Property-scoped reads of the claims of items.
+
+Reading one property with ItemPage.get() downloads the whole entity,
+with every label, description, alias and sitelink, which is megabytes for
+big items. get_claims() asks the repo for the claims only, for up to
+BATCH_SIZE items per request, and keeps the requested properties. The
+claims are pywikibot.Claim objects attached to an ItemPage that knows its
+latest revision, so changeTarget(), addQualifier(), addSource() and
+editEntity() work on them just like on the claims of item.get().
+"""
+import os
+import sys
+sys.path.append(os.environ['PYWIKIBOT_DIR'])
+
+import pywikibot
+import resilience
+
+# Maximum number of ids accepted by wbgetentities per request
+BATCH_SIZE = 50
+
+def _is_loaded(item):
+    """Tell whether the whole entity was already downloaded"""
+    return hasattr(item, '_content')
+
+def get_claims(repo, items, p_ids):
+    """
+    Get the claims of some properties of many items, with batched
+    wbgetentities requests. Items already loaded are not requested again.
+
+    @param repo: DataSite object
+    @param items: iterable of entity ids or pywikibot.ItemPage
+    @param p_ids: property ids of the claims to get
+    @return dictionary of {qid: {property id: list of pywikibot.Claim}},
+        missing items have no property
+    """
+    items = {item.getID() if isinstance(item, pywikibot.ItemPage) else item: item for item in items}
+    claims = {}
+    missing = []
+
+    for qid, item in items.items():
+        if isinstance(item, pywikibot.ItemPage) and _is_loaded(item):
+            claims[qid] = {p_id: item.claims[p_id] for p_id in p_ids if p_id in item.claims}
+        else:
+            missing.append(qid)
+
+    for i in range(0, len(missing), BATCH_SIZE):
+        batch = missing[i:i + BATCH_SIZE]
+        data = resilience.call(repo.hostname(), repo.simple_request(action='wbgetentities',
+            ids='|'.join(batch), props='info|claims').submit)
+
+        for key, entity in data.get('entities', {}).items():
+            # Redirected ids are returned under the id of the target
+            qid = entity.get('redirects', {}).get('from', key)
+            claims[qid] = {}
+            if 'missing' in entity:
+                continue
+
+            item = items.get(qid)
+            if not isinstance(item, pywikibot.ItemPage):
+                item = pywikibot.ItemPage(repo, entity['id'])
+            item.latest_revision_id = entity['lastrevid']
+
+            for p_id in p_ids:
+                for data_claim in entity.get('claims', {}).get(p_id, []):
+                    claim = pywikibot.Claim.fromJSON(repo, data_claim)
+                    claim.on_item = item
+                    claims[qid].setdefault(p_id, []).append(claim)
+
+    return claims
+
+def get_item_claims(item, p_ids, repo=None):
+    """
+    Get the claims of some properties of a single item. See get_claims()
+
+    @param item: entity id or pywikibot.ItemPage
+    @param p_ids: property ids of the claims to get
+    @param repo: DataSite object, needed only if item is an id
+    @return dictionary of {property id: list of pywikibot.Claim}
+    """
+    if isinstance(item, pywikibot.ItemPage):
+        qid, repo = item.getID(), item.repo
+    else:
+        qid = item
+
+    return get_claims(repo, [item], p_ids).get(qid, {})
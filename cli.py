@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Single entry point for the scripts of this repo.
+
+    python cli.py <command> [options]
+
+Only the standard library is imported at startup. The module of a
+command (and with it pywikibot, requests, bs4...) is imported when that
+command is run, so short jobs and `--help` start quickly. Run
+`python cli.py bench-startup` to check the startup time.
+"""
+import argparse
+import importlib
+import sys
+
+# command: (module, function, help)
+COMMANDS = {
+    'import-ids': ('import_enwiki_external_ids', 'import_external_ids',
+        'Import external IDs of all the rules (or the given properties) from English Wikipedia'),
+    'import-netflix': ('import_enwiki_netflix_id', 'import_netflix_ids',
+        'Import Netflix IDs (P1874) from English Wikipedia'),
+    'import-soundcloud': ('import_enwiki_soundcloud_id', 'import_soundcloud_ids',
+        'Import SoundCloud IDs (P3040) from English Wikipedia'),
+    'fix-netflix': ('fix_netflix_id_mismatch', 'check_netflix_ids_mismatch',
+        'Resolve Netflix ID mismatches between Wikipedia and Wikidata'),
+    'fix-soundcloud': ('fix_soundcloud_id_mismatch', 'check_soundcloud_ids_mismatch',
+        'Resolve SoundCloud ID mismatches between Wikipedia and Wikidata'),
+    'add-statements': ('add_statements', 'main',
+        'Add the statements, qualifiers and references of add_statements.py'),
+    'add-claim-details': ('add_statements', 'add_claim_details',
+        'Add the qualifiers and references listed in a CSV or JSON lines file, one edit per item'),
+    'search-qids': ('search_terms_for_qids', 'main',
+        'Search the QIDs of the Task 1 pages and of unconnected pages'),
+    'build-label-index': ('label_index', 'build_index',
+        'Build the offline label and alias index of items from a Wikidata JSON dump'),
+    'compare-wikis': ('cross_wiki', 'compare_property',
+        'Compare the value of a property in the articles of every language and in the repo'),
+    'sync-daemon': ('sync_daemon', 'main',
+        'Watch recent changes and sync the edited pages of the tracked categories'),
+    'lint-patterns': ('pattern_registry', 'lint_patterns',
+        'Lint extraction patterns for catastrophic backtracking and common mistakes'),
+    'load-test': ('load_test', 'run_load_test',
+        'Replay a synthetic import against a local mock of the Wikibase API and compare write strategies'),
+    'bench-startup': ('benchmarks', 'bench_startup',
+        'Measure the startup time of this command line and check that no heavy module is imported'),
+    'bench-convert': ('benchmarks', 'bench_value_conversion',
+        'Measure the bulk conversion of raw values to Wikibase values'),
+}
+
+# Commands whose function accepts 'shard', 'store_path' and 'run_id'
+SHARDED_COMMANDS = ['import-ids', 'fix-netflix', 'fix-soundcloud']
+
+def build_parser():
+    """Return the argparse parser with a subcommand for every entry of COMMANDS"""
+    parser = argparse.ArgumentParser(description='Wikidata and Wikipedia synchronization scripts')
+    parser.add_argument('--sink', metavar='TYPE:PATH',
+        help='Also write the per-page results to a sink, e.g. jsonl:results.jsonl or sqlite:results.db')
+    parser.add_argument('--quiet', action='store_true',
+        help='Don\'t print the per-page results')
+    parser.add_argument('--shard', metavar='INDEX/COUNT',
+        help='Only process the pages of one shard (%s)' % ', '.join(SHARDED_COMMANDS))
+    parser.add_argument('--processes', type=int,
+        help='Split the pages between this many local processes (%s)' % ', '.join(SHARDED_COMMANDS))
+    parser.add_argument('--shard-store', metavar='PATH', default='shards.db',
+        help='SQLite store shared by the shards for claiming pages and merging the results')
+    parser.add_argument('--run-id',
+        help='Id of the run the shards claim pages for (default: a new one with --processes, '
+        'the current UTC date with --shard)')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    commands = {}
+    for name, (module, func, help) in COMMANDS.items():
+        commands[name] = subparsers.add_parser(name, help=help, description=help)
+        commands[name].set_defaults(target=(module, func))
+
+    commands['import-ids'].add_argument('p_ids', nargs='*', default=None,
+        help='Property IDs to import (default: all the rules)')
+    commands['import-ids'].add_argument('--depth', type=int, default=0,
+        help='Also go through the subcategories of the source categories down to this depth')
+    commands['import-ids'].add_argument('--workers', type=int, default=1,
+        help='Number of threads fetching the pages')
+    commands['import-ids'].add_argument('--parse-processes', type=int, default=0,
+        help='Scan the page texts in this many processes instead of the fetching threads')
+    commands['add-claim-details'].add_argument('path',
+        help='CSV (with a header) or .jsonl file with item, property, claim, type, prop and value fields')
+    commands['search-qids'].add_argument('--parallel', action='store_true',
+        help='Search all the wikis concurrently')
+    commands['search-qids'].add_argument('--rate', type=float, default=10,
+        help='Requests per second shared by all searches')
+    commands['search-qids'].add_argument('--total', type=int, default=1000,
+        help='Maximum number of unconnected pages to go through')
+    commands['search-qids'].add_argument('--label-index', metavar='PATH',
+        help='Match the unconnected pages with this offline label index before searching')
+    commands['build-label-index'].add_argument('dump_path', metavar='DUMP',
+        help='Wikidata JSON dump, e.g. latest-all.json.gz')
+    commands['build-label-index'].add_argument('--langs', nargs='+', default=['en'],
+        help='Languages of the labels and aliases to index')
+    commands['build-label-index'].add_argument('--index', dest='index_file', default='label_index.sqlite',
+        help='Path of the index file')
+    commands['compare-wikis'].add_argument('p_id', metavar='PROPERTY',
+        help='Property ID to compare')
+    commands['compare-wikis'].add_argument('qids', nargs='+', metavar='QID',
+        help='Items to compare')
+    commands['compare-wikis'].add_argument('--langs', nargs='+',
+        help='Languages of the wikis to compare (default: those with a known infobox key)')
+    commands['compare-wikis'].add_argument('--key', dest='keys', action='append', metavar='LANG=KEY',
+        help='Infobox key of the property in a language, e.g. fr=auteur (repeatable)')
+    commands['compare-wikis'].add_argument('--workers', type=int, default=8,
+        help='Number of wikis fetched concurrently')
+    commands['fix-soundcloud'].add_argument('--workers', type=int, default=4,
+        help='Number of threads checking the IDs on the website')
+    commands['sync-daemon'].add_argument('--mock-feed', metavar='PATH',
+        help='Read the changes from a JSON lines file instead of the recent changes')
+    commands['sync-daemon'].add_argument('--mock-members', metavar='PATH',
+        help='Read the category members from a JSON file instead of the site')
+    commands['sync-daemon'].add_argument('--dry-run', action='store_true',
+        help='Only report what would be done')
+    commands['sync-daemon'].add_argument('--debounce', type=float, default=10,
+        help='Seconds a page must stay unedited before it is processed')
+    commands['sync-daemon'].add_argument('--poll-interval', type=float, default=5,
+        help='Seconds between polls of the feed')
+    commands['sync-daemon'].add_argument('--refresh-interval', type=float, default=600,
+        help='Seconds between refreshes of the category members')
+    commands['lint-patterns'].add_argument('patterns', nargs='*',
+        help='Patterns to lint (default: the external ID rules)')
+    commands['load-test'].add_argument('--claims', type=int, default=500,
+        help='Number of claims to import')
+    commands['load-test'].add_argument('--claims-per-item', type=int, default=2,
+        help='Claims of each item')
+    commands['load-test'].add_argument('--strategies', nargs='+',
+        choices=['claim+reference', 'claim-with-reference', 'item-batch'],
+        help='Write strategies to run (default: all)')
+    commands['load-test'].add_argument('--workers', type=int, default=4,
+        help='Number of threads writing concurrently')
+    commands['load-test'].add_argument('--rate', type=float,
+        help='Requests per second of all the workers (default: no pacing)')
+    commands['load-test'].add_argument('--latency', type=float, default=0.02,
+        help='Mean latency of the mock API in seconds')
+    commands['load-test'].add_argument('--lag-per-edit', type=float, default=0.05,
+        help='Seconds of replication lag added by each edit')
+    commands['load-test'].add_argument('--edit-rate', type=float, default=50,
+        help='Edits per second allowed by the mock API before "ratelimited"')
+    commands['load-test'].add_argument('--maxlag', type=float, default=5,
+        help='maxlag sent with every request')
+    commands['bench-convert'].add_argument('--count', type=int, default=10000,
+        help='Number of values for each datatype')
+    commands['bench-startup'].add_argument('--runs', type=int, default=5,
+        help='Number of runs to take the median of')
+    commands['bench-startup'].add_argument('--budget', type=float, default=0.1,
+        help='Allowed startup time in seconds on top of the bare interpreter')
+
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = vars(parser.parse_args(argv))
+    command = args.pop('command')
+    module, func = args.pop('target')
+    sink, quiet = args.pop('sink'), args.pop('quiet')
+    shard, processes, store_path = args.pop('shard'), args.pop('processes'), args.pop('shard_store')
+    run_id = args.pop('run_id')
+
+    if (shard or processes) and command not in SHARDED_COMMANDS:
+        parser.error('%s cannot be sharded' % command)
+
+    if sink or quiet:
+        import result_sinks
+        result_sinks.configure(result_sinks.open_sink(sink) if sink else None, quiet)
+
+    if args.get('p_ids') == []:
+        args['p_ids'] = None
+
+    if processes:
+        import sharding
+        sharding.run_sharded(module, func, args, processes, store_path, quiet, run_id)
+        return
+    elif shard:
+        import sharding
+        try:
+            args['shard'] = sharding.parse_shard(shard)
+        except ValueError as e:
+            parser.error(str(e))
+        args['store_path'] = store_path
+        args['run_id'] = run_id or sharding.daily_run_id()
+
+        # Merge the results of this shard in the shared store
+        if not sink:
+            import result_sinks
+            result_sinks.configure(result_sinks.SqliteSink(store_path), quiet)
+
+    result = getattr(importlib.import_module(module), func)(**args)
+
+    # Functions of the scripts return 1 on success, only
+    # an explicit False is taken as a failure here
+    if result is False:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Cross-wiki comparison of one property for a set of items.
+
+compare_property() follows the sitelinks of the items to their article
+in every language, fetches the articles of each wiki in batches (the
+wikis concurrently), reads the value of the property in each infobox
+with the key of that language (KEY_MAPS) and compares it with the
+claims of the repo, labelled in the same language:
+
+    python cli.py compare-wikis P50 Q1 Q2 Q3 --langs en fr de
+
+The result is a consistency matrix of {qid: {lang: cell}}, printed as a
+table, and every cell is also reported to the result sinks.
+"""
+import os
+import sys
+sys.path.append(os.environ['PYWIKIBOT_DIR'])
+
+import re
+import decimal
+import pywikibot
+import get_statements2
+import infobox_index
+import label_cache
+import claim_reader
+import parse_pool
+import resilience
+import result_sinks
+import text_store
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Maximum number of ids or titles per API request
+BATCH_SIZE = 50
+
+# Infobox key (a simple string or subregex, as in get_statement_from_infobox())
+# of a property in each language
+KEY_MAPS = {
+    'P50': {'en': 'author', 'fr': 'auteur', 'de': 'autor', 'es': 'autor'},
+    'P84': {'en': 'architect', 'fr': 'architecte', 'de': 'architekt', 'es': 'arquitecto'},
+    'P123': {'en': 'publisher', 'fr': 'éditeur', 'de': 'verlag', 'es': 'editorial'},
+    'P131': {'en': '(location|administrative_region)', 'fr': '(localisation|ville|commune)',
+        'es': '(ubicación|localidad)'},
+    'P176': {'en': '(manufacturer|maker|producer)', 'fr': '(fabricant|constructeur)',
+        'de': 'hersteller', 'es': 'fabricante'},
+    'P27': {'en': '(nationality|citizenship)', 'fr': 'nationalit[ée]', 'de': 'staatsangehörigkeit',
+        'es': 'nacionalidad'},
+    'P571': {'en': '(formation|inception|started|founded)', 'fr': '(fondation|création)',
+        'de': 'gründung', 'es': 'fundación'},
+    'P625': {'en': 'coordinates', 'fr': 'coordonnées', 'es': 'coordenadas'},
+    'P1083': {'en': 'seating_capacity', 'fr': 'capacité', 'de': 'plätze', 'es': 'capacidad'},
+}
+
+# Status of a cell of the matrix, and its symbol in the printed table
+STATUS_SYMBOLS = {
+    'match': '=',
+    'mismatch': 'X',
+    'not_in_repo': '+',
+    'not_in_article': '-',
+    'not_found': '.',
+    'no_article': '',
+}
+
+# Numbers (signed when the sign starts a word) and words
+_TOKEN = re.compile(r'(?:(?<![\w.])-)?\d+(?:\.\d+)?|[^\W\d_]+')
+_THOUSANDS = re.compile(r'(?<=\d),(?=\d{3}(?!\d))')
+# Time values of the repo, see pywikibot.WbTime.toTimestamp()
+_TIMESTAMP = re.compile(r'^[+-]?(\d{1,4})-(\d\d)-(\d\d)T')
+
+def get_sitelinks(repo, qids, langs):
+    """
+    Get the Wikipedia articles of many items in several languages,
+    with batched requests
+
+    @param repo: DataSite object
+    @param qids: iterable of item ids
+    @param langs: language codes of the wikis
+    @return dictionary of {qid: {lang: title}}
+    """
+    qids = list(dict.fromkeys(qids))
+    sites = {'%swiki' % lang: lang for lang in langs}
+    sitelinks = {qid: {} for qid in qids}
+
+    for i in range(0, len(qids), BATCH_SIZE):
+        batch = qids[i:i + BATCH_SIZE]
+        data = resilience.call(repo.hostname(), repo.simple_request(action='wbgetentities',
+            ids='|'.join(batch), props='sitelinks', sitefilter='|'.join(sites)).submit)
+
+        for key, entity in data.get('entities', {}).items():
+            qid = entity.get('redirects', {}).get('from', key)
+            for site, link in entity.get('sitelinks', {}).items():
+                if site in sites:
+                    sitelinks.setdefault(qid, {})[sites[site]] = link['title']
+
+    return sitelinks
+
+def extract_value(page, key):
+    """
+    Read the value of an infobox key in the text of a page, like
+    get_statement_from_infobox() does, and clean it up for comparison:
+    links are reduced to their target and coordinates to their numbers.
+
+    @param page: pywikibot.Page
+    @param key: the key (a simple string or subregex)
+    @return string value or None
+    """
+    value = infobox_index.find_param(infobox_index.get_page_index(page), key)
+    if not value:
+        for result in parse_pool.scan_infobox_key(text_store.get_text(page), key):
+            # The groups of the key come first when it has any
+            candidates = result if isinstance(result, tuple) else [result]
+            value = next((c for c in reversed(candidates) if c.strip()), None)
+            if value:
+                break
+
+    if not value:
+        return None
+
+    value = value.strip()
+    if '{{coord|' in value.lower():
+        return ', '.join(parse_pool.coord_digits(value))
+    return parse_pool.strip_wikilinks(value).strip()
+
+def fetch_values(site, titles, key):
+    """
+    Fetch the articles of one wiki in batches (see text_store.prefetch())
+    and read the value of a key
+
+    @param site: pywikibot.Site
+    @param titles: list of article titles
+    @param key: infobox key of the property in the language of the site
+    @return dictionary of {title: value or None}
+    """
+    values = {}
+    for i in range(0, len(titles), BATCH_SIZE):
+        batch = titles[i:i + BATCH_SIZE]
+        text_store.prefetch(site, batch)
+        for title in batch:
+            values[title] = extract_value(pywikibot.Page(site, title), key)
+
+    return values
+
+def get_repo_values(repo, qids, p_id, langs):
+    """
+    Get the values of the claims of a property, in the form
+    check_repo() gives them, with item targets labelled in each language
+
+    @return dictionary of {qid: {lang: list of values}}
+    """
+    claims = claim_reader.get_claims(repo, qids, [p_id])
+
+    targets = [claim.getTarget().getID() for item_claims in claims.values()
+        for claim in item_claims.get(p_id, []) if isinstance(claim.getTarget(), pywikibot.ItemPage)]
+    if targets:
+        label_cache.get_labels(repo, targets, langs)
+
+    values = {}
+    for qid in qids:
+        item = pywikibot.ItemPage(repo, qid)
+        item_claims = claims.get(qid, {}).get(p_id, [])
+        values[qid] = {lang: [str(get_statements2.check_repo(item, p_id, lang, [claim]))
+            for claim in item_claims] for lang in langs}
+
+    return values
+
+def _tokens(value):
+    """
+    Split a value into lowercase words and numbers, with the numbers in
+    one form: '60,491 (football)' -> {'60491', 'football'}, '6.30' -> {'6.3'}
+    """
+    tokens = set()
+    for token in _TOKEN.findall(_THOUSANDS.sub('', str(value))):
+        if token[-1].isdigit():
+            token = format(decimal.Decimal(token).normalize(), 'f')
+        tokens.add(token.casefold())
+    return tokens
+
+def _same_value(value, repo_value):
+    """Tell whether the value of an article is the value of the repo, see compare_value()"""
+    timestamp = _TIMESTAMP.match(str(repo_value))
+    if timestamp:
+        year, month, day = map(int, timestamp.groups())
+        try:
+            precision, date = parse_pool.parse_date(value)
+        except ValueError:
+            return str(year) in _tokens(value)
+        return (date['year'], date.get('month', month), date.get('day', day)) == (year, month, day)
+
+    tokens, repo_tokens = _tokens(value), _tokens(repo_value)
+    return bool(tokens and repo_tokens) and (tokens <= repo_tokens or repo_tokens <= tokens)
+
+def compare_value(value, repo_values):
+    """
+    Compare the value of an article with the values of the repo. They
+    match when all the words and numbers of one are among those of the
+    other, so that '[[Monrovia]], Liberia' matches 'Monrovia' and
+    '60,491' matches 60491, but 'UK' doesn't match 'Ukraine'. Dates are
+    compared field by field, so that '1952' and '1 July 1952' match
+    '1952-07-01T00:00:00Z'.
+
+    @param value: value of the article or None
+    @param repo_values: list of the values of the repo
+    @return status, a key of STATUS_SYMBOLS
+    """
+    if not value and not repo_values:
+        return 'not_found'
+    elif not value:
+        return 'not_in_article'
+    elif not repo_values:
+        return 'not_in_repo'
+
+    if any(_same_value(value, repo_value) for repo_value in repo_values):
+        return 'match'
+
+    return 'mismatch'
+
+def print_matrix(matrix, langs):
+    """Print the consistency matrix as a table, with the legend and the totals per language"""
+    width = max([len(qid) for qid in matrix] + [6])
+    print(' ' * width + ''.join('%6s' % lang for lang in langs))
+    for qid, cells in matrix.items():
+        print(qid.ljust(width) + ''.join('%6s' % STATUS_SYMBOLS[cells[lang]['status']] for lang in langs))
+
+    print(', '.join('%s %s' % (symbol or "' '", status) for status, symbol in STATUS_SYMBOLS.items()))
+    for lang in langs:
+        counts = {}
+        for cells in matrix.values():
+            counts[cells[lang]['status']] = counts.get(cells[lang]['status'], 0) + 1
+        print('%s: %s' % (lang, ', '.join('%s %s' % (count, status) for status, count in sorted(counts.items()))))
+
+def compare_property(p_id, qids, langs=None, keys=None, workers=8):
+    """
+    Compare the value of a property in the articles of every language
+    and in the repo, for many items.
+
+    @param p_id: the property id
+    @param qids: list of item ids
+    @param langs: language codes of the wikis to compare, the
+        languages of KEY_MAPS[p_id] (and keys) if None
+    @param keys: dictionary of {lang: infobox key} (or list of 'lang=key'
+        strings) to use instead of those of KEY_MAPS
+    @param workers: Number of wikis fetched concurrently
+    @return dictionary of {qid: {lang: {'title', 'value', 'repo_value', 'status'}}}
+    """
+    if keys and not isinstance(keys, dict):
+        keys = dict(key.split('=', 1) for key in keys)
+    keys = dict(KEY_MAPS.get(p_id, {}), **(keys or {}))
+    langs = list(langs or keys)
+
+    unknown = [lang for lang in langs if lang not in keys]
+    if unknown:
+        raise ValueError('No infobox key of %s for %s, give it with keys' % (p_id, ', '.join(unknown)))
+
+    repo = pywikibot.Site('wikidata', 'wikidata').data_repository()
+    qids = list(dict.fromkeys(qids))
+    sitelinks = get_sitelinks(repo, qids, langs)
+    repo_values = get_repo_values(repo, qids, p_id, langs)
+
+    # One task per wiki: the articles of a wiki are fetched in batches,
+    # the wikis are fetched concurrently
+    values = {}
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {}
+        for lang in langs:
+            titles = [links[lang] for links in sitelinks.values() if lang in links]
+            if titles:
+                site = pywikibot.Site(lang, 'wikipedia')
+                futures[lang] = executor.submit(fetch_values, site, titles, keys[lang])
+
+        for lang, future in futures.items():
+            try:
+                values[lang] = future.result()
+            except Exception as e:
+                result_sinks.report('error', 'Error: Could not fetch the %s articles: %s' % (lang, str(e)),
+                    lang=lang, error=str(e))
+                values[lang] = {}
+
+    matrix = {}
+    for qid in qids:
+        matrix[qid] = {}
+        for lang in langs:
+            title = sitelinks.get(qid, {}).get(lang)
+            value = values.get(lang, {}).get(title) if title else None
+            cell = {
+                'title': title,
+                'value': value,
+                'repo_value': repo_values[qid][lang],
+                'status': compare_value(value, repo_values[qid][lang]) if title else 'no_article',
+            }
+            matrix[qid][lang] = cell
+
+            if title:
+                result_sinks.report('comparison', None, id=p_id, qid=qid, lang=lang, **cell)
+
+    print_matrix(matrix, langs)
+    return matrix
@@ -4,98 +4,179 @@ import os
 import sys
 sys.path.append(os.environ['PYWIKIBOT_DIR'])
 
+import itertools
 import json
-import requests
 import pywikibot
 import import_enwiki_netflix_id
+import result_sinks
+import claim_reader
+import sharding
+import resilience
+import text_store
 
-from bs4 import BeautifulSoup
 from pywikibot import pagegenerators
 from import_enwiki_netflix_id import NETFLIX_ID_PROPERTY
 
 CATEGORY = 'Category:Netflix_title_ID_different_from_Wikidata'
 NETFLIX_BASE_URL = 'https://www.netflix.com/title/'
 
-def check_netflix_ids_mismatch():
+def check_netflix_ids_mismatch(shard=None, store_path=None, run_id=None):
     """
     Check mismatch between Netflix IDs in Wikidata which are different
     from what is in the corresponing article in English Wikipedia.
+
+    @param shard: (index, count) to only process the pages of one shard,
+        see sharding.select()
+    @param store_path: path of the store shared by the shards
+    @param run_id: id of the run the shards claim pages for
     """
     wiki = pywikibot.Site('en', 'wikipedia')
     category = pywikibot.Category(wiki, CATEGORY)
     pages = pagegenerators.CategorizedPageGenerator(category)
+    pages = iter(sharding.select(pages, shard, store_path, run_id=run_id))
 
     total_pages = 0
     processed = 0
     result = []
 
-    for page in pages:
+    # The pages are compared a chunk at a time, the texts and the repo
+    # IDs of a chunk are read with batched requests
+    for page, ids in _chunks(pages, wiki):
         total_pages += 1
-        res = compare_netflix_ids(page, wiki)
+        res = compare_netflix_ids(page, wiki, ids)
 
         if res == True:
             # The IDs are the same, nothing to do. The category may contains cached entries
-            print('The ID for "%s" are the same in both the article and Wikidata.' % page.title())
+            result_sinks.report('same', 'The ID for "%s" are the same in both the article and Wikidata.' % page.title(),
+                title=page.title())
             processed += 1
             continue
         elif not res:
-            print('Skipping %s. It has no Netflix ID' % page.title())
+            result_sinks.report('skipped', 'Skipping %s. It has no Netflix ID' % page.title(), title=page.title())
             processed += 1
             continue
 
         result.append([res, page])
 
-    for ids, page in result:
-        title = page.title()
-
-        # Now we have two IDs (one from article, another from repo).
-        # Let us check their associated movie titles in the website
-        repoId = ids['repoId']
-        wikiId = ids['articleId']
-        web_name1 = get_netflix_moviename(repoId)
-        web_name2 = get_netflix_moviename(wikiId)
-
-        if web_name1 == web_name2:
-            # Since the names are the same, then definitely both IDs are valid for the
-            # title and visiting the URL with either of the IDs will confirm this.
-            print('''The movie "{t}" has two different Netflix IDs and both are correct.
-                repoId: {rId}, articleId: {wId}. This can be confirmed by
-                visiting {url}{rId} and {url}{wId} which will all resolve to
-                the same page'''.format(t=title, rId=repoId, wId=wikiId, url=NETFLIX_BASE_URL))
-            processed += 1
-        else:
-            # At this stage, the IDs are still different and do not belong to the same title
-            wiki_name = title.partition('(')[0].strip() # strip wiki disambiguation markers
-            if web_name1 == wiki_name:
-                print('The Wikidata netflix ID: %s is the correct one for the title %s:' %(repoId, title))
-                processed += 1
-            elif web_name2 == wiki_name:
-                print('The Article netflix ID: %s is the correct one for the title %s:' %(wikiId, title))
-                processed += 1
-            else:
-                if not web_name1 and web_name2:
-                    # The repo has the incorrect id, so we will fix it now
-                    print('Found the correct ID for %s. ID => %s' %(title, wikiId))
-                    print('Fixing it now...')
-                    item = page.data_item()
-                    item_dict = item.get()
-                    for claim in item_dict['claims'][NETFLIX_ID_PROPERTY]:
-                        print('Changing %s -> %s...' %(claim.getTarget(), wikiId))
-                        claim.changeTarget(wikiId)
-                    processed += 1
-                elif not web_name2 and web_name1:
-                    # This script will not edit English now, it's the one with incorrect id
-                    print('Found the correct ID for %s (already in the repo). ID => %s' %(title, repoId))
-                    print('The article in the Wikipedia article needs to be corrected now')
-                    processed += 1
-                else:
-                    print('''Cannot resolve the ids (%s and %s) to an article. Both for the wiki title: '%s'.
-                        Netflix Web titles are ['%s' and '%s']
-                        ''' %(repoId, wikiId, title, web_name1, web_name2))
-                    processed += 1
+    # Mismatches whose checks fail on a timeout or a server error are tried again later
+    jobs = {page.title(): (ids, page) for ids, page in result}
+    titles = resilience.RetryQueue(jobs)
+    for title in titles:
+        try:
+            resolve_netflix_mismatch(*jobs[title])
+        except Exception as e:
+            if not resilience.should_requeue(e):
+                raise
+            if not titles.retry(title, e):
+                result_sinks.report('error', 'Error: Giving up on %s: %s' % (title, str(e)),
+                    title=title, error=str(e))
+            continue
+        processed += 1
+
+    # Let a later worker of the run try the pages given up again
+    sharding.release([title for title, error in titles.given_up], shard, store_path, run_id)
 
     print('Finished! Total pages: %s. Processed: %s' %(total_pages, processed))
 
+def _chunks(pages, wiki):
+    """Yield the pages with the IDs of their chunk, see get_netflix_ids()"""
+    while True:
+        chunk = list(itertools.islice(pages, text_store.BATCH_SIZE))
+        if not chunk:
+            break
+        ids = import_enwiki_netflix_id.get_netflix_ids(wiki, [page.title() for page in chunk])
+        for page in chunk:
+            yield page, ids
+
+def check_netflix_page(page, wiki):
+    """
+    Compare the Netflix IDs of a single page and resolve the mismatch, if any
+
+    @param page: pywikibot.Page object
+    @param wiki: pywikibot.Site object
+    """
+    res = compare_netflix_ids(page, wiki)
+
+    if res == True:
+        result_sinks.report('same', 'The ID for "%s" are the same in both the article and Wikidata.' % page.title(),
+            title=page.title())
+    elif not res:
+        result_sinks.report('skipped', 'Skipping %s. It has no Netflix ID' % page.title(), title=page.title())
+    else:
+        resolve_netflix_mismatch(res, page)
+
+def resolve_netflix_mismatch(ids, page):
+    """
+    Check the two different IDs of a page on the website and fix the
+    repo when only the ID of the article is valid.
+
+    @param ids: dictionary returned by compare_netflix_ids()
+    @param page: pywikibot.Page object
+    """
+    title = page.title()
+
+    # Now we have two IDs (one from article, another from repo).
+    # Let us check their associated movie titles in the website
+    repoId = ids['repoId']
+    wikiId = ids['articleId']
+    web_name1 = get_netflix_moviename(repoId)
+    web_name2 = get_netflix_moviename(wikiId)
+
+    if web_name1 == web_name2:
+        # Since the names are the same, then definitely both IDs are valid for the
+        # title and visiting the URL with either of the IDs will confirm this.
+        result_sinks.report('both_valid', '''The movie "{t}" has two different Netflix IDs and both are correct.
+            repoId: {rId}, articleId: {wId}. This can be confirmed by
+            visiting {url}{rId} and {url}{wId} which will all resolve to
+            the same page'''.format(t=title, rId=repoId, wId=wikiId, url=NETFLIX_BASE_URL),
+            title=title, repoId=repoId, articleId=wikiId)
+    else:
+        # At this stage, the IDs are still different and do not belong to the same title
+        wiki_name = title.partition('(')[0].strip() # strip wiki disambiguation markers
+        if web_name1 == wiki_name:
+            result_sinks.report('repo_correct', 'The Wikidata netflix ID: %s is the correct one for the title %s:'
+                %(repoId, title), title=title, repoId=repoId, articleId=wikiId)
+        elif web_name2 == wiki_name:
+            result_sinks.report('article_correct', 'The Article netflix ID: %s is the correct one for the title %s:'
+                %(wikiId, title), title=title, repoId=repoId, articleId=wikiId)
+        else:
+            if not web_name1 and web_name2:
+                # The repo has the incorrect id, so we will fix it now
+                result_sinks.log('Found the correct ID for %s. ID => %s\nFixing it now...' %(title, wikiId))
+                # Only the claims of the property, not the whole item: its id
+                # comes with the page text
+                qid = text_store.get_item_id(page)
+                claims = claim_reader.get_item_claims(qid, [NETFLIX_ID_PROPERTY], page.site.data_repository()) if qid else {}
+                claims = claims.get(NETFLIX_ID_PROPERTY, [])
+                if not claims:
+                    result_sinks.report('not_fixed', 'The item of %s has no Netflix ID claim, nothing was changed'
+                        % title, title=title, repoId=repoId, articleId=wikiId, qid=qid)
+                    return
+
+                for claim in claims:
+                    result_sinks.log('Changing %s -> %s...' %(claim.getTarget(), wikiId))
+                    try:
+                        claim.changeTarget(wikiId)
+                    except pywikibot.Error as e:
+                        if resilience.should_requeue(e):
+                            raise
+                        result_sinks.report('error', 'Error: Changing the ID of %s failed: %s' % (title, str(e)),
+                            title=title, repoId=repoId, articleId=wikiId, qid=qid, error=str(e))
+                        return
+
+                result_sinks.report('fixed', 'Fixed the ID of %s: %s -> %s' % (title, repoId, wikiId),
+                    title=title, repoId=repoId, articleId=wikiId, qid=qid)
+            elif not web_name2 and web_name1:
+                # This script will not edit English now, it's the one with incorrect id
+                result_sinks.report('article_needs_fix', 'Found the correct ID for %s (already in the repo). ID => %s\n'
+                    'The article in the Wikipedia article needs to be corrected now' %(title, repoId),
+                    title=title, repoId=repoId, articleId=wikiId)
+            else:
+                result_sinks.report('unresolved', '''Cannot resolve the ids (%s and %s) to an article. Both for the wiki title: '%s'.
+                    Netflix Web titles are ['%s' and '%s']
+                    ''' %(repoId, wikiId, title, web_name1, web_name2),
+                    title=title, repoId=repoId, articleId=wikiId)
+
 def get_netflix_moviename(id):
     """
     Given a valid netflix identifier, this function queries the netflix
@@ -107,7 +188,10 @@ def get_netflix_moviename(id):
     @param id: Netflix Id
     @return string the movie name or empty string
     """
-    web_request = requests.get('https://www.netflix.com/title/' + str(id))
+    # Only needed for the web lookups, don't pay for them at startup
+    from bs4 import BeautifulSoup
+
+    web_request = resilience.http_get(NETFLIX_BASE_URL + str(id))
     html = BeautifulSoup(web_request.content, 'html.parser')
     data = html.find('script', type='application/ld+json')
 
@@ -119,7 +203,7 @@ def get_netflix_moviename(id):
 
     return name
 
-def compare_netflix_ids(page, wiki):
+def compare_netflix_ids(page, wiki, ids=None):
     """
     Extract the Netflix Id from the article and also extract it from the
     Wikidata Item. Then compare, if they're equal stop and return True as
@@ -128,10 +212,15 @@ def compare_netflix_ids(page, wiki):
 
     @param page: pywikibot.Page object
     @param wiki: pywikibot.Site object
+    @param ids: IDs of the chunk of the page returned by get_netflix_ids(),
+        None to read the IDs of the page alone
     @return True if the IDs are equal, dict() if they are not;
         or None if we cannot extract the ID
     """
-    result = import_enwiki_netflix_id.get_netflix_id(wiki, page.title())
+    if ids is not None:
+        result = ids[page.title()]
+    else:
+        result = import_enwiki_netflix_id.get_netflix_id(wiki, page.title())
 
     if result:
         articleId = result['value'] # extracted from article
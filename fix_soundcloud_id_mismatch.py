@@ -4,69 +4,196 @@ import os
 import sys
 sys.path.append(os.environ['PYWIKIBOT_DIR'])
 
+import itertools
+import queue
+import threading
 import pywikibot
 import import_enwiki_soundcloud_id
+import result_sinks
+import claim_reader
+import sharding
+import resilience
+import text_store
 
-from sclib import sync
-from bs4 import BeautifulSoup
 from pywikibot import pagegenerators
+from import_enwiki_soundcloud_id import SOUNDCLOUD_ID_PROPERTY
 from urllib.error import (HTTPError, URLError)
 
 CATEGORY = 'Category:SoundCloud ID different from Wikidata'
 SOUNDCLOUD_BASE_URL = 'https://soundcloud.com/'
 
-def check_soundcloud_ids_mismatch():
+def check_soundcloud_ids_mismatch(workers=4, shard=None, store_path=None, run_id=None):
     """
     Check mismatch between SoundCloud IDs in Wikidata which are different
     from what is in the corresponing article in English Wikipedia.
+
+    Walking the category and comparing the IDs runs in this thread while
+    the mismatches it finds are resolved by the worker threads at the
+    same time, so the remote checks start as soon as the first mismatch
+    is found instead of after the whole category.
+
+    @param workers: Number of threads checking the IDs on the website
+    @param shard: (index, count) to only process the pages of one shard,
+        see sharding.select()
+    @param store_path: path of the store shared by the shards
+    @param run_id: id of the run the shards claim pages for
     """
     wiki = pywikibot.Site('en', 'wikipedia')
     category = pywikibot.Category(wiki, CATEGORY)
     pages = pagegenerators.CategorizedPageGenerator(category)
+    pages = iter(sharding.select(pages, shard, store_path, run_id=run_id))
 
-    total_pages = 0
-    processed = 0
-    result = []
+    counts = {'total': 0, 'processed': 0}
+    lock = threading.Lock()
+    mismatches = queue.Queue(maxsize=workers * 4)
+    failed = {}
 
-    for page in pages:
-        total_pages += 1
-        res = compare_soundcloud_ids(page, wiki)
+    def resolve_mismatches():
+        while True:
+            job = mismatches.get()
+            if job is None:
+                break
 
-        if res == True:
-            # The IDs are the same, nothing to do. The category may contains cached entries
-            print('The ID for "%s" are the same in both the article and Wikidata.' % page.title())
-            processed += 1
-            continue
-        elif not res:
-            print('Skipping %s. It has no SoundCloud ID' % page.title())
-            processed += 1
+            try:
+                resolve_soundcloud_mismatch(*job)
+            except Exception as e:
+                if resilience.should_requeue(e):
+                    # Try it again once the walk is done, don't lose it
+                    with lock:
+                        failed[job[1].title()] = job
+                    continue
+                # Keep draining the queue, a dead worker would block the walk
+                result_sinks.report('error', 'Error: Resolving %s failed: %s' % (job[1].title(), str(e)),
+                    title=job[1].title(), error=str(e))
+                continue
+
+            with lock:
+                counts['processed'] += 1
+
+    threads = [threading.Thread(target=resolve_mismatches) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        # The pages are compared a chunk at a time, the texts and the repo
+        # IDs of a chunk are read with batched requests
+        for page, ids in _chunks(pages, wiki):
+            with lock:
+                counts['total'] += 1
+            res = compare_soundcloud_ids(page, wiki, ids)
+
+            if res == True:
+                # The IDs are the same, nothing to do. The category may contains cached entries
+                result_sinks.report('same', 'The ID for "%s" are the same in both the article and Wikidata.'
+                    % page.title(), title=page.title())
+            elif not res:
+                result_sinks.report('skipped', 'Skipping %s. It has no SoundCloud ID' % page.title(),
+                    title=page.title())
+            else:
+                mismatches.put((res, page))
+                continue
+
+            with lock:
+                counts['processed'] += 1
+    finally:
+        for thread in threads:
+            mismatches.put(None)
+        for thread in threads:
+            thread.join()
+
+    titles = resilience.RetryQueue(failed)
+    for title in titles:
+        try:
+            resolve_soundcloud_mismatch(*failed[title])
+        except Exception as e:
+            if not resilience.should_requeue(e):
+                raise
+            if not titles.retry(title, e):
+                result_sinks.report('error', 'Error: Giving up on %s: %s' % (title, str(e)),
+                    title=title, error=str(e))
             continue
+        counts['processed'] += 1
+
+    # Let a later worker of the run try the pages given up again
+    sharding.release([title for title, error in titles.given_up], shard, store_path, run_id)
+
+    print('Finished! Total pages: %s. Processed: %s' %(counts['total'], counts['processed']))
+
+def check_soundcloud_page(page, wiki):
+    """
+    Compare the SoundCloud IDs of a single page and resolve the mismatch, if any
+
+    @param page: pywikibot.Page object
+    @param wiki: pywikibot.Site object
+    """
+    res = compare_soundcloud_ids(page, wiki)
+
+    if res == True:
+        result_sinks.report('same', 'The ID for "%s" are the same in both the article and Wikidata.'
+            % page.title(), title=page.title())
+    elif not res:
+        result_sinks.report('skipped', 'Skipping %s. It has no SoundCloud ID' % page.title(),
+            title=page.title())
+    else:
+        resolve_soundcloud_mismatch(res, page)
 
-        result.append([res, page.title()])
-
-    for ids, title in result:
-        # Now we have two IDs (one from article, another from repo).
-        # Let us check their associated movie titles in the website
-        repoId = ids['repoId']
-        wikiId = ids['articleId']
-        c_url, response_code1 = check_soundcloud_id(repoId)
-        c_url2, response_code2 = check_soundcloud_id(wikiId)
-
-        if c_url == c_url2:
-            # Both valid
-            print('''Both SoundClouds IDs are valid for the title. %s''' % title)
-            processed += 1
-        elif response_code1 == 404 and response_code1 != response_code2:
-            # Handle case
-            processed += 1
-        elif response_code2 == 404 and response_code2 != response_code1:
-            # Handle case
-            processed += 1
-        else:
-            # Handle final case
-            pass
-
-    print('Finished! Total pages: %s. Processed: %s' %(total_pages, processed))
+def resolve_soundcloud_mismatch(ids, page):
+    """
+    Check the two different IDs of a page on the website and fix the
+    repo when only the ID of the article is valid.
+
+    @param ids: dictionary returned by compare_soundcloud_ids()
+    @param page: pywikibot.Page object
+    """
+    title = page.title()
+
+    # Now we have two IDs (one from article, another from repo).
+    # Let us check their canonical locations in the website
+    repoId = ids['repoId']
+    wikiId = ids['articleId']
+    c_url, response_code1 = check_soundcloud_id(repoId) if repoId else ('', None)
+    c_url2, response_code2 = check_soundcloud_id(wikiId)
+
+    if c_url and c_url == c_url2:
+        # Both valid
+        result_sinks.report('both_valid', '''Both SoundClouds IDs are valid for the title. %s''' % title,
+            title=title, repoId=repoId, articleId=wikiId)
+    elif response_code1 == 404 and c_url2:
+        # The repo has the incorrect id, so we will fix it now
+        result_sinks.log('Found the correct ID for %s. ID => %s\nFixing it now...' %(title, wikiId))
+        # Only the claims of the property, not the whole item: its id
+        # comes with the page text
+        qid = text_store.get_item_id(page)
+        claims = claim_reader.get_item_claims(qid, [SOUNDCLOUD_ID_PROPERTY], page.site.data_repository()) if qid else {}
+        claims = [claim for claim in claims.get(SOUNDCLOUD_ID_PROPERTY, []) if claim.getTarget() == repoId]
+        if not claims:
+            result_sinks.report('not_fixed', 'The item of %s has no claim with the ID %s, nothing was changed'
+                % (title, repoId), title=title, repoId=repoId, articleId=wikiId, qid=qid)
+            return
+
+        for claim in claims:
+            result_sinks.log('Changing %s -> %s...' %(repoId, wikiId))
+            try:
+                claim.changeTarget(wikiId)
+            except pywikibot.Error as e:
+                if resilience.should_requeue(e):
+                    raise
+                result_sinks.report('error', 'Error: Changing the ID of %s failed: %s' % (title, str(e)),
+                    title=title, repoId=repoId, articleId=wikiId, qid=qid, error=str(e))
+                return
+
+        result_sinks.report('fixed', 'Fixed the ID of %s: %s -> %s' % (title, repoId, wikiId),
+            title=title, repoId=repoId, articleId=wikiId, qid=qid)
+    elif response_code2 == 404 and c_url:
+        # This script will not edit English now, it's the one with incorrect id
+        result_sinks.report('article_needs_fix', 'Found the correct ID for %s (already in the repo). ID => %s\n'
+            'The article in the Wikipedia article needs to be corrected now' %(title, repoId),
+            title=title, repoId=repoId, articleId=wikiId)
+    else:
+        result_sinks.report('unresolved', '''Cannot resolve the ids (%s and %s) for the wiki title: '%s'.
+            SoundCloud locations are ['%s' (%s) and '%s' (%s)]
+            ''' %(repoId, wikiId, title, c_url, response_code1, c_url2, response_code2),
+            title=title, repoId=repoId, articleId=wikiId)
 
 def check_soundcloud_id(id):
     """
@@ -76,23 +203,41 @@ def check_soundcloud_id(id):
     @param id: SoundCloud identifier.
     @return List[] canonical url of the title or empty string, and the response code
     """
+    # Only needed for the web lookups, don't pay for them at startup
+    from sclib import sync
+    from bs4 import BeautifulSoup
+
     c_url = ''
 
     try:
-       page = sync.get_page(SOUNDCLOUD_BASE_URL + str(id))
+       page = resilience.call('soundcloud.com', sync.get_page, SOUNDCLOUD_BASE_URL + str(id))
     except (HTTPError, URLError) as e:
-       return c_url, e.code
+       # Timeouts and server errors are left to the caller to retry the page later
+       if resilience.should_requeue(e):
+           raise
+       # Only HTTPError has a status code
+       return c_url, getattr(e, 'code', None)
     
     code = None
     if page:
         html = BeautifulSoup(page, 'html.parser')
         data = html.find('link', {'rel': 'canonical'})
-        c_url = data['href']
+        c_url = data['href'] if data else ''
         code = 200 # successful request
 
     return c_url, code
 
-def compare_soundcloud_ids(page, wiki):
+def _chunks(pages, wiki):
+    """Yield the pages with the IDs of their chunk, see get_soundcloud_ids()"""
+    while True:
+        chunk = list(itertools.islice(pages, text_store.BATCH_SIZE))
+        if not chunk:
+            break
+        ids = import_enwiki_soundcloud_id.get_soundcloud_ids(wiki, [page.title() for page in chunk])
+        for page in chunk:
+            yield page, ids
+
+def compare_soundcloud_ids(page, wiki, ids=None):
     """
     Extract the SoundCloud Id from the article and also extract it from the
     Wikidata Item. Then compare, if they're equal stop and return True as
@@ -101,11 +246,15 @@ def compare_soundcloud_ids(page, wiki):
 
     @param page: pywikibot.Page object
     @param wiki: pywikibot.Site object
+    @param ids: IDs of the chunk of the page returned by get_soundcloud_ids(),
+        None to read the IDs of the page alone
     @return True if the IDs are equal, dict() if they are not;
         or None if we cannot extract the ID
     """
-
-    result = import_enwiki_soundcloud_id.get_soundcloud_id(wiki, page.title())
+    if ids is not None:
+        result = ids[page.title()]
+    else:
+        result = import_enwiki_soundcloud_id.get_soundcloud_id(wiki, page.title())
 
     if result:
         articleId = result['value'] # extracted from article
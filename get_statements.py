@@ -2,6 +2,7 @@
 
 import pywikibot
 import re
+import text_store
 
 def get_statement_from_article():
     """
@@ -28,7 +29,7 @@ def get_statement_from_article():
     # a key-value pair of property and value. 'Auteur' means 'Author' in French and
     # we don't care about the case of the string so we passed the re.IGNORECASE flag
     # 'value' is what we are eventually looking for and it will be the author name.
-    result = re.search(r"Auteur *[^\w ] *(.*)", page.text, re.IGNORECASE)
+    result = re.search(r"Auteur *[^\w ] *(.*)", text_store.get_text(page), re.IGNORECASE)
 
     if result:
         # Now extract only the value from the result
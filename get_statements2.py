@@ -5,9 +5,24 @@ import sys
 sys.path.append(os.environ['PYWIKIBOT_DIR'])
 
 import pywikibot
-import re
-
-def get_statement(wiki, title, key, pid, source=None, ret=False):
+import threading
+import infobox_index
+import label_cache
+import claim_index
+import claim_reader
+import result_sinks
+import parse_pool
+import resilience
+import text_store
+
+# Number of lookups resolved by each tier of search_text(): 'raw' found in
+# the wikitext, 'expanded' found after expansion, 'skipped' not found with
+# no sign of a template producing the value (not expanded), 'missed' not
+# found even after expansion
+tier_stats = {'raw': 0, 'expanded': 0, 'skipped': 0, 'missed': 0}
+_tier_lock = threading.Lock()
+
+def get_statement(wiki, title, key, pid, source=None, ret=False, pool=None):
     """
     Convenience function to access the two key functions that do the heavy work
 
@@ -17,11 +32,12 @@ def get_statement(wiki, title, key, pid, source=None, ret=False):
     @param pid: The property id
     @param source: likely location to find the fact (e.g: infobox or just entire text)
     @param ret: Return the result instead of printing to stdout
+    @param pool: parse_pool.ParsePool to parse the text in, None to parse it here
     """
     if source == 'infobox':
-        result = get_statement_from_infobox(wiki, title, key, pid, ret)
+        result = get_statement_from_infobox(wiki, title, key, pid, ret, pool)
     elif source == 'text':
-        result = get_statement_from_text(wiki, title, key, pid, ret)
+        result = get_statement_from_text(wiki, title, key, pid, ret, pool)
     else:
         result = None
 
@@ -30,7 +46,7 @@ def get_statement(wiki, title, key, pid, source=None, ret=False):
     else:
         return 0
 
-def get_statement_from_infobox(wiki, title, key, pid, ret=False):
+def get_statement_from_infobox(wiki, title, key, pid, ret=False, pool=None):
     """
     This searches an article and attempts to get where a certain
     statement is used. It also then checks the Item page in the
@@ -43,14 +59,26 @@ def get_statement_from_infobox(wiki, title, key, pid, ret=False):
     @param key: The key to search for (a simple string or subregex)
     @param pid: The property id
     @param ret: Return the result instead of printing
+    @param pool: parse_pool.ParsePool to parse the text in, None to parse it here
     """
     page = pywikibot.Page(wiki, title)
 
-    # Search the article text and look for the pattern ( key = value )
-    # This is the pattern used in most infoboxes of Wikipedia
-    # articles where there's a key-value pair of property and value. Both
-    # the key and the value are case-insensitive.
-    result = re.findall(r"%s *[=] *(.*)" % key, page.text, re.IGNORECASE)
+    # Look the key up in the template parameters of the page first. The
+    # index is built in one pass and cached per revision, so checking many
+    # properties of the same page doesn't rescan the text every time.
+    value = infobox_index.find_param(infobox_index.get_page_index(page, pool), key)
+
+    if value:
+        result = [value]
+    else:
+        # Search the article text and look for the pattern ( key = value )
+        # This is the pattern used in most infoboxes of Wikipedia
+        # articles where there's a key-value pair of property and value. Both
+        # the key and the value are case-insensitive.
+        if pool:
+            result = pool.run(parse_pool.scan_infobox_key, text_store.get_text(page), key)
+        else:
+            result = parse_pool.scan_infobox_key(text_store.get_text(page), key)
     count = len(result)
 
     if count:
@@ -74,14 +102,16 @@ def get_statement_from_infobox(wiki, title, key, pid, ret=False):
 
             return value
 
-        value = loop_through_result(result, count, key)
+        if not value:
+            value = loop_through_result(result, count, key)
 
         # Loop through the value again if we are still not done
         if type(value) == tuple:
             value = loop_through_result(value, len(value), key)
 
         if not value:
-            print('There was a problem. The statement cannot be found')
+            result_sinks.report('not_found', 'There was a problem. The statement cannot be found',
+                title=title, id=pid)
             return 0
 
         value = value.strip()
@@ -93,81 +123,244 @@ def get_statement_from_infobox(wiki, title, key, pid, ret=False):
         # from the the sorrounding template
         needs_extraction = "{{coord|" in value or "{{Coord|" in value
         if needs_extraction:
-            value = re.findall(r'-?\d+\.?\d*', value)
+            value = parse_pool.coord_digits(value)
 
         result = {}
         # First result from manual search
         if not ret:
-            print(f'Result: {prop} = {value}')
+            result_sinks.report('statement', f'Result: {prop} = {value}', title=title, id=pid, value=value)
         else:
             result['id'] = pid
             result['title'] = title
             result['value'] = value
             result['repo_value'] = None
 
-        item = page.data_item()
-        item_dict = item.get()
-
         # Check the repo in case the claim already exists
-        value2 = check_repo(page.data_item(), pid)
+        value2 = check_repo(get_item(page), pid)
 
         if not ret:
-            print(f'The {prop} from parsing the article is: {value}'
-                + f' and the  {prop} from the item page is: {value2}\n')
+            result_sinks.report('comparison', f'The {prop} from parsing the article is: {value}'
+                + f' and the  {prop} from the item page is: {value2}\n',
+                title=title, id=pid, value=value, repo_value=value2)
             return 1
         else:
             result['repo_value'] = value2
         return result
     else:
-        print('There was a problem. The statement cannot be found 0')
+        result_sinks.report('not_found', 'There was a problem. The statement cannot be found 0',
+            title=title, id=pid)
         return 0
 
-def get_statement_from_text(wiki, title, regex, pid, ret=False):
+def search_text(page, regexes, pool=None):
+    """
+    Search the text of a page for several regexes, cheapest tier first.
+
+    The texts are read through text_store. Every regex is first searched
+    in the raw wikitext. The page is only
+    expanded (one more request, and the costliest one) when a regex wasn't
+    found and the wikitext shows that a template may produce its value,
+    see parse_pool.produced_by_template(). The expanded text is then
+    searched for the regexes still missing. The outcome of every lookup is
+    counted in tier_stats.
+
+    @param page: pywikibot.Page
+    @param regexes: dictionary of {key: regex}
+    @param pool: parse_pool.ParsePool to scan the texts in, None to scan them here
+    @return dictionary of {key: value} of the regexes found, the value
+        being the last group of the match
+    """
+    run = pool.run if pool else lambda func, *args: func(*args)
+
+    found, missing = run(parse_pool.scan_wikitext, text_store.get_text(page), regexes)
+    expanded = {}
+    if missing:
+        page_source = text_store.get_expanded_text(page)
+        expanded = run(parse_pool.scan_text, page_source, {key: regexes[key] for key in missing})
+
+    with _tier_lock:
+        tier_stats['raw'] += len(found)
+        tier_stats['skipped'] += len(regexes) - len(found) - len(missing)
+        tier_stats['expanded'] += len(expanded)
+        tier_stats['missed'] += len(missing) - len(expanded)
+
+    found.update(expanded)
+    return found
+
+def report_tiers():
     """
-    Variant of get_statement_from_infobox() which uses the expanded page
-    text. Slower, but can find facts hidden in template and other wikitext
-    nesting logic.
+    Print how many lookups each tier of search_text() resolved
+
+    @return tier_stats
+    """
+    total = sum(tier_stats.values())
+    if total:
+        print('Text lookups: %s found in wikitext, %s after expansion, %s not found '
+            'without expanding, %s not found after expanding (%s%% expanded)'
+            % (tier_stats['raw'], tier_stats['expanded'], tier_stats['skipped'],
+            tier_stats['missed'], round(100 * (tier_stats['expanded'] + tier_stats['missed']) / total)))
+
+    return tier_stats
+
+def get_statement_from_text(wiki, title, regex, pid, ret=False, pool=None):
+    """
+    Variant of get_statement_from_infobox() which searches the whole page
+    text. The raw wikitext is searched first and the page is only expanded
+    when a template may produce the value (see search_text()), which can
+    find facts hidden in template and other wikitext nesting logic.
     Parameters same as get_statement_from_infobox()
     """
     page = pywikibot.Page(wiki, title)
 
-    if page.isRedirectPage():
-        page = page.getRedirectTarget()
-
-    page_source = page.expand_text(True)
+    if resilience.call(wiki.hostname(), page.isRedirectPage):
+        page = resilience.call(wiki.hostname(), page.getRedirectTarget)
 
-    result = re.search(r'%s' % regex, page_source, re.I)
+    result = search_text(page, {pid: regex}, pool).get(pid)
     value = {'repo_value' : None}
 
-    repo_check = check_repo(page.data_item(), pid)
+    repo_check = check_repo(get_item(page), pid)
     if repo_check:
         value['repo_value'] = repo_check
 
     if result:
-        val = result.group(len(result.groups()))
+        val = result
         if ret:
             value['id'] = pid
             value['title'] = title
             value['value'] = val
             return value
         else:
-            print('Found: %s' % val)
+            result_sinks.report('statement', 'Found: %s' % val, title=title, id=pid,
+                value=val, repo_value=value['repo_value'])
             return 1
 
-    if not ret: print('No result was found')
+    if not ret: result_sinks.report('not_found', 'No result was found', title=title, id=pid)
     return None
 
-def check_repo(item, p_id):
+def get_statements_from_text(wiki, title, regexes, pool=None, check=True):
+    """
+    Variant of get_statement_from_text() that looks for several properties
+    at once. The page is fetched (and expanded, if needed) only once and
+    every regex is applied to that single copy of the text, so adding a
+    property costs no extra request per page.
+
+    @param wiki: Wiki site pywikibot.Site
+    @param title: The article title
+    @param regexes: dictionary of {property id: regex}
+    @param pool: parse_pool.ParsePool to scan the texts in, None to scan them here
+    @param check: Read the repo values now. If False, the results have
+        the 'item' of the page instead, to check the results of many
+        pages at once with check_repo_results()
+    @return dictionary of {property id: result} for every property whose
+        value was found in the article. Each result has the same keys as
+        the one returned by get_statement_from_text()
+    """
+    page = pywikibot.Page(wiki, title)
+
+    if resilience.call(wiki.hostname(), page.isRedirectPage):
+        page = resilience.call(wiki.hostname(), page.getRedirectTarget)
+
+    item = get_item(page)
+    matches = search_text(page, regexes, pool)
+    if not check:
+        return {pid: {'id': pid, 'title': title, 'value': value, 'repo_value': None, 'item': item}
+            for pid, value in matches.items()}
+
+    # The claims of all the properties found, in one request
+    claims = claim_reader.get_item_claims(item, list(matches)) if matches else {}
+
+    found = {}
+    for pid, value in matches.items():
+        found[pid] = {
+            'id': pid,
+            'title': title,
+            'value': value,
+            'repo_value': check_repo(item, pid, claims=claims.get(pid, []))
+        }
+
+    return found
+
+def check_repo_results(results, lang='en'):
+    """
+    Fill the 'repo_value' of the results of many pages returned by
+    get_statements_from_text() with check=False, with check_repo_batch()
+    for each property. Their 'item' is removed.
+
+    @param results: iterable of results
+    @param lang: language of the labels of item-valued targets
+    """
+    by_property = {}
+    for result in results:
+        by_property.setdefault(result['id'], []).append(result)
+
+    for p_id, group in by_property.items():
+        values = check_repo_batch([result['item'] for result in group], p_id, lang)
+        for result in group:
+            result['repo_value'] = values.get(result.pop('item').getID())
+
+def get_item(page):
+    """
+    Return the item of a page without downloading the entity, unlike
+    page.data_item(): its id comes with the text of the page (see
+    text_store.get_item_id()) and check_repo() then reads only the
+    claims it needs.
+
+    @param page: pywikibot.Page
+    @return pywikibot.ItemPage, not loaded
+    @raises pywikibot.NoPage if the page has no item, like page.data_item()
+    """
+    qid = text_store.get_item_id(page)
+    if not qid:
+        raise pywikibot.NoPage(page)
+    return pywikibot.ItemPage(page.site.data_repository(), qid)
+
+def check_repo_batch(items, p_id, lang='en'):
+    """
+    Variant of check_repo() for many items. The claims of the property
+    and then the labels of all the item-valued targets of the batch are
+    fetched together in batched requests before the values are read.
+
+    @param items: list of pywikibot.ItemPage
+    @param p_id: the property id
+    @param lang: language of the labels of item-valued targets
+    @return dictionary of {qid: value} for every item
+    """
+    if not items:
+        return {}
+
+    claims = claim_reader.get_claims(items[0].repo, items, [p_id])
+
+    targets = []
+    for item_claims in claims.values():
+        for claim in item_claims.get(p_id, []):
+            claim_target = claim.getTarget()
+            if isinstance(claim_target, pywikibot.ItemPage):
+                targets.append(claim_target.getID())
+
+    if targets:
+        label_cache.get_labels(items[0].repo, targets, (lang,))
+
+    return {item.getID(): check_repo(item, p_id, lang, claims.get(item.getID(), {}).get(p_id, []))
+        for item in items}
+
+def check_repo(item, p_id, lang='en', claims=None):
     """
     Checks the repo to find whether a particular claim already exists
     on the target item.
     @param item, the item
     @param p_id: the property id
+    @param lang: language of the label used when the value is an item
+    @param claims: the claims of the property if already fetched; if None
+        only the claims of the property are read (not the whole item)
     """
-    item_dict = item.get()
+    if claims is None:
+        claims = claim_reader.get_item_claims(item, [p_id]).get(p_id, [])
     value = None
 
-    for claim in item_dict['claims'].get(p_id, None) or {}:
+    # Remember what the repo already has, so that writing
+    # the same claim again can be avoided locally
+    claim_index.record_claims(item.getID(), p_id, claims)
+
+    for claim in claims:
         claim_target = claim.getTarget()
         if isinstance(claim_target, pywikibot.WbQuantity):
            value = claim_target.amount
@@ -178,8 +371,9 @@ def check_repo(item, p_id):
         elif isinstance(claim_target, pywikibot.FilePage):
             value = claim_target.title()
         elif isinstance(claim_target, pywikibot.ItemPage):
-            claim_dict = claim_target.get()
-            value = claim_dict['labels']['en']
+            # Only the label is needed, not the whole target entity
+            qid = claim_target.getID()
+            value = label_cache.get_label(claim.repo, qid, lang) or qid
         else:
             value = claim_target
 
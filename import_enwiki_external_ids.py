@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import itertools
+sys.path.append(os.environ['PYWIKIBOT_DIR'])
+
+import pywikibot
+import get_statements2
+import base_import_script
+import result_sinks
+import sharding
+import resilience
+import parse_pool
+import text_store
+
+from concurrent.futures import ThreadPoolExecutor
+from result_store import ResultStore
+
+# Each rule is a list in the format:
+# p_id - id of the external identifier property in the repo
+# name - display name of the identifier (used in messages and edit summaries)
+# regex - regex to extract the identifier from the expanded article text;
+#   the identifier is the last group of the match
+# category - maintenance category listing pages with the id missing in the repo
+EXTERNAL_ID_RULES = [
+    ['P1874', 'Netflix', r'(https?:\/\/www\.netflix\.com\/(title|watch))\/(\d{6,8})',
+        'Netflix title ID not in Wikidata'],
+    ['P3040', 'SoundCloud', r'(https?:\/\/(wwww\.)?soundcloud\.com\/(\w*))',
+        'SoundCloud ID not in Wikidata'],
+]
+
+def get_rule(p_id):
+    """
+    Return the rule of EXTERNAL_ID_RULES for a property
+
+    @param p_id: The property ID
+    @return list [p_id, name, regex, category] or None
+    """
+    for rule in EXTERNAL_ID_RULES:
+        if rule[0] == p_id:
+            return rule
+
+    return None
+
+def import_external_ids(p_ids=None, no_item_file='External_id_no_data_item.txt', batch_size=20,
+        shard=None, store_path=None, depth=0, workers=1, parse_processes=0, run_id=None):
+    """
+    Import external identifiers from English Wikipedia to the Wikidata
+    and add them to the respective data pages of the pages.
+
+    Pages of the source categories of all the selected rules are visited
+    once each, and every selected identifier is extracted from that one
+    copy of the page text.
+
+    @param p_ids: List of property IDs to import, all rules if None
+    @param no_item_file: Name of file to record pages without data item
+    @param batch_size: Stop once this many IDs are found for every property,
+        None to go through all the pages
+    @param shard: (index, count) to only process the pages of one shard,
+        see sharding.select()
+    @param store_path: path of the store shared by the shards
+    @param run_id: id of the run the shards claim pages for
+    @param depth: Also go through the subcategories of the source
+        categories down to this depth
+    @param workers: Number of threads fetching the pages
+    @param parse_processes: Number of processes scanning the page texts,
+        0 to scan them in the fetching threads, see parse_pool.ParsePool
+    @return dictionary of {property id: result of add_claims_to_item()}
+    """
+    rules = [r for r in EXTERNAL_ID_RULES if p_ids is None or r[0] in p_ids]
+    regexes = {p_id: regex for p_id, name, regex, category in rules}
+    wiki = pywikibot.Site('en', 'wikipedia')
+    repo = wiki.data_repository()
+
+    # A page may be listed in more than one source category,
+    # keep it only once so that it's fetched only once. Only the titles
+    # are kept (in order, as dictionary keys): the Page objects are made
+    # a chunk at a time when fetching the texts and again when adding the
+    # claims, so that large runs don't hold every Page in memory
+    pages = {}
+    for category in {r[3] for r in rules}:
+        if depth:
+            count = len(pages)
+            for page in base_import_script.walk_category(wiki, category, depth):
+                pages.setdefault(page.title())
+            print('Found %s new pages in the tree of "%s".' % (len(pages) - count, category))
+            continue
+
+        data = base_import_script.get_all_pages(wiki, category, generate=True)
+        print('Found %s pages in "%s".' % (data['count'], data['title']))
+        for page in data['pages']:
+            pages.setdefault(page.title())
+
+    all_ids = {p_id: ResultStore() for p_id in regexes}
+    no_data_item = []
+
+    print('Beginning iterating through %s pages.' % len(pages))
+
+    if shard:
+        no_item_file = '%s.%s' % (no_item_file, shard[0])
+
+    # The fetching threads hand the texts to the parse processes, if any,
+    # so that scanning them doesn't hold the GIL of the fetching process
+    pool = parse_pool.ParsePool(parse_processes) if parse_processes else None
+
+    def fetch(title):
+        try:
+            # Each request is retried under the budget of its own host. The
+            # repo values are read for the whole chunk at once below
+            found = get_statements2.get_statements_from_text(wiki, title, regexes, pool, check=False)
+        except Exception as e:
+            return title, None, e
+        return title, found, None
+
+    def requeue(title, error):
+        if not resilience.should_requeue(error):
+            raise error
+        if titles.retry(title, error):
+            result_sinks.report('requeued', 'Processing %s failed (%s), it will be tried again later'
+                % (title, str(error)), title=title, error=str(error))
+        else:
+            result_sinks.report('error', 'Error: Giving up on %s: %s' % (title, str(error)),
+                title=title, error=str(error))
+
+    # Pages that fail on a timeout or a server error are tried again later
+    titles = resilience.RetryQueue(sharding.select(pages, shard, store_path, key=lambda title: title,
+        run_id=run_id))
+    # Pages claimed but not processed, given back to the shards at the end
+    unprocessed = []
+    done = False
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            while not done:
+                # A new iterator every time, so that the pages requeued
+                # by the previous chunk are taken as well
+                chunk = list(itertools.islice(iter(titles), workers * 4))
+                if not chunk:
+                    break
+
+                # Check and download the texts of the chunk in batches,
+                # the pages that fail are fetched again one by one
+                try:
+                    text_store.prefetch(wiki, chunk)
+                except Exception as e:
+                    if not resilience.should_requeue(e):
+                        raise
+
+                fetched = []
+                for title, found, error in executor.map(fetch, chunk):
+                    if isinstance(error, pywikibot.NoPage):
+                        result_sinks.report('no_item', 'Note: %s has no entity page' % title, title=title)
+                        no_data_item.append(title)
+                    elif error:
+                        requeue(title, error)
+                    else:
+                        fetched.append((title, found))
+
+                # The claims of the items of the whole chunk, one batch of
+                # requests per property instead of one request per page
+                try:
+                    get_statements2.check_repo_results([res for title, found in fetched for res in found.values()])
+                except Exception as e:
+                    for title, found in fetched:
+                        requeue(title, e)
+                    continue
+
+                for position, (title, found) in enumerate(fetched):
+                    for p_id, res in found.items():
+                        # Skip if it already exists on the repo
+                        if res['repo_value'] or (batch_size and len(all_ids[p_id]) >= batch_size):
+                            continue
+                        all_ids[p_id].append(res)
+                        result_sinks.report('statement', **res)
+
+                    if batch_size and all(len(ids) >= batch_size for ids in all_ids.values()):
+                        print('Found %s IDs of each property to use for batch run.' % batch_size)
+                        unprocessed += [title for title, found in fetched[position + 1:]]
+                        done = True
+                        break
+    finally:
+        if pool:
+            pool.close()
+
+    unprocessed += [item for due, count, item in titles.delayed]
+    unprocessed += [title for title, error in titles.given_up]
+    sharding.release(unprocessed, shard, store_path, run_id)
+
+    # Record pages with no data page (if any)
+    base_import_script.record_pages_without_items(no_data_item, no_item_file)
+
+    if titles.given_up:
+        print('%s pages were given up after %s attempts' % (len(titles.given_up), titles.max_attempts))
+    resilience.report()
+    text_store.report()
+
+    results = {}
+    for p_id, name, regex, category in rules:
+        print('Found %s potential %s ids to add' % (len(all_ids[p_id]), name))
+
+        summary = u'Importing %s id from English Wikipedia' % name
+        items = ([r.value, r.title] for r in all_ids[p_id])
+        result = base_import_script.add_claims_to_item(repo, items, p_id, summary)
+        all_ids[p_id].close()
+
+        print('Finished! Added %s %s ids' % (result['added'], name))
+
+        if result['skipped']:
+            print('%s ids were skipped because there was error during processing' % result['skipped'])
+
+        results[p_id] = result
+
+    get_statements2.report_tiers()
+
+    return results
+
+def get_ids(wiki, titles, p_id):
+    """
+    Extract the identifier of a property from many articles and read the
+    identifiers of their items in the repo. The texts are fetched in
+    batches (see text_store.prefetch()) and the claims of all the items
+    are read together, see get_statements2.check_repo_results().
+
+    @param wiki: pywikibot.Site
+    @param titles: list of article titles
+    @param p_id: The property ID
+    @return dictionary of {title: result of get_statement_from_text() or None}
+    """
+    regexes = {p_id: get_rule(p_id)[2]}
+    text_store.prefetch(wiki, titles)
+    found = {title: get_statements2.get_statements_from_text(wiki, title, regexes, check=False).get(p_id)
+        for title in titles}
+    get_statements2.check_repo_results([result for result in found.values() if result])
+
+    return found
+
+def import_page_ids(wiki, title, p_ids=None):
+    """
+    Import the external identifiers of a single page, e.g. right after
+    the page was edited.
+
+    @param wiki: pywikibot.Site
+    @param title: string title of the article
+    @param p_ids: List of property IDs to import, all rules if None
+    @return number of claims added
+    """
+    rules = [r for r in EXTERNAL_ID_RULES if p_ids is None or r[0] in p_ids]
+    regexes = {p_id: regex for p_id, name, regex, category in rules}
+    found = get_statements2.get_statements_from_text(wiki, title, regexes)
+
+    repo = wiki.data_repository()
+    added = 0
+    for p_id, name, regex, category in rules:
+        res = found.get(p_id)
+        if not res or res['repo_value']:
+            continue
+
+        summary = u'Importing %s id from English Wikipedia' % name
+        result = base_import_script.add_claims_to_item(repo, [[res['value'], title]], p_id, summary)
+        added += result['added']
+
+    return added
+
+if __name__ == '__main__':
+    import_external_ids()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Single pass index of the template parameters of an article.
+
+parse_templates() walks the wikitext once and returns every template of
+the page with its parameters as a normalized {template: {param: value}}
+dictionary. The index of a page is cached per revision by
+get_page_index(), so looking up many infobox properties of the same
+page costs one parse instead of one full text scan per property.
+"""
+import re
+import threading
+import pattern_registry
+import text_store
+
+from collections import OrderedDict
+
+# Number of page indexes kept in memory
+INDEX_CACHE_SIZE = 1000
+
+_index_cache = OrderedDict()
+_lock = threading.Lock()
+
+_TOKENS = re.compile(r'\{\{|\}\}|\[\[|\]\]|\||<!--.*?-->|<nowiki>.*?</nowiki>', re.S)
+_COMMENT = re.compile(r'<!--.*?-->', re.S)
+_SPACES = re.compile(r'\s+')
+
+def normalize_name(name, template=False):
+    """
+    Normalize a template or parameter name: strip comments and the
+    namespace prefix, use spaces for underscores in template names and
+    ignore case and repeated whitespace. Underscores are kept in parameter
+    names, the wiki doesn't take them for spaces there.
+
+    @param name: raw name as found in the wikitext
+    @param template: The name is a template name ({{Infobox_film}} is
+        {{Infobox film}})
+    @return string normalized name
+    """
+    if template:
+        name = name.replace('_', ' ')
+    name = _SPACES.sub(' ', _COMMENT.sub('', name)).strip().lower()
+    if name.startswith('template:'):
+        name = name[len('template:'):].strip()
+    return name
+
+def parse_templates(text):
+    """
+    Tokenize the wikitext in one pass and build the index of all its
+    templates. Pipes inside links and nested templates are not taken as
+    parameter separators. Unnamed parameters are indexed by position
+    ('1', '2', ...). When a template is used more than once on the page,
+    parameters from the first use win.
+
+    @param text: wikitext of the page
+    @return dictionary of {template name: {param name: value}}, in the
+        order in which the templates start in the text
+    """
+    templates = []
+    # Each frame is [kind, start of the current part, list of parts, start]
+    stack = []
+
+    for token in _TOKENS.finditer(text):
+        tok = token.group()
+        if tok == '{{':
+            stack.append(['t', token.end(), [], token.start()])
+        elif tok == '[[':
+            stack.append(['l', token.end(), [], token.start()])
+        elif tok == '|':
+            if stack and stack[-1][0] == 't':
+                frame = stack[-1]
+                frame[2].append(text[frame[1]:token.start()])
+                frame[1] = token.end()
+        elif tok == ']]':
+            if stack and stack[-1][0] == 'l':
+                stack.pop()
+        elif tok == '}}':
+            # Drop unclosed links, they can't span a template boundary
+            while stack and stack[-1][0] == 'l':
+                stack.pop()
+            if not stack:
+                continue
+            kind, part_start, parts, start = stack.pop()
+            parts.append(text[part_start:token.start()])
+            templates.append((start, parts))
+
+    index = {}
+    for start, parts in sorted(templates, key=lambda t: t[0]):
+        name = normalize_name(parts[0].partition(':')[2] if parts[0].lstrip().startswith('#') else parts[0], True)
+        params = index.setdefault(name, {})
+        position = 0
+        for part in parts[1:]:
+            key, sep, value = part.partition('=')
+            if not sep:
+                position += 1
+                key, value = str(position), part
+            key = normalize_name(key)
+            if key not in params:
+                params[key] = _COMMENT.sub('', value).strip()
+
+    return index
+
+def find_param(index, key):
+    """
+    Find the value of the first template parameter matching a key.
+    Infobox templates are searched before any other template.
+
+    @param index: dictionary returned by parse_templates()
+    @param key: parameter name (a simple string or subregex); like in
+        the full text search, it has to match at the end of the name
+    @return string value or None
+    """
+    names = sorted(index, key=lambda name: not name.startswith('infobox'))
+
+    # Plain names are a dictionary hit
+    plain = key.lower()
+    if re.escape(plain) == plain.replace(' ', '\\ '):
+        for name in names:
+            value = index[name].get(plain)
+            if value:
+                return value
+
+    pattern = pattern_registry.compile_pattern(r'(?:%s) *$' % key, re.I)
+    for name in names:
+        for param, value in index[name].items():
+            if value and pattern.search(' ' + param):
+                return value
+
+    return None
+
+def get_page_index(page, pool=None):
+    """
+    Return the template index of a page, parsing its text only once
+    per revision.
+
+    @param page: pywikibot.Page
+    @param pool: parse_pool.ParsePool to parse the text in, None to parse it here
+    @return dictionary returned by parse_templates()
+    """
+    revid, text = text_store.get_revision(page)
+    key = (page.site.dbName(), page.title(), revid)
+
+    with _lock:
+        if key in _index_cache:
+            _index_cache.move_to_end(key)
+            return _index_cache[key]
+
+    # Parsed without the lock, the other threads keep using the cache
+    index = pool.run(parse_templates, text) if pool else parse_templates(text)
+    with _lock:
+        _index_cache[key] = index
+        if len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+
+    return index
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Persistent cache of entity labels.
+
+Reading the label of a claim target with ItemPage.get() downloads the
+whole entity. get_labels() asks the repo for the labels only, in the
+requested languages and for up to BATCH_SIZE entities per request, and
+keeps them in a local SQLite file because the same targets (countries,
+languages, occupations...) come up again and again.
+"""
+import sqlite3
+import threading
+import time
+
+import resilience
+
+LABEL_CACHE_FILE = 'label_cache.sqlite'
+# Labels older than this (in seconds) are fetched again
+LABEL_MAX_AGE = 7 * 24 * 3600
+# Maximum number of ids accepted by wbgetentities per request
+BATCH_SIZE = 50
+
+_connections = {}
+_lock = threading.Lock()
+
+def _connect(cache_file):
+    """Return the shared connection to the cache file, creating the table if needed"""
+    if cache_file not in _connections:
+        conn = sqlite3.connect(cache_file, check_same_thread=False)
+        conn.execute('CREATE TABLE IF NOT EXISTS labels (qid TEXT, lang TEXT, label TEXT, '
+            'fetched REAL, PRIMARY KEY (qid, lang))')
+        _connections[cache_file] = conn
+    return _connections[cache_file]
+
+def get_labels(repo, qids, langs=('en',), cache_file=LABEL_CACHE_FILE):
+    """
+    Get the labels of many entities, from the cache when possible and
+    with batched wbgetentities requests otherwise.
+
+    @param repo: DataSite object
+    @param qids: iterable of entity ids
+    @param langs: language codes of the labels to get
+    @param cache_file: path of the SQLite cache file
+    @return dictionary of {qid: {lang: label or None}}
+    """
+    qids = list(dict.fromkeys(qids))
+    labels = {qid: {} for qid in qids}
+    min_fetched = time.time() - LABEL_MAX_AGE
+
+    with _lock:
+        conn = _connect(cache_file)
+        for i in range(0, len(qids), 500):
+            chunk = qids[i:i + 500]
+            rows = conn.execute('SELECT qid, lang, label FROM labels WHERE fetched > ? AND qid IN (%s)'
+                % ','.join('?' * len(chunk)), [min_fetched, *chunk])
+            for qid, lang, label in rows:
+                if lang in langs:
+                    labels[qid][lang] = label
+
+    missing = [qid for qid in qids if any(lang not in labels[qid] for lang in langs)]
+
+    for i in range(0, len(missing), BATCH_SIZE):
+        batch = missing[i:i + BATCH_SIZE]
+        data = resilience.call(repo.hostname(), repo.simple_request(action='wbgetentities',
+            ids='|'.join(batch), props='labels', languages='|'.join(langs)).submit)
+
+        rows = []
+        for key, entity in data.get('entities', {}).items():
+            # Redirected ids are returned under the id of the target
+            qid = entity.get('redirects', {}).get('from', key)
+            for lang in langs:
+                label = entity.get('labels', {}).get(lang, {}).get('value')
+                labels.setdefault(qid, {})[lang] = label
+                rows.append((qid, lang, label, time.time()))
+
+        with _lock:
+            conn = _connect(cache_file)
+            conn.executemany('INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?)', rows)
+            conn.commit()
+
+    return labels
+
+def get_label(repo, qid, lang='en', cache_file=LABEL_CACHE_FILE):
+    """
+    Get the label of a single entity. See get_labels()
+
+    @return string label or None if the entity has no label in lang
+    """
+    return get_labels(repo, [qid], (lang,), cache_file)[qid].get(lang)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Offline index of the labels and aliases of Wikidata items.
+
+build_index() reads a Wikidata JSON dump once and keeps, for every
+requested language, the normalized labels and aliases of the items in a
+local SQLite file, with whether each item already has a sitelink to the
+Wikipedia of that language. lookup() then resolves thousands of titles
+per second without any request:
+
+    python cli.py build-label-index latest-all.json.gz --langs en fr ar
+    python cli.py search-qids --label-index label_index.sqlite
+
+Items already linked to an article of the wiki are left out of the
+candidates of its unconnected pages, since they can't be their item.
+"""
+import bz2
+import gzip
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+LABEL_INDEX_FILE = 'label_index.sqlite'
+# Rows inserted per transaction while building the index
+BUILD_BATCH_SIZE = 50000
+# Titles looked up per query
+LOOKUP_BATCH_SIZE = 500
+
+_connections = {}
+_lock = threading.Lock()
+
+_SPACES = re.compile(r'[\s_]+')
+_DISAMBIGUATION = re.compile(r'\s*\(([^()]*)\)$')
+
+def normalize_label(label):
+    """
+    Reduce a label, an alias or a page title to the form kept in the
+    index: Unicode normalized, case folded, with underscores and repeated
+    whitespace taken as a single space.
+
+    @param label: string label
+    @return string normalized label
+    """
+    label = unicodedata.normalize('NFKC', label)
+    return _SPACES.sub(' ', label).strip().casefold()
+
+def split_disambiguation(title):
+    """
+    Split the disambiguation suffix of a title, 'Tatu (film)' -> ('Tatu', 'film')
+
+    @param title: page title
+    @return (title without the suffix, suffix or '')
+    """
+    match = _DISAMBIGUATION.search(title)
+    if not match or match.start() == 0:
+        return title, ''
+    return title[:match.start()], match.group(1)
+
+def _open_dump(path):
+    """Open a plain, .gz or .bz2 dump file for reading text"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    elif path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+def _entity_rows(entity, langs):
+    """Return the (lang, label, qid, linked) rows of an item of the dump"""
+    qid = entity['id']
+    sitelinks = entity.get('sitelinks', {})
+    rows = set()
+
+    for lang in langs:
+        linked = int('%swiki' % lang in sitelinks)
+        names = [entity.get('labels', {}).get(lang, {}).get('value')]
+        names += [alias.get('value') for alias in entity.get('aliases', {}).get(lang, [])]
+        for name in filter(None, names):
+            rows.add((lang, normalize_label(name), qid, linked))
+
+    return rows
+
+def build_index(dump_path, langs=('en',), index_file=LABEL_INDEX_FILE):
+    """
+    Build the index from a Wikidata JSON dump (one entity per line, as in
+    latest-all.json.gz). The dump is streamed, only one batch of rows is
+    held in memory. The index is rebuilt from scratch.
+
+    @param dump_path: path of the dump, optionally gzip or bzip2 compressed
+    @param langs: language codes of the labels and aliases to index
+    @param index_file: path of the SQLite index file
+    @return number of items indexed
+    """
+    conn = sqlite3.connect(index_file)
+    # The index can be rebuilt from the dump, don't pay for durability
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('DROP TABLE IF EXISTS labels')
+    conn.execute('CREATE TABLE labels (lang TEXT, label TEXT, qid TEXT, linked INTEGER)')
+
+    start = time.time()
+    items = 0
+    rows = []
+    with _open_dump(dump_path) as dump:
+        for line in dump:
+            line = line.strip().rstrip(',')
+            if not line.startswith('{'):
+                continue # opening and closing brackets of the array
+
+            entity = json.loads(line)
+            if entity.get('type') != 'item':
+                continue
+
+            rows.extend(_entity_rows(entity, langs))
+            items += 1
+            if len(rows) >= BUILD_BATCH_SIZE:
+                conn.executemany('INSERT INTO labels VALUES (?, ?, ?, ?)', rows)
+                conn.commit()
+                rows = []
+
+            if items % 1000000 == 0:
+                print('Indexed %s items...' % items)
+
+    conn.executemany('INSERT INTO labels VALUES (?, ?, ?, ?)', rows)
+    # Building the index once all the rows are in is much faster
+    conn.execute('CREATE INDEX labels_lookup ON labels (lang, label)')
+    conn.commit()
+    conn.close()
+
+    with _lock:
+        _connections.pop(index_file, None)
+
+    print('Indexed the %s labels of %s items in %.0f seconds'
+        % ('/'.join(langs), items, time.time() - start))
+    return items
+
+def _connect(index_file):
+    """Return the shared read connection to the index file"""
+    if index_file not in _connections:
+        _connections[index_file] = sqlite3.connect('file:%s?mode=ro' % index_file,
+            uri=True, check_same_thread=False)
+    return _connections[index_file]
+
+def lookup(titles, lang='en', index_file=LABEL_INDEX_FILE, unlinked=True, fallback=True):
+    """
+    Find the items whose label or alias is the title of each page. When
+    the full title matches nothing, the title without its disambiguation
+    suffix ('Tatu (film)' -> 'Tatu') is tried, if fallback is set.
+
+    @param titles: iterable of page titles
+    @param lang: language code of the labels (and of the wiki)
+    @param index_file: path of the SQLite index file
+    @param unlinked: Leave out the items that already have an article
+        in the Wikipedia of lang
+    @param fallback: Also try the title without its disambiguation suffix
+    @return dictionary of {title: sorted list of qids}
+    """
+    titles = list(dict.fromkeys(titles))
+    keys = {}
+    for title in titles:
+        full = normalize_label(title)
+        short = normalize_label(split_disambiguation(title)[0])
+        keys[title] = [full] if short == full or not fallback else [full, short]
+
+    labels = list({key for title_keys in keys.values() for key in title_keys})
+    matches = {}
+    with _lock:
+        conn = _connect(index_file)
+        for i in range(0, len(labels), LOOKUP_BATCH_SIZE):
+            chunk = labels[i:i + LOOKUP_BATCH_SIZE]
+            rows = conn.execute('SELECT label, qid, linked FROM labels WHERE lang = ? AND label IN (%s)'
+                % ','.join('?' * len(chunk)), [lang, *chunk])
+            for label, qid, linked in rows:
+                if not (unlinked and linked):
+                    matches.setdefault(label, set()).add(qid)
+
+    result = {}
+    for title in titles:
+        result[title] = []
+        for key in keys[title]:
+            if key in matches:
+                result[title] = sorted(matches[key])
+                break
+
+    return result
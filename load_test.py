@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Load test of the write path against a local stand-in of the Wikibase API.
+
+MockWikibase is a small threaded HTTP server answering the API modules
+used by the import scripts (wbcreateclaim, wbsetreference, wbeditentity
+and wbgetentities) with a configurable latency, and which refuses edits
+the way the real API does:
+
+- maxlag: every edit adds replication lag, which drains at one second
+  per second; requests sent with a maxlag lower than the current lag get
+  a 'maxlag' error and a Retry-After header,
+- rate limit: edits over the edit rate of the account get a 'ratelimited'
+  error.
+
+run_load_test() replays a synthetic import of N claims with each write
+strategy and reports the accepted edits and claims per second, the
+retries and the latency of every claim write (p50/p95/p99, retries
+included), so batch size, workers and pacing can be tuned offline:
+
+    python cli.py load-test --claims 2000 --workers 4 --rate 20
+"""
+import http.client
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode
+
+from rate_limit import RateLimiter
+
+# Write strategies:
+# claim+reference - what add_claims_to_item() does: create the claim, read
+#   the claims of the item and add the reference, three requests per claim
+# claim-with-reference - one wbeditentity per claim with its reference
+# item-batch - one wbeditentity per item with all its claims
+STRATEGIES = ['claim+reference', 'claim-with-reference', 'item-batch']
+
+# Maximum retries of a request refused for maxlag or rate limit
+MAX_RETRIES = 10
+
+class MockWikibase:
+    """Local stand-in of the Wikibase API, see the module documentation"""
+    def __init__(self, latency=0.02, lag_per_edit=0.05, edit_rate=50, seed=0):
+        """
+        @param latency: mean latency of a request in seconds; edits take
+            twice as long and a few requests are much slower
+        @param lag_per_edit: seconds of replication lag added by each edit
+        @param edit_rate: edits per second allowed before 'ratelimited'
+        @param seed: seed of the latency generator
+        """
+        self.latency = latency
+        self.lag_per_edit = lag_per_edit
+        self.limiter_rate = float(edit_rate)
+        self.tokens = float(edit_rate)
+        self.lag = 0.0
+        self.updated = time.monotonic()
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'edits': 0, 'maxlag': 0, 'ratelimited': 0}
+        self.claims = {}
+        self.server = None
+
+    def _update(self):
+        """Drain the lag and refill the edit tokens for the time elapsed"""
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        self.lag = max(0.0, self.lag - elapsed)
+        self.tokens = min(self.limiter_rate, self.tokens + elapsed * self.limiter_rate)
+
+    def _delay(self, edit):
+        """Latency of a request: mostly around the mean, with a long tail"""
+        with self.lock:
+            delay = self.rng.expovariate(1 / self.latency)
+            if self.rng.random() < 0.01:
+                delay *= 10
+        return delay * (2 if edit else 1)
+
+    def handle(self, params):
+        """
+        Answer one API request
+
+        @param params: dictionary of the request parameters
+        @return (status, headers, response dictionary)
+        """
+        action = params.get('action')
+        edit = action in ('wbcreateclaim', 'wbsetreference', 'wbeditentity')
+        time.sleep(self._delay(edit))
+
+        with self.lock:
+            self._update()
+            self.stats['requests'] += 1
+
+            maxlag = params.get('maxlag')
+            if maxlag is not None and self.lag > float(maxlag):
+                self.stats['maxlag'] += 1
+                return 200, {'Retry-After': '1'}, {'error': {'code': 'maxlag',
+                    'info': 'Waiting for a database server: %.1f seconds lagged.' % self.lag,
+                    'lag': self.lag}}
+
+            if edit:
+                if self.tokens < 1:
+                    self.stats['ratelimited'] += 1
+                    return 200, {}, {'error': {'code': 'ratelimited',
+                        'info': 'As an anti-abuse measure, you are limited from performing this action too many times'}}
+                self.tokens -= 1
+                self.lag += self.lag_per_edit
+                self.stats['edits'] += 1
+
+            if action == 'wbgetentities':
+                return 200, {}, {'entities': {qid: {'id': qid, 'lastrevid': 1,
+                    'claims': self.claims.get(qid, {})} for qid in params.get('ids', '').split('|')}}
+            elif action == 'wbcreateclaim':
+                self.claims.setdefault(params['entity'], {}).setdefault(params['property'], []).append(
+                    {'value': params.get('value')})
+                return 200, {}, {'success': 1, 'pageinfo': {'lastrevid': 1}}
+            elif action == 'wbsetreference':
+                return 200, {}, {'success': 1, 'pageinfo': {'lastrevid': 1}}
+            elif action == 'wbeditentity':
+                data = json.loads(params.get('data', '{}'))
+                for claim in data.get('claims', []):
+                    self.claims.setdefault(params['id'], {}).setdefault(claim['property'], []).append(claim)
+                return 200, {}, {'success': 1, 'entity': {'id': params['id'], 'lastrevid': 1}}
+
+            return 200, {}, {'error': {'code': 'badvalue', 'info': 'Unknown action: %s' % action}}
+
+    def start(self):
+        """Start serving on a free local port, in a background thread"""
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                status, headers, data = mock.handle(dict(parse_qsl(body)))
+                payload = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class Client:
+    """
+    Minimal API client of one worker: one keep-alive connection, maxlag
+    sent with every request and requests refused for maxlag or rate limit
+    retried after waiting, like pywikibot does.
+    """
+    def __init__(self, address, maxlag=5, limiter=None, retry_wait=1.0):
+        self.conn = http.client.HTTPConnection(*address)
+        self.maxlag = maxlag
+        self.limiter = limiter
+        self.retry_wait = retry_wait
+        self.retries = 0
+        self.failed = 0
+
+    def request(self, **params):
+        """
+        Send a request, retrying refused ones
+
+        @return response dictionary
+        """
+        params.update(format='json', maxlag=self.maxlag)
+        for attempt in range(MAX_RETRIES + 1):
+            if self.limiter:
+                self.limiter.wait()
+
+            self.conn.request('POST', '/w/api.php', urlencode(params),
+                {'Content-Type': 'application/x-www-form-urlencoded'})
+            response = self.conn.getresponse()
+            data = json.loads(response.read().decode('utf-8'))
+
+            code = data.get('error', {}).get('code')
+            if code not in ('maxlag', 'ratelimited'):
+                return data
+
+            self.retries += 1
+            wait = float(response.getheader('Retry-After') or self.retry_wait)
+            # Spread the retries of the workers
+            time.sleep(wait * (0.5 + random.random()))
+
+        self.failed += 1
+        return data
+
+def synthetic_import(claims, claims_per_item=1, seed=0):
+    """
+    Build a synthetic import: claims of external ids on items
+
+    @param claims: number of claims
+    @param claims_per_item: claims of each item (e.g. several properties
+        imported at once)
+    @return list of (qid, [(property, value), ...])
+    """
+    rng = random.Random(seed)
+    props = ['P1874', 'P3040', 'P345', 'P2002']
+    items = []
+    for i in range(0, claims, claims_per_item):
+        count = min(claims_per_item, claims - i)
+        items.append(('Q%s' % (1000 + i), [(props[j % len(props)], str(rng.randint(10 ** 6, 10 ** 8)))
+            for j in range(count)]))
+    return items
+
+def _claim_json(prop, value, reference=True):
+    """Return the JSON of an external id claim, with an 'imported from' reference"""
+    claim = {'type': 'statement', 'rank': 'normal', 'mainsnak': {'snaktype': 'value',
+        'property': prop, 'datavalue': {'type': 'string', 'value': value}}, 'property': prop}
+    if reference:
+        claim['references'] = [{'snaks': {'P143': [{'snaktype': 'value', 'property': 'P143',
+            'datavalue': {'type': 'wikibase-entityid', 'value': {'id': 'Q328'}}}]}}]
+    return claim
+
+def write_item(client, strategy, qid, claims):
+    """
+    Write the claims of one item with a strategy
+
+    @return (list of the latencies of the claim writes in seconds, number
+        of claims whose writes were all accepted)
+    """
+    latencies = []
+    if strategy == 'item-batch':
+        start = time.perf_counter()
+        data = client.request(action='wbeditentity', id=qid, summary='Load test',
+            data=json.dumps({'claims': [_claim_json(p, v) for p, v in claims]}))
+        latencies += [time.perf_counter() - start] * len(claims)
+        return latencies, 0 if 'error' in data else len(claims)
+
+    accepted = 0
+    for prop, value in claims:
+        start = time.perf_counter()
+        if strategy == 'claim-with-reference':
+            responses = [client.request(action='wbeditentity', id=qid, summary='Load test',
+                data=json.dumps({'claims': [_claim_json(prop, value)]}))]
+        else:
+            responses = [client.request(action='wbcreateclaim', entity=qid, property=prop, snaktype='value',
+                value=json.dumps(value), summary='Load test')]
+            # No reference can be added to a claim that wasn't created
+            if 'error' not in responses[0]:
+                responses.append(client.request(action='wbgetentities', ids=qid, props='info|claims'))
+                responses.append(client.request(action='wbsetreference', statement='%s$x' % qid,
+                    summary='Load test', snaks=json.dumps({'P143': [{'snaktype': 'value', 'property': 'P143',
+                    'datavalue': {'type': 'wikibase-entityid', 'value': {'id': 'Q328'}}}]})))
+        latencies.append(time.perf_counter() - start)
+        if not any('error' in data for data in responses):
+            accepted += 1
+
+    return latencies, accepted
+
+def percentile(values, p):
+    """Return the p-th percentile (0-100) of a list of numbers"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def run_strategy(strategy, items, workers=4, rate=None, latency=0.02, lag_per_edit=0.05,
+        edit_rate=50, maxlag=5):
+    """
+    Replay an import with one strategy against a fresh MockWikibase
+
+    @param strategy: one of STRATEGIES
+    @param items: list returned by synthetic_import()
+    @param workers: number of threads writing concurrently
+    @param rate: requests per second of all the workers (pacing), None for no pacing
+    @return dictionary of the results
+    """
+    mock = MockWikibase(latency, lag_per_edit, edit_rate)
+    address = mock.start()
+    limiter = RateLimiter(rate) if rate else None
+
+    work = list(items)
+    work_lock = threading.Lock()
+    latencies = []
+    accepted = [0]
+    clients = []
+
+    def worker():
+        client = Client(address, maxlag, limiter)
+        clients.append(client)
+        while True:
+            with work_lock:
+                if not work:
+                    return
+                qid, claims = work.pop()
+            item_latencies, item_accepted = write_item(client, strategy, qid, claims)
+            with work_lock:
+                latencies.extend(item_latencies)
+                accepted[0] += item_accepted
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    mock.stop()
+
+    return {
+        'strategy': strategy,
+        'claims': sum(len(claims) for qid, claims in items),
+        'seconds': elapsed,
+        'edits': mock.stats['edits'],
+        'edits_per_second': mock.stats['edits'] / elapsed,
+        # Only the claims whose writes were all accepted
+        'claims_per_second': accepted[0] / elapsed,
+        'requests': mock.stats['requests'],
+        'retries': sum(c.retries for c in clients),
+        'failed': sum(c.failed for c in clients),
+        'maxlag': mock.stats['maxlag'],
+        'ratelimited': mock.stats['ratelimited'],
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+    }
+
+def run_load_test(claims=500, claims_per_item=2, strategies=None, workers=4, rate=None,
+        latency=0.02, lag_per_edit=0.05, edit_rate=50, maxlag=5):
+    """
+    Replay a synthetic import with every strategy and print a report
+
+    @param claims: number of claims to import
+    @param claims_per_item: claims of each item
+    @param strategies: strategies to run, all of STRATEGIES if None
+    @param workers: number of threads writing concurrently
+    @param rate: requests per second of all the workers, None for no pacing
+    @param latency: mean latency of the mock API in seconds
+    @param lag_per_edit: seconds of replication lag added by each edit
+    @param edit_rate: edits per second allowed by the mock API
+    @param maxlag: maxlag sent with every request
+    @return list of the result dictionaries
+    """
+    items = synthetic_import(claims, claims_per_item)
+    results = []
+
+    print('%-22s %8s %9s %9s %8s %8s %7s %7s %7s' % ('strategy', 'edits', 'edits/s',
+        'claims/s', 'retries', 'failed', 'p50', 'p95', 'p99'))
+    for strategy in strategies or STRATEGIES:
+        result = run_strategy(strategy, items, workers, rate, latency, lag_per_edit, edit_rate, maxlag)
+        results.append(result)
+        print('%-22s %8d %9.1f %9.1f %8d %8d %6.3fs %6.3fs %6.3fs' % (strategy, result['edits'],
+            result['edits_per_second'], result['claims_per_second'], result['retries'],
+            result['failed'], result['p50'], result['p95'], result['p99']))
+
+    return results
@@ -5,7 +5,11 @@ import sys
 sys.path.append(os.environ['PYWIKIBOT_DIR'])
 
 import pywikibot
-from datetime import datetime
+import claim_index
+import claim_reader
+import parse_pool
+import result_sinks
+from collections import OrderedDict
 
 def print_outreachy_page(site, title):
     """This loads and prints the text of a page"""
@@ -51,38 +55,62 @@ def load_wikidata_item(site, item_id):
         print("There was a problem!")
         return 0
 
-def add_claim_to_item(repo, item, prop_id, value, summary):
+# Datatypes of properties, they never change
+_datatypes = {}
+# Datatypes handled by convert_value()
+DATATYPES = ('wikibase-item', 'commonsMedia', 'globe-coordinate', 'quantity', 'time', 'geo-shape',
+    'monolingualtext', 'tabular-data', 'url', 'math', 'external-id', 'musical-notation')
+_commons = None
+
+def get_datatype(repo, prop_id):
     """
-    This adds new claim to an Item and handles datatype conversion
-    based on the property where we are to add the claim.
+    Return the datatype of a property, asking the repo only once per property
 
     @param repo DataSite
-    @param item entity id where to do the work or pywikibot.ItemPage object
-    @param prop_id the propety id of the claim
-    @param value The claim to add
-    @param summary Edit summary
+    @param prop_id the propety id
+    """
+    if (repo, prop_id) not in _datatypes:
+        _datatypes[(repo, prop_id)] = pywikibot.PropertyPage(repo, prop_id).type
+    return _datatypes[(repo, prop_id)]
+
+def get_commons():
+    """Return the shared Wikimedia Commons site"""
+    global _commons
+    if _commons is None:
+        _commons = pywikibot.Site('commons', 'commons')
+    return _commons
+
+def parse_time(value, repo=None):
+    """
+    Convert a date culled from an article to WbTime with the precision
+    of the date (day, month or year)
+
+    @param value: string like '1 July 1952', 'July 1952' or '1952'
+    @param repo: DataSite
+    @raises ValueError if the date is not in one of these forms
+    """
+    precision, date = parse_pool.parse_date(value)
+    return pywikibot.WbTime(site=repo, precision=precision, **date)
+
+def convert_value(repo, datatype, value):
+    """
+    Convert a raw value to the type expected by claims of the datatype
+
+    @param repo DataSite
+    @param datatype datatype of the property
+    @param value the raw value
     @raises pywikibot.Error on unknown datatype
     """
-    datatype = pywikibot.PropertyPage(repo, prop_id).type
     if datatype == 'wikibase-item':
         value = pywikibot.ItemPage(repo, value)
     elif datatype == 'commonsMedia':
-        commons = pywikibot.Site('commons', 'commons')
-        value = pywikibot.FilePage(commons, value)
+        value = pywikibot.FilePage(get_commons(), value)
     elif datatype == 'globe-coordinate':
-        value = pywikibot.Coordinate(value[0], value[1])
+        value = pywikibot.Coordinate(float(value[0]), float(value[1]))
     elif datatype == 'quantity':
         value = pywikibot.WbQuantity(value, site=repo)
     elif datatype == 'time':
-        form = len(value.split())
-        if form == 3:
-            style = '%d %B %Y'
-        elif form == 2:
-            style = '%B %Y'
-        else:
-            style = '%Y'
-        dt = datetime.strptime(value, style).isoformat()
-        value = pywikibot.WbTime(dt)
+        value = parse_time(value, repo)
     elif datatype == 'geo-shape':
         value = pywikibot.WbGeoShape(value)
     elif datatype == 'monolingualtext':
@@ -98,6 +126,62 @@ def add_claim_to_item(repo, item, prop_id, value, summary):
     else:
         raise pywikibot.Error('Unknown datatype: %s' % datatype)
 
+    return value
+
+def convert_values(repo, prop_id, values, datatype=None):
+    """
+    Convert many raw values of a property at once. The datatype is looked
+    up once and values that repeat are converted only once.
+
+    @param repo DataSite
+    @param prop_id the propety id
+    @param values list of raw values
+    @param datatype datatype of the property, looked up if None
+    @return list of converted values, in the same order. Values that
+        cannot be converted are None
+    @raises pywikibot.Error on unknown datatype
+    """
+    datatype = datatype or get_datatype(repo, prop_id)
+    if datatype not in DATATYPES:
+        raise pywikibot.Error('Unknown datatype: %s' % datatype)
+
+    converted = {}
+    result = []
+    failed = 0
+
+    for value in values:
+        key = tuple(value) if isinstance(value, list) else value
+        if key not in converted:
+            try:
+                converted[key] = convert_value(repo, datatype, value)
+            except (ValueError, TypeError, ArithmeticError, pywikibot.Error):
+                # e.g. a date in an unknown form, an invalid file title or
+                # a quantity with a thousands separator (decimal.InvalidOperation)
+                converted[key] = None
+                failed += 1
+        result.append(converted[key])
+
+    if failed:
+        print('%s values of %s could not be converted to %s' % (failed, prop_id, datatype))
+
+    return result
+
+def add_claim_to_item(repo, item, prop_id, value, summary, convert=True):
+    """
+    This adds new claim to an Item and handles datatype conversion
+    based on the property where we are to add the claim.
+
+    @param repo DataSite
+    @param item entity id where to do the work or pywikibot.ItemPage object
+    @param prop_id the propety id of the claim
+    @param value The claim to add
+    @param summary Edit summary
+    @param convert False if the value was already converted, e.g. by convert_values()
+    @raises pywikibot.Error on unknown datatype
+    """
+    if convert:
+        value = convert_value(repo, get_datatype(repo, prop_id), value)
+
     claim = pywikibot.Claim(repo, prop_id)
     claim.setTarget(value)
 
@@ -105,10 +189,99 @@ def add_claim_to_item(repo, item, prop_id, value, summary):
         item = pywikibot.ItemPage(repo, item)
 
     item.addClaim(claim, summary=summary)
-    print('New claim saved!')
+    claim_index.record(item.getID(), prop_id, value)
+    result_sinks.report('claim_saved', 'New claim saved!', qid=item.getID(), id=prop_id)
     return 1
 
-def add_qualifier(repo, item_id, claim_id, prop_id, target):
+def select_claim(claims, selector=None):
+    """
+    Select one of the claims of a property
+
+    @param claims list of pywikibot.Claim (or None)
+    @param selector None for the first claim, else the GUID of the claim
+        (e.g. 'Q42$F078E5B3-F9A8-480E-B7AC-D97778CBBEF9') or its value
+    @return pywikibot.Claim or None if no claim matches
+    """
+    if not claims:
+        return None
+    if not selector:
+        return claims[0]
+
+    for claim in claims:
+        if claim.snak == selector:
+            return claim
+
+    selector = claim_index.normalize_value(selector)
+    for claim in claims:
+        if claim_index.normalize_value(claim.getTarget()) == selector:
+            return claim
+
+    return None
+
+def apply_claim_changes(repo, item_id, changes, summary=u'Adding qualifiers and references.'):
+    """
+    Add many qualifiers and references to the claims of an item in a
+    single edit. The claims of the item are loaded once (only those of
+    the properties changed), the qualifiers and references
+    are added to its claims locally and all the changed claims are saved
+    with one editEntity() call. Qualifiers and references the claim
+    already has are skipped.
+
+    @param repo DataSite
+    @param item_id entity id where to do the work
+    @param changes list of (claim property, claim selector, kind, property, target)
+        tuples, where the claim selector is as in select_claim(), kind is
+        'qualifier' or 'reference' and target is the converted value. The
+        references of the same claim are added together as one reference
+    @param summary Edit summary
+    @return dictionary with the number of 'added' and 'skipped' changes
+    """
+    item = pywikibot.ItemPage(repo, item_id)
+    claims = claim_reader.get_item_claims(item, list({change[0] for change in changes}))
+
+    changed = {}
+    references = {}
+    added = skipped = 0
+    for claim_prop, selector, kind, prop_id, target in changes:
+        claim = select_claim(claims.get(claim_prop), selector)
+        if claim is None:
+            result_sinks.report('skipped', 'Skipping %s of %s: no %s claim %s'
+                % (kind, item_id, claim_prop, selector or ''), qid=item_id, id=claim_prop, claim=selector)
+            skipped += 1
+            continue
+
+        snak = pywikibot.Claim(repo, prop_id, is_qualifier=kind == 'qualifier',
+            is_reference=kind == 'reference')
+        snak.setTarget(target)
+
+        if kind == 'qualifier':
+            existing = claim.qualifiers.get(prop_id, [])
+        else:
+            existing = [s for source in claim.sources for s in source.get(prop_id, [])]
+        value = claim_index.normalize_value(target)
+        if any(claim_index.normalize_value(s.getTarget()) == value for s in existing):
+            skipped += 1
+            continue
+
+        if kind == 'qualifier':
+            claim.qualifiers.setdefault(prop_id, []).append(snak)
+        else:
+            if id(claim) not in references:
+                references[id(claim)] = OrderedDict()
+                claim.sources.append(references[id(claim)])
+            references[id(claim)].setdefault(prop_id, []).append(snak)
+
+        changed[id(claim)] = claim
+        added += 1
+
+    if changed:
+        item.editEntity({'claims': [claim.toJSON() for claim in changed.values()]}, summary=summary)
+        result_sinks.report('claim_details_saved', 'Saved %s qualifiers and references of %s'
+            % (added, item_id), qid=item_id, added=added)
+
+    return {'added': added, 'skipped': skipped}
+
+def add_qualifier(repo, item_id, claim_id, prop_id, target, claim=None):
     """
     This adds new qualifier to an existing claim
     @param repo DataSite
@@ -116,10 +289,11 @@ def add_qualifier(repo, item_id, claim_id, prop_id, target):
     @param prop_id the propety id of the claim to add qualifier on
     @param claim_id the propety id of the claim (qualifier) to add
     @param target value of the claim
+    @param claim the claim to add the qualifier to, see select_claim()
     """
     item = pywikibot.ItemPage(repo, item_id)
-    claims = item.get()['claims']
-    claim = claims.get(claim_id)[0] or None
+    claims = claim_reader.get_item_claims(item, [claim_id])
+    claim = select_claim(claims.get(claim_id), claim)
 
     if not claim:
         return 0
@@ -132,7 +306,7 @@ def add_qualifier(repo, item_id, claim_id, prop_id, target):
     except ValueError:
        return 0
 
-def add_reference(repo, item_id, claim_id, ref_type, value):
+def add_reference(repo, item_id, claim_id, ref_type, value, claim=None):
     """
     This adds new qualifier to an existing claim
     @param repo: DataSite
@@ -141,10 +315,11 @@ def add_reference(repo, item_id, claim_id, ref_type, value):
     @param claim_id: the propety id of the claim (qualifier) to add
     @param ref_type: the ref form (reference URL, stated in, etc)
     @param value: value of the reference
+    @param claim: the claim to add the reference to, see select_claim()
     """
     item = pywikibot.ItemPage(repo, item_id)
-    claims = item.get()['claims']
-    claim = claims.get(claim_id)[0] or None
+    claims = claim_reader.get_item_claims(item, [claim_id])
+    claim = select_claim(claims.get(claim_id), claim)
 
     if not claim:
         return 0
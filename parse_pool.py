@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+CPU stage of the extraction: wikitext parsing in a process pool.
+
+Once the pages are fetched concurrently, scanning their text (rule
+regexes, template parsing) is CPU-bound and the threads of one process
+take turns on the GIL. ParsePool runs these scans in worker processes
+while the fetching stays on the threads: a thread hands a page text to
+the pool and waits for the result, releasing the GIL meanwhile, so the
+parsing scales with the number of cores.
+
+Texts larger than SHM_THRESHOLD are handed over in shared memory instead
+of being pickled through the pool's pipe (Python 3.8+, otherwise they are
+pickled like the others).
+
+The scan functions of this module don't need pywikibot, so they can run
+in the workers; they are also used directly when no pool is given.
+"""
+import re
+import calendar
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+import pattern_registry
+
+# Texts of at least this many bytes are handed over in shared memory
+SHM_THRESHOLD = 256 * 1024
+
+# Name of the site of a URL in a regex, e.g. netflix in 'www\.netflix\.com'
+_SITE_NAME = re.compile(r'(\w+)\\?\.(?:com|org|net|edu|gov|io|tv|fm)(?!\w)', re.I)
+_COMMENT = re.compile(r'<!--.*?-->', re.S)
+_COORD_DIGITS = re.compile(r'-?\d+\.?\d*')
+
+# Accepted dates: '1 July 1952', 'July 1952' and '1952'
+_MONTHS = {name.lower(): i for i, name in enumerate(calendar.month_name) if name}
+_MONTHS.update({name.lower(): i for i, name in enumerate(calendar.month_abbr) if name})
+_DATE_FORMATS = [
+    (re.compile(r'(\d{1,2}) ([A-Za-z]+) (\d{1,4})'), ('day', 'month', 'year')),
+    (re.compile(r'([A-Za-z]+) (\d{1,4})'), ('month', 'year')),
+    (re.compile(r'(\d{1,4})'), ('year',)),
+]
+
+def produced_by_template(text, regex):
+    """
+    Tell whether a value missing from the wikitext may be produced by a
+    template of the page, i.e. whether it's worth expanding the page.
+
+    For a regex matching the URL of a site, that's when the wikitext has
+    a template and mentions the site (e.g. {{Netflix title|...}} or
+    {{URL|netflix.com/...}}). For any other regex it can't be told, so it's
+    always assumed. Templates that read the value from the repo are not
+    looked for, they can only give back the value the repo already has.
+
+    @param text: wikitext of the page
+    @param regex: regex of the value
+    @return boolean
+    """
+    sites = _SITE_NAME.findall(regex)
+    if not sites:
+        return True
+
+    text = text.lower()
+    return '{{' in text and any(site.lower() in text for site in sites)
+
+def scan_text(text, regexes):
+    """
+    Search a text for several regexes
+
+    @param text: the text
+    @param regexes: dictionary of {key: regex}
+    @return dictionary of {key: value} of the regexes found, the value
+        being the last group of the match
+    """
+    found = {}
+    for key, regex in regexes.items():
+        result = pattern_registry.search(r'%s' % regex, text, re.I)
+        if result:
+            found[key] = result.group(len(result.groups()))
+    return found
+
+def scan_wikitext(text, regexes):
+    """
+    First tier of get_statements2.search_text(): search the raw wikitext
+    (without comments) and tell which missing values may be produced by a
+    template.
+
+    @param text: wikitext of the page
+    @param regexes: dictionary of {key: regex}
+    @return (dictionary of {key: value} of the regexes found,
+        list of the keys worth searching in the expanded text)
+    """
+    text = _COMMENT.sub('', text)
+    found = scan_text(text, regexes)
+    missing = [key for key, regex in regexes.items()
+        if key not in found and produced_by_template(text, regex)]
+    return found, missing
+
+def scan_infobox_key(text, key):
+    """
+    Search the wikitext for the ( key = value ) pattern used in most
+    infoboxes, see get_statements2.get_statement_from_infobox()
+
+    @return list of the matches
+    """
+    return pattern_registry.findall(r"%s *[=] *(.*)" % key, text, re.IGNORECASE)
+
+def coord_digits(value):
+    """
+    Extract the numbers of a {{coord}} template: '{{coord|51.76|-1.26}}' -> ['51.76', '-1.26']
+    """
+    return _COORD_DIGITS.findall(value)
+
+def parse_date(value):
+    """
+    Parse a date culled from an article: '1 July 1952', 'July 1952' or '1952'
+
+    @param value: the date
+    @raises ValueError if the date is not in one of these forms
+    @return (precision, dictionary of {'year', 'month', 'day': int}), the
+        precision being the most precise field given ('day', 'month' or 'year')
+    """
+    value = ' '.join(value.split())
+    for pattern, fields in _DATE_FORMATS:
+        match = pattern.fullmatch(value)
+        if not match:
+            continue
+
+        date = dict(zip(fields, match.groups()))
+        if 'month' in date:
+            month = _MONTHS.get(date['month'].lower())
+            if not month:
+                raise ValueError('Unknown month in date: %s' % value)
+            date['month'] = month
+
+        date = {k: int(v) for k, v in date.items()}
+        datetime(date['year'], date.get('month', 1), date.get('day', 1))
+        return fields[0], date
+
+    raise ValueError('Unknown date format: %s' % value)
+
+def strip_wikilinks(title):
+    """
+    Strip all internal and interwiki link formattings of a value
+    so that it can be searched as a local page. [[example]] -> example
+    """
+    match = re.search(r'\[\[(.*?)\]\]', title)
+    if match:
+        title = match.group(1)
+
+    match = re.search(r'..?:+(.*)', title)
+    if match:
+        title = match.group(1)
+
+    match = re.match(r'\{\{(.*)\|(.*)\}\}', title)
+    if match:
+          title = match.group(2)
+
+    return title
+
+def _load(handle):
+    """Return the text of a handle made by ParsePool._share()"""
+    if isinstance(handle, str):
+        return handle
+
+    name, size = handle
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size]).decode('utf-8')
+    finally:
+        shm.close()
+
+def _call(func, handle, args):
+    return func(_load(handle), *args)
+
+class ParsePool:
+    """
+    Pool of worker processes running the scan functions on page texts.
+    Its methods can be called from many threads at once.
+
+        with ParsePool() as pool:
+            found, missing = pool.run(scan_wikitext, text, regexes)
+    """
+    def __init__(self, processes=None, shm_threshold=SHM_THRESHOLD):
+        """
+        @param processes: number of worker processes, the number of cores if None
+        @param shm_threshold: texts of at least this many bytes are
+            handed over in shared memory
+        """
+        self.executor = ProcessPoolExecutor(processes)
+        self.shm_threshold = shm_threshold
+
+    def _share(self, text):
+        """Return the handle to send for a text, and its shared memory if any"""
+        if shared_memory is None or len(text) < self.shm_threshold // 4:
+            return text, None
+
+        data = text.encode('utf-8')
+        if len(data) < self.shm_threshold:
+            return text, None
+
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        shm.buf[:len(data)] = data
+        return (shm.name, len(data)), shm
+
+    def run(self, func, text, *args):
+        """
+        Run func(text, *args) in a worker process and wait for the result
+
+        @param func: a function of this module (or any picklable function
+            taking the text first)
+        @param text: the text
+        @return the result of func
+        """
+        handle, shm = self._share(text)
+        try:
+            return self.executor.submit(_call, func, handle, args).result()
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Registry of the regular expressions used to extract statements.
+
+Rule tables pass user supplied patterns straight to the regex engine,
+with re.I, over whole articles and expanded HTML, where one badly
+written pattern can backtrack for seconds. Every pattern goes through
+this registry, which:
+
+- compiles it once and keeps it,
+- lints it for the constructs known to backtrack catastrophically
+  and for common mistakes (alternation or groups written inside a
+  character class); patterns with nested unbounded repeats, which
+  backtrack exponentially, are rejected with a ValueError, the other
+  warnings are printed,
+- enforces a time budget per search with the timeout of the
+  third-party `regex` module (a required dependency, the re module
+  can't interrupt a search): the search is stopped once over the
+  budget, and patterns that go over the budget MAX_STRIKES times are
+  disabled for the rest of the run,
+- records the number of scans and the time spent by each pattern, see
+  report().
+"""
+import re
+import threading
+import time
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+import regex
+
+# Seconds a single search may take
+TIME_BUDGET = 1.0
+# Searches over the budget before a pattern is disabled
+MAX_STRIKES = 3
+
+# Lint warning of the patterns that are rejected
+CATASTROPHIC = 'nested unbounded repeat, can backtrack exponentially'
+
+_patterns = {}
+_stats = {}
+_lock = threading.Lock()
+
+_UNBOUNDED = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+
+def _walk(items, warnings, in_repeat=False):
+    """Look for nested and adjacent unbounded repeats in the parsed pattern"""
+    previous_unbounded = False
+    for op, av in items:
+        unbounded = op in _UNBOUNDED and av[1] == sre_parse.MAXREPEAT
+        if unbounded:
+            if in_repeat:
+                warnings.append(CATASTROPHIC)
+            if previous_unbounded:
+                warnings.append('adjacent unbounded repeats, can backtrack polynomially')
+            _walk(av[2], warnings, True)
+        elif op in _UNBOUNDED:
+            _walk(av[2], warnings, in_repeat)
+        elif op == sre_parse.SUBPATTERN:
+            _walk(av[-1], warnings, in_repeat)
+        elif op == sre_parse.BRANCH:
+            for branch in av[1]:
+                _walk(branch, warnings, in_repeat)
+
+        if op not in (sre_parse.AT,):
+            previous_unbounded = unbounded
+
+def lint(pattern):
+    """
+    Check a pattern for constructs that backtrack catastrophically
+    and for common mistakes
+
+    @param pattern: the pattern
+    @return list of warnings (strings), empty if none
+    """
+    warnings = []
+    try:
+        _walk(sre_parse.parse(pattern), warnings)
+    except re.error as e:
+        return ['invalid pattern: %s' % str(e)]
+
+    for char_class in re.findall(r'(?<!\\)\[((?:\\.|[^\]\\])*)\]', pattern):
+        if '|' in char_class:
+            warnings.append('"|" inside the character class [%s] matches a pipe, '
+                'use a group for alternatives' % char_class)
+        if '(' in char_class or ')' in char_class:
+            warnings.append('parentheses inside the character class [%s] match '
+                'parentheses, use a group' % char_class)
+
+    return list(dict.fromkeys(warnings))
+
+def compile_pattern(pattern, flags=re.I):
+    """
+    Return the compiled pattern, compiling and linting it on first use.
+    Lint warnings are printed once per pattern.
+
+    @param pattern: the pattern
+    @param flags: re flags
+    @raise ValueError: the pattern can backtrack catastrophically
+    """
+    key = (pattern, flags)
+    with _lock:
+        if key in _patterns:
+            return _patterns[key]
+
+    warnings = lint(pattern)
+    if CATASTROPHIC in warnings:
+        raise ValueError('Pattern %r rejected: %s' % (pattern, CATASTROPHIC))
+    for warning in warnings:
+        print('Warning: pattern %r: %s' % (pattern, warning))
+
+    compiled = regex.compile(pattern, flags)
+
+    with _lock:
+        _patterns[key] = compiled
+        _stats.setdefault(pattern, {'scans': 0, 'time': 0.0, 'max': 0.0,
+            'chars': 0, 'over_budget': 0, 'disabled': False, 'warnings': warnings})
+
+    return compiled
+
+def _scan(method, pattern, text, flags, default):
+    compiled = compile_pattern(pattern, flags)
+    stats = _stats[pattern]
+
+    if stats['disabled']:
+        return default
+
+    start = time.perf_counter()
+    try:
+        result = getattr(compiled, method)(text, timeout=TIME_BUDGET)
+    except TimeoutError:
+        result = default
+        print('Warning: pattern %r took more than %ss, the search was stopped' % (pattern, TIME_BUDGET))
+    elapsed = time.perf_counter() - start
+
+    with _lock:
+        stats['scans'] += 1
+        stats['time'] += elapsed
+        stats['chars'] += len(text)
+        stats['max'] = max(stats['max'], elapsed)
+        if elapsed > TIME_BUDGET:
+            stats['over_budget'] += 1
+            if stats['over_budget'] >= MAX_STRIKES:
+                stats['disabled'] = True
+                print('Warning: pattern %r went over the time budget %s times, disabling it'
+                    % (pattern, MAX_STRIKES))
+
+    return result
+
+def search(pattern, text, flags=re.I):
+    """
+    re.search() through the registry
+
+    @return match object or None (also when the search is over the budget)
+    """
+    return _scan('search', pattern, text, flags, None)
+
+def findall(pattern, text, flags=re.I):
+    """
+    re.findall() through the registry
+
+    @return list of matches, empty when the search is over the budget
+    """
+    return _scan('findall', pattern, text, flags, [])
+
+def lint_patterns(patterns=None):
+    """
+    Lint patterns and print their warnings
+
+    @param patterns: list of patterns, the regexes of
+        import_enwiki_external_ids.EXTERNAL_ID_RULES if None
+    @return True if no pattern has a warning
+    """
+    if not patterns:
+        import import_enwiki_external_ids
+        patterns = [rule[2] for rule in import_enwiki_external_ids.EXTERNAL_ID_RULES]
+
+    ok = True
+    for pattern in patterns:
+        warnings = lint(pattern)
+        status = 'FAIL' if CATASTROPHIC in warnings else 'WARN' if warnings else 'OK  '
+        print('%s %r' % (status, pattern))
+        for warning in warnings:
+            print('     - %s' % warning)
+        ok = ok and not warnings
+
+    return ok
+
+def report(top=10):
+    """
+    Print the patterns that cost the most scan time
+
+    @param top: number of patterns to print
+    @return list of (pattern, stats) sorted by total time
+    """
+    with _lock:
+        ranked = sorted(_stats.items(), key=lambda item: item[1]['time'], reverse=True)
+
+    if ranked:
+        print('%10s %8s %10s %10s  %s' % ('total (s)', 'scans', 'max (s)', 'MB/s', 'pattern'))
+    for pattern, stats in ranked[:top]:
+        speed = stats['chars'] / stats['time'] / 1e6 if stats['time'] else 0
+        print('%10.3f %8d %10.4f %10.1f  %r%s' % (stats['time'], stats['scans'], stats['max'],
+            speed, pattern, ' (disabled)' if stats['disabled'] else ''))
+
+    return ranked
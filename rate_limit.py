@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Request rate budget shared between threads.
+
+Scripts that talk to several sites at once create one RateLimiter and
+pass it to every worker, so that the total number of API requests per
+second stays within the budget however many workers are running.
+"""
+import threading
+import time
+
+class RateLimiter:
+    """
+    Token bucket limiter. Each call to wait() takes one token, blocking
+    until a token is available. Tokens refill at 'rate' per second up to
+    'burst' tokens.
+    """
+    def __init__(self, rate, burst=None):
+        """
+        @param rate: number of requests allowed per second
+        @param burst: maximum number of requests that can be made at once
+            after a quiet period; defaults to rate
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until a request can be made within the budget"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Shared resilience layer for the calls to the wikis and external sites.
+
+- call() runs a request, retrying transient failures (timeouts, dropped
+  connections, 429 and 5xx) with jittered exponential backoff,
+- every host has a retry budget, so retries can't multiply the load on
+  a host that is already struggling,
+- every host has a circuit breaker: after BREAKER_THRESHOLD failures in
+  a row the host is left alone for BREAKER_RESET seconds, calls fail at
+  once with CircuitOpenError, then one trial call decides whether to
+  close the circuit again,
+- RetryQueue iterates pages and takes back the ones that failed, to be
+  tried again later instead of being dropped.
+
+    queue = resilience.RetryQueue(titles)
+    for title in queue:
+        try:
+            result = resilience.call('en.wikipedia.org', fetch, title)
+        except Exception as e:
+            if not resilience.should_requeue(e):
+                raise
+            queue.retry(title, e)
+"""
+import heapq
+import itertools
+import random
+import socket
+import threading
+import time
+
+from urllib.parse import urlparse
+
+# Attempts of a call before giving up
+MAX_ATTEMPTS = 4
+# First and maximum delay of the backoff, in seconds
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+# Retries allowed per host: RETRY_RATIO of its calls plus RETRY_MIN per window
+RETRY_RATIO = 0.2
+RETRY_MIN = 10
+RETRY_WINDOW = 60.0
+# Failures in a row that open the circuit of a host, and seconds it stays open
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 30.0
+# Connect and read timeouts of the HTTP requests, in seconds
+TIMEOUT = (5, 30)
+
+# Names of the exception classes of requests, urllib3, aiohttp and pywikibot that
+# are worth retrying (matched by name so that none of them is imported)
+_TRANSIENT_NAMES = {'Timeout', 'ReadTimeout', 'ConnectTimeout', 'ConnectionError',
+    'ChunkedEncodingError', 'ProtocolError', 'ServerError', 'TimeoutError', 'MaxlagTimeoutError',
+    'URLError', 'ClientConnectionError', 'ClientPayloadError'}
+
+class CircuitOpenError(Exception):
+    """The circuit of the host is open, the call was not made"""
+
+class HTTPStatusError(Exception):
+    """An HTTP response with an error status worth retrying"""
+    def __init__(self, url, code):
+        super().__init__('HTTP %s for %s' % (code, url))
+        self.code = code
+
+def is_transient(error):
+    """
+    Tell whether a failed call is worth retrying: timeouts, dropped
+    connections and HTTP 429 and 5xx responses are, everything else
+    (e.g. 404, invalid data) is not.
+
+    @param error: the exception
+    @return boolean
+    """
+    code = getattr(error, 'code', None)
+    if code is None and getattr(error, 'response', None) is not None:
+        code = getattr(error.response, 'status_code', None)
+    if isinstance(code, int):
+        return code == 429 or code >= 500
+
+    if isinstance(error, (ConnectionError, TimeoutError, socket.timeout)):
+        return True
+    return any(cls.__name__ in _TRANSIENT_NAMES for cls in type(error).__mro__)
+
+def should_requeue(error):
+    """
+    Tell whether a page whose processing failed with this error should be
+    tried again later (see RetryQueue): the error is transient or the
+    host was not called because its circuit is open.
+    """
+    return isinstance(error, CircuitOpenError) or is_transient(error)
+
+def backoff_delay(attempt, base=BASE_DELAY, cap=MAX_DELAY):
+    """
+    Delay before a retry, with full jitter: random between 0 and the
+    exponential backoff, so that clients that failed together don't
+    retry together
+
+    @param attempt: number of the retry, from 1
+    @return seconds
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+class Host:
+    """Retry budget and circuit breaker of one host"""
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.stats = {'calls': 0, 'retries': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+    def _roll_window(self, now):
+        if now - self.window_start >= RETRY_WINDOW:
+            self.window_start, self.calls, self.retries = now, 0, 0
+
+    def allow(self):
+        """
+        Take a call, raising CircuitOpenError if the circuit is open. Once
+        BREAKER_RESET has passed, a single trial call is let through.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._roll_window(now)
+            if self.opened is not None:
+                if now - self.opened < BREAKER_RESET or self.trial:
+                    self.stats['rejected'] += 1
+                    raise CircuitOpenError('%s is failing, not calling it for %.0f more seconds'
+                        % (self.name, max(0, BREAKER_RESET - (now - self.opened))))
+                self.trial = True
+            self.calls += 1
+            self.stats['calls'] += 1
+
+    def allow_retry(self):
+        """Take a retry from the budget of the host, return False if there's none left"""
+        with self.lock:
+            self._roll_window(time.monotonic())
+            if self.retries >= RETRY_MIN + RETRY_RATIO * self.calls:
+                return False
+            self.retries += 1
+            self.stats['retries'] += 1
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.stats['failures'] += 1
+            # A failed trial opens the circuit again
+            if self.trial or (self.opened is None and self.failures >= BREAKER_THRESHOLD):
+                self.opened = time.monotonic()
+                self.stats['opened'] += 1
+            self.trial = False
+
+    def state(self):
+        """'closed', 'open' or 'half-open'"""
+        with self.lock:
+            if self.opened is None:
+                return 'closed'
+            return 'half-open' if time.monotonic() - self.opened >= BREAKER_RESET else 'open'
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+def host(name):
+    """Return the shared Host of a host name (or of the host of a URL)"""
+    if '/' in name:
+        name = urlparse(name).netloc
+    with _hosts_lock:
+        if name not in _hosts:
+            _hosts[name] = Host(name)
+        return _hosts[name]
+
+def call(host_name, func, *args, max_attempts=MAX_ATTEMPTS, retryable=is_transient, sleep=time.sleep, **kwargs):
+    """
+    Call a function that makes a request to a host, retrying transient
+    failures with jittered exponential backoff within the retry budget
+    of the host, and going through its circuit breaker.
+
+    @param host_name: name of the host (or a URL of it)
+    @param func: the function
+    @param max_attempts: maximum number of calls
+    @param retryable: function telling whether an exception is worth a retry
+    @raises CircuitOpenError if the circuit of the host is open,
+        else the last exception of func
+    @return the result of func
+    """
+    target = host(host_name)
+    attempt = 0
+    while True:
+        attempt += 1
+        target.allow()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if not retryable(e):
+                # The host answered, it's the request that is wrong
+                target.success()
+                raise
+            target.failure()
+            if attempt >= max_attempts or not target.allow_retry():
+                raise
+            sleep(backoff_delay(attempt))
+            continue
+
+        target.success()
+        return result
+
+def http_get(url, timeout=TIMEOUT, **kwargs):
+    """
+    requests.get() with timeouts, going through call(). 429 and 5xx
+    responses are retried; other responses are returned as they are.
+
+    @param url: the URL
+    @param timeout: (connect, read) timeouts in seconds
+    @raises CircuitOpenError, HTTPStatusError or the errors of requests
+    @return requests.Response
+    """
+    import requests
+
+    def get():
+        response = requests.get(url, timeout=timeout, **kwargs)
+        if response.status_code == 429 or response.status_code >= 500:
+            raise HTTPStatusError(url, response.status_code)
+        return response
+
+    return call(url, get)
+
+class RetryQueue:
+    """
+    Iterate items (e.g. page titles) and take back the ones whose
+    processing failed, to be yielded again after a backoff delay, once
+    the other items are done or the delay has passed. An item is given up
+    after max_attempts.
+    """
+    def __init__(self, items, max_attempts=3, base_delay=5.0, max_delay=300.0, sleep=time.sleep):
+        """
+        @param items: iterable of hashable items, consumed lazily
+        @param max_attempts: attempts of an item before it's given up
+        @param base_delay: delay before the first retry, doubled for each retry
+        @param max_delay: maximum delay before a retry
+        """
+        self.items = iter(items)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.delayed = []
+        self.attempts = {}
+        self.given_up = []
+        self.counter = itertools.count()
+
+    def retry(self, item, error=None):
+        """
+        Take an item back to try it again later
+
+        @param item: the item
+        @param error: the exception that made it fail, kept for given up items
+        @return True if it will be tried again, False if it was given up
+        """
+        attempts = self.attempts.get(item, 1)
+        if attempts >= self.max_attempts:
+            self.given_up.append((item, error))
+            return False
+
+        self.attempts[item] = attempts + 1
+        delay = self.base_delay * 2 ** (attempts - 1)
+        delay = min(self.max_delay, delay) * random.uniform(0.5, 1.5)
+        heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.counter), item))
+        return True
+
+    def __iter__(self):
+        end = object()
+        while True:
+            if self.delayed and self.delayed[0][0] <= time.monotonic():
+                yield heapq.heappop(self.delayed)[2]
+                continue
+
+            item = next(self.items, end)
+            if item is not end:
+                yield item
+                continue
+
+            if not self.delayed:
+                return
+            self.sleep(max(0, self.delayed[0][0] - time.monotonic()))
+
+def report():
+    """
+    Print the calls, retries and circuit state of every host
+
+    @return dictionary of {host: stats}
+    """
+    with _hosts_lock:
+        hosts = dict(_hosts)
+
+    for name, target in sorted(hosts.items()):
+        print('%s: %s (%s)' % (name, ', '.join('%s %s' % (v, k) for k, v in target.stats.items()),
+            target.state()))
+
+    return {name: dict(target.stats) for name, target in hosts.items()}
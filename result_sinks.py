@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Structured, buffered output of the per-page results.
+
+The scripts report every per-page result with report(). The result is
+kept as a record ({'kind': ..., 'message': ..., other fields}) by the
+configured sink, which buffers the records and writes them in blocks,
+and its message is printed unless quiet mode is on. Without a sink only
+the message is printed, like before.
+
+    result_sinks.configure(open_sink('jsonl:results.jsonl'), quiet=True)
+"""
+import atexit
+import json
+import threading
+import time
+
+# Number of records buffered before they are written
+BUFFER_SIZE = 1000
+
+_sink = None
+_quiet = False
+
+class JsonlSink:
+    """Write the records as JSON lines"""
+    def __init__(self, path, buffer_size=BUFFER_SIZE):
+        self.file = open(path, mode='a', encoding='utf-8')
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        with self.lock:
+            self.buffer.append(json.dumps(record, ensure_ascii=False, default=str))
+            if len(self.buffer) >= self.buffer_size:
+                self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.buffer = []
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+class SqliteSink:
+    """
+    Write the records to the 'results' table of an SQLite database, with
+    the kind, title and time in their own columns and the whole record as JSON
+    """
+    def __init__(self, path, buffer_size=BUFFER_SIZE):
+        import sqlite3
+        # Several processes may share the database, wait for their writes
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results '
+            '(time REAL, kind TEXT, title TEXT, record TEXT)')
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        with self.lock:
+            self.buffer.append((time.time(), record['kind'], record.get('title'),
+                json.dumps(record, ensure_ascii=False, default=str)))
+            if len(self.buffer) >= self.buffer_size:
+                self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            self.conn.executemany('INSERT INTO results VALUES (?, ?, ?, ?)', self.buffer)
+            self.conn.commit()
+            self.buffer = []
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+SINKS = {'jsonl': JsonlSink, 'sqlite': SqliteSink}
+
+def open_sink(spec):
+    """
+    Open a sink from a 'type:path' string, e.g. 'jsonl:results.jsonl'
+    or 'sqlite:results.db'
+
+    @param spec: type and path of the sink
+    @raises ValueError on unknown type
+    """
+    kind, sep, path = spec.partition(':')
+    if not sep or kind not in SINKS:
+        raise ValueError('Unknown sink: %s (expected one of %s followed by :path)'
+            % (spec, ', '.join(SINKS)))
+    return SINKS[kind](path)
+
+def configure(sink=None, quiet=False):
+    """
+    Set where the results go. The previous sink, if any, is closed.
+
+    @param sink: JsonlSink, SqliteSink (or any object with write(), flush()
+        and close()) or None to only print
+    @param quiet: Don't print the messages of the results
+    """
+    global _sink, _quiet
+    if _sink is not None:
+        _sink.close()
+    _sink = sink
+    _quiet = quiet
+
+def report(kind, message=None, **fields):
+    """
+    Report a result
+
+    @param kind: short name of the kind of result, e.g. 'skipped'
+    @param message: human readable message, printed unless in quiet mode
+    @param fields: the data of the result, e.g. title='...', value='...'
+    """
+    if _sink is not None:
+        record = {'kind': kind, 'message': message}
+        record.update(fields)
+        _sink.write(record)
+
+    if message and not _quiet:
+        print(message)
+
+def log(message):
+    """Report a plain progress message"""
+    report('log', message)
+
+def close():
+    """Write the buffered results and close the sink"""
+    configure(None, _quiet)
+
+atexit.register(close)
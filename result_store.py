@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Compact storage for extraction results.
+
+The functions of get_statements2 return every finding as a dictionary
+with the keys 'id', 'title', 'value' and 'repo_value'. Keeping millions
+of those dictionaries (and the Page objects next to them) exhausts the
+memory on full wiki runs. ResultStore keeps the fields in columns, and
+once their estimated size crosses a threshold they're spilled to a
+temporary file. Iterating a store streams StatementRecord objects back,
+first from the disk then from memory, in the order they were added.
+"""
+import os
+import pickle
+import sys
+import tempfile
+
+# Estimated size of the in-memory columns (bytes) before spilling to disk
+MAX_MEMORY = 64 * 1024 * 1024
+
+FIELDS = ('id', 'title', 'value', 'repo_value')
+
+class StatementRecord:
+    """
+    A single finding. The fields can be read as attributes or with
+    the same keys as the dictionaries of get_statements2.
+    """
+    __slots__ = FIELDS
+
+    def __init__(self, id, title, value, repo_value=None):
+        self.id = id
+        self.title = title
+        self.value = value
+        self.repo_value = repo_value
+
+    def __getitem__(self, key):
+        if key not in FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in FIELDS else default
+
+    def __repr__(self):
+        return 'StatementRecord(%r, %r, %r, %r)' % (self.id, self.title, self.value, self.repo_value)
+
+class ResultStore:
+    """
+    Append-only columnar store of StatementRecord with spill to disk.
+    """
+    def __init__(self, max_memory=MAX_MEMORY):
+        """
+        @param max_memory: estimated size in bytes of the in-memory
+            columns above which they are written to disk
+        """
+        self.max_memory = max_memory
+        self.columns = tuple([] for f in FIELDS)
+        self.memory = 0
+        self.spilled = 0
+        self.file = None
+
+    def append(self, result):
+        """
+        Add a finding.
+
+        @param result: StatementRecord or dictionary with the keys of FIELDS
+        """
+        for column, field in zip(self.columns, FIELDS):
+            value = result[field] if field != 'repo_value' else result.get(field)
+            # Property ids repeat all the time, keep a single copy of each
+            if field == 'id' and isinstance(value, str):
+                value = sys.intern(value)
+            column.append(value)
+            self.memory += sys.getsizeof(value) + 8
+
+        if self.memory > self.max_memory:
+            self.spill()
+
+    def spill(self):
+        """Write the in-memory columns to the temporary file and clear them"""
+        if not self.columns[0]:
+            return
+
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix='results-')
+
+        self.file.seek(0, os.SEEK_END)
+        pickle.dump(self.columns, self.file, pickle.HIGHEST_PROTOCOL)
+        self.spilled += len(self.columns[0])
+        self.columns = tuple([] for f in FIELDS)
+        self.memory = 0
+
+    def _chunks(self):
+        """Yield the spilled columns chunk by chunk, then the in-memory ones"""
+        if self.file is not None:
+            self.file.seek(0)
+            while True:
+                try:
+                    yield pickle.load(self.file)
+                except EOFError:
+                    break
+        yield self.columns
+
+    def __iter__(self):
+        for columns in self._chunks():
+            for fields in zip(*columns):
+                yield StatementRecord(*fields)
+
+    def __len__(self):
+        return self.spilled + len(self.columns[0])
+
+    def close(self):
+        """Delete the temporary file, if any"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.columns = tuple([] for f in FIELDS)
+        self.memory = self.spilled = 0
@@ -11,68 +11,370 @@ This module has two functions:
         This uses the identified titles in on the page (User:Ammarpad/Outreachy 1)
         and also attempt to find out their QIDs through entity search. The pages
         are in three languages English, French and Arabic
+
+Running with --parallel searches all the wikis at the same time, under
+a shared request rate budget, and prints one merged report at the end.
+
+When a search returns several items, they are ranked locally (see
+rank_candidates()) and only the best ones are verified, with one batched
+request for the sitelinks of the candidates of many titles.
+
+With --label-index, the unconnected pages are first matched against the
+offline label index of label_index.py and only the titles it can't
+decide are searched through the API. Only a single item matching the
+full title is taken as is; the items matching the title without its
+disambiguation suffix are candidates, ranked like search results.
 """
 import os
 import sys
 sys.path.append(os.environ['PYWIKIBOT_DIR'])
 
+import argparse
 import pywikibot
 import re
+import result_sinks
+import label_index
+import text_store
+import threading
+
+from rate_limit import RateLimiter
+
+LANGS = ['fr', 'ar', 'en']
+# Number of ranked candidates of a title that are verified
+TOP_CANDIDATES = 3
+# Maximum number of ids accepted by wbgetentities per request
+BATCH_SIZE = 50
+
+def rank_candidates(title, candidates):
+    """
+    Rank the results of an entity search for a page title, best first,
+    without any request. Candidates whose label (then alias) is the title,
+    or the title without its disambiguation suffix, come first; words of
+    the suffix found in the description ('Tatu (film)' and '2017 Nigerian
+    film') break ties, then the order of the search.
+
+    @param title: page title
+    @param candidates: list of results of DataSite.search_entities()
+    @return list of (score, candidate), best first. The score is 0 for
+        candidates that match the title neither by label nor by alias
+    """
+    full = label_index.normalize_label(title)
+    base, disambiguator = label_index.split_disambiguation(title)
+    base = label_index.normalize_label(base)
+    words = set(label_index.normalize_label(disambiguator).split())
+
+    ranked = []
+    for position, candidate in enumerate(candidates):
+        label = label_index.normalize_label(candidate.get('label', ''))
+        match = candidate.get('match', {})
+        text = label_index.normalize_label(match.get('text', ''))
+
+        score = 0
+        if label == full:
+            score = 4
+        elif label == base:
+            score = 3
+        elif text in (full, base):
+            # Matched one of the aliases
+            score = 2
+
+        if score:
+            description = set(label_index.normalize_label(candidate.get('description', '')).split())
+            score += len(words & description) / (len(words) or 1)
+
+        ranked.append((score, -position, candidate))
+
+    ranked.sort(key=lambda r: r[:2], reverse=True)
+    return [(score, candidate) for score, position, candidate in ranked]
+
+def get_candidates(repo, qids, lang, wait=lambda: None):
+    """
+    Get the label, description and aliases of many items in the form of
+    the results of DataSite.search_entities(), for rank_candidates(),
+    with batched requests
+
+    @param repo: DataSite object
+    @param qids: iterable of item ids
+    @param lang: language code of the terms
+    @param wait: Function called before each request (e.g. RateLimiter.wait)
+    @return dictionary of {qid: candidate}, the 'match' of a candidate
+        lists its aliases
+    """
+    qids = list(dict.fromkeys(qids))
+    candidates = {}
+
+    for i in range(0, len(qids), BATCH_SIZE):
+        batch = qids[i:i + BATCH_SIZE]
+        wait()
+        data = repo.simple_request(action='wbgetentities', ids='|'.join(batch),
+            props='labels|descriptions|aliases', languages=lang).submit()
+
+        for key, entity in data.get('entities', {}).items():
+            if 'missing' in entity:
+                continue
+            qid = entity.get('redirects', {}).get('from', key)
+            candidates[qid] = {
+                'id': qid,
+                'label': entity.get('labels', {}).get(lang, {}).get('value', ''),
+                'description': entity.get('descriptions', {}).get(lang, {}).get('value', ''),
+                'aliases': [alias['value'] for alias in entity.get('aliases', {}).get(lang, [])],
+            }
+
+    return candidates
+
+def verify_fallback(title, candidates):
+    """
+    Pick the item of a page among the items whose label or alias is its
+    title without the disambiguation suffix ('Tatu' for 'Tatu (film)'):
+    one of them only, when its description has words of the suffix and
+    no other candidate ranks as high (see rank_candidates()).
+
+    @param title: page title
+    @param candidates: list of candidates returned by get_candidates()
+    @return qid or None
+    """
+    # Rank each candidate through its best matching alias, if any
+    expanded = []
+    for candidate in candidates:
+        for text in [candidate['label']] + candidate['aliases']:
+            expanded.append(dict(candidate, match={'text': text}))
+
+    ranked = []
+    for score, candidate in rank_candidates(title, expanded):
+        if score and candidate['id'] not in [c['id'] for s, c in ranked]:
+            ranked.append((score, candidate))
+
+    if not ranked or (len(ranked) > 1 and ranked[1][0] == ranked[0][0]):
+        return None
+
+    score, best = ranked[0]
+    words = set(label_index.normalize_label(label_index.split_disambiguation(title)[1]).split())
+    if not words & set(label_index.normalize_label(best['description']).split()):
+        return None
+
+    return best['id']
+
+def resolve_redirects(site, titles, wait=lambda: None):
+    """
+    Follow the redirects of many pages of a wiki, with batched requests
+
+    @param site: pywikibot.Site
+    @param titles: iterable of page titles
+    @param wait: Function called before each request (e.g. RateLimiter.wait)
+    @return dictionary of {title: title of the target page}, the title
+        itself (normalized) for pages that aren't redirects
+    """
+    titles = list(dict.fromkeys(titles))
+    targets = {}
+
+    for i in range(0, len(titles), BATCH_SIZE):
+        batch = titles[i:i + BATCH_SIZE]
+        wait()
+        data = site.simple_request(action='query', titles='|'.join(batch), redirects=1).submit()
+        query = data.get('query', {})
+        normalized = {move['from']: move['to'] for move in query.get('normalized', [])}
+        redirects = {move['from']: move['to'] for move in query.get('redirects', [])}
+
+        for title in batch:
+            target = normalized.get(title, title)
+            targets[title] = redirects.get(target, target)
 
-def main():
+    return targets
+
+def get_sitelinks(repo, qids, site, wait=lambda: None):
+    """
+    Get the sitelink of many items to one site, with batched requests
+
+    @param repo: DataSite object
+    @param qids: iterable of item ids
+    @param site: database name of the site, e.g. 'enwiki'
+    @param wait: Function called before each request (e.g. RateLimiter.wait)
+    @return dictionary of {qid: linked title or None}
+    """
+    qids = list(dict.fromkeys(qids))
+    sitelinks = {}
+
+    for i in range(0, len(qids), BATCH_SIZE):
+        batch = qids[i:i + BATCH_SIZE]
+        wait()
+        data = repo.simple_request(action='wbgetentities', ids='|'.join(batch),
+            props='sitelinks', sitefilter=site).submit()
+
+        for key, entity in data.get('entities', {}).items():
+            qid = entity.get('redirects', {}).get('from', key)
+            sitelinks[qid] = entity.get('sitelinks', {}).get(site, {}).get('title')
+
+    return sitelinks
+
+def main(parallel=False, rate=10, total=1000, label_index=None):
+    """
+    @param parallel: Run every search concurrently instead of one by one
+    @param rate: Requests per second shared by all the searches (parallel mode)
+    @param total: Maximum number of unconnected pages to go through
+    @param label_index: Path of the offline label index to match the
+        unconnected pages with before searching, None to only search
+    """
     try:
+        if parallel:
+            run_parallel(rate, total, label_index)
+            return
+
         # Run for French, Arabic and English pages
-        search_terms_for_qids('fr')
-        search_terms_for_qids('ar')
-        search_terms_for_qids('en')
+        for lang in LANGS:
+            search_terms_for_qids(lang)
         # Run for UnconnectedPages
-        find_qids_for_pages()
+        find_qids_for_pages(total=total, index_file=label_index)
     except KeyboardInterrupt:
        pass
 
-def find_qids_for_pages():
+def run_parallel(rate, total=1000, label_index=None):
+    """
+    Run the searches for every language and for the unconnected pages
+    concurrently. The searches share the Site objects that pywikibot
+    caches (the English wiki and the repo are the same objects in all of
+    them), so they are not isolated from each other: each buffers its
+    output and all of them take their requests from one rate budget. A
+    search that fails, whatever the error, is reported in its output and
+    doesn't stop the others. The searches run in daemon threads, so
+    Ctrl-C stops the run right away. The output is printed line by line
+    as a single report once the slowest search is done.
+
+    @param rate: Requests per second shared by all the searches
+    @param total: Maximum number of unconnected pages to go through
+    @param label_index: Path of the offline label index, see main()
+    @return list of the result dictionaries of every search
+    """
+    limiter = RateLimiter(rate)
+    jobs = [(search_terms_for_qids, [lang], {}) for lang in LANGS]
+    jobs.append((find_qids_for_pages, [], {'total': total, 'index_file': label_index}))
+
+    results = [None] * len(jobs)
+    outputs = [[] for job in jobs]
+
+    def run(position, func, args, kwargs):
+        lines = outputs[position]
+        try:
+            results[position] = func(*args, limiter=limiter, log=lines.append, **kwargs)
+        except Exception as e:
+            lines.append('There was a problem: %s' % str(e))
+
+    threads = [threading.Thread(target=run, args=(position, *job), daemon=True)
+        for position, job in enumerate(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        # Wait with a timeout, so that Ctrl-C reaches this thread
+        while thread.is_alive():
+            thread.join(0.5)
+
+    for lines in outputs:
+        for line in lines:
+            result_sinks.log(line)
+
+    print('SUMMARY')
+    for result in filter(None, results):
+        print('%s: found %s QIDs for %s pages' % (result['name'], len(result['found']), result['total']))
+
+    return results
+
+def find_qids_for_pages(limiter=None, log=result_sinks.log, total=1000, index_file=None):
     """
     Loop through English Wikipedia unconnected pages and attempt to
     find their QIDs in the repo.
+
+    @param limiter: Optional RateLimiter to take API requests from
+    @param log: Function used to output the progress messages
+    @param total: Maximum number of unconnected pages to go through
+    @param index_file: Path of the offline label index. Pages whose title
+        is the label or alias of a single item not linked to English
+        Wikipedia are resolved locally, only the others are searched.
+        None to search every page
+    @return dictionary with 'name', 'total' and 'found' (dict of title -> qid)
     """
+    wait = limiter.wait if limiter else lambda: None
+
     enwiki = pywikibot.Site('en', 'wikipedia')
     data_repo = enwiki.data_repository()
-    unconnected_pages = enwiki.querypage('UnconnectedPages', total=1000)
+    wait()
+    unconnected_pages = enwiki.querypage('UnconnectedPages', total=total)
 
     # Filter pages not in main namespace
     mainspace_pages = filter(lambda page: (page.namespace().id == 0), [*unconnected_pages])
     pages = [*mainspace_pages]
 
-    print('Found %s total pages in main namespace' % len(pages))
+    page_count = len(pages)
+    log('Found %s total pages in main namespace' % page_count)
 
-    found = 0
+    found = {}
+    if index_file:
+        titles = [p.title() for p in pages]
+        exact = label_index.lookup(titles, 'en', index_file, fallback=False)
+        for title, qids in exact.items():
+            if len(qids) == 1:
+                found[title] = qids[0]
+                result_sinks.report('qid', title=title, qid=qids[0], lang='en', source='index')
+
+        # The items matching the title without its disambiguation suffix
+        # are only candidates, to be verified
+        fallback = label_index.lookup([title for title in titles if not exact[title]], 'en', index_file)
+        fallback = {title: qids for title, qids in fallback.items() if qids}
+        candidates = get_candidates(data_repo, [qid for qids in fallback.values() for qid in qids], 'en', wait)
+        for title, qids in fallback.items():
+            qid = verify_fallback(title, [candidates[qid] for qid in qids if qid in candidates])
+            if qid:
+                found[title] = qid
+                result_sinks.report('qid', title=title, qid=qid, lang='en', source='index')
+
+        pages = [p for p in pages if p.title() not in found]
+        log('Found %s QIDs in the label index, searching the %s other pages' % (len(found), len(pages)))
+
+    pending = {}
     for p in pages:
+        wait()
         res = [*data_repo.search_entities(p.title(), 'en', None, **{'type': 'item'})]
-        if len(res) > 0: print('Found %s matching results.' % len(res))
+        if len(res) > 0: log('Found %s matching results.' % len(res))
 
         if len(res) == 0:
-            print('Couldn\'t find the QID for %s, Search API returns empty result.' % p.title())
+            log('Couldn\'t find the QID for %s, Search API returns empty result.' % p.title())
             continue
         elif len(res) == 1:
-            print('Found the page\'s QID: {title} -> {qid}.'.format(title=p.title(), qid=res[0]['id']))
-            found += 1
+            log('Found the page\'s QID: {title} -> {qid}.'.format(title=p.title(), qid=res[0]['id']))
+            found[p.title()] = res[0]['id']
+            result_sinks.report('qid', title=p.title(), qid=res[0]['id'], lang='en')
             continue
         else:
-            for r in res:
-                if r['label'] == p.title():
-                    print('Found the page\'s QID: {title} -> {qid}.'.format(title=p.title(), qid=r['id']))
-                    found += 1
-                    break
+            # Keep the best candidates matching the title by label or alias
+            ranked = [c['id'] for score, c in rank_candidates(p.title(), res) if score]
+            pending[p.title()] = ranked[:TOP_CANDIDATES]
 
-    print('Found %s total QIDs' % len(found))
+    # The item of an unconnected page can't have an English Wikipedia
+    # article yet: take the best candidate without one
+    sitelinks = get_sitelinks(data_repo, [qid for qids in pending.values() for qid in qids],
+        'enwiki', wait)
+    for title, qids in pending.items():
+        for qid in qids:
+            if not sitelinks.get(qid):
+                log('Found the page\'s QID: {title} -> {qid}.'.format(title=title, qid=qid))
+                found[title] = qid
+                result_sinks.report('qid', title=title, qid=qid, lang='en')
+                break
 
-def search_terms_for_qids(lang):
+    log('Found %s total QIDs' % len(found))
+
+    return {'name': 'UNCONNECTED PAGES', 'total': page_count, 'found': found}
+
+def search_terms_for_qids(lang, limiter=None, log=result_sinks.log):
     """
     Load page titles identified in Task 1 (User:Ammarpad/Outreachy 1)
     and attempt to figure out their QIDs through entity search.
 
     @param lang: string language code of the wiki
+    @param limiter: Optional RateLimiter to take API requests from
+    @param log: Function used to output the progress messages
+    @return dictionary with 'name', 'total' and 'found' (dict of title -> qid)
     """
+    wait = limiter.wait if limiter else lambda: None
+
     wiki = pywikibot.Site(lang, 'wikipedia')
     wikidata = wiki.data_repository()
 
@@ -80,48 +382,65 @@ def search_terms_for_qids(lang):
     page = pywikibot.Page(wikidata, 'User:Ammarpad/Outreachy 1')
 
     # Find all page titles linking back to Wikipedia in 'lang'
-    titles = re.findall(r'\[\[:%s:(.*?)\]\]' % lang, page.text)
+    wait()
+    titles = re.findall(r'\[\[:%s:(.*?)\]\]' % lang, text_store.get_text(page))
 
     langs = {'fr': 'FRENCH', 'en': 'ENGLISH', 'ar': 'ARABIC'}
 
-    print('RUNNING THE SCRIPT FOR %s WIKIPEDIA (%s pages)' %(langs[lang], len(titles)))
+    log('RUNNING THE SCRIPT FOR %s WIKIPEDIA (%s pages)' %(langs[lang], len(titles)))
 
-    found = 0
+    found = {}
+    pending = {}
     for t in titles:
         # Work around bidirectionality problem for strings in parentheses
         if lang == 'ar':
-            print('...%s Searching for' % t)
+            log('...%s Searching for' % t)
         else:
-            print('Searching for %s...' % t)
+            log('Searching for %s...' % t)
 
+        wait()
         res = [*wikidata.search_entities(t, lang, None, **{'type': 'item'})]
-        if len(res) > 0: print('Found %s matching results.' % len(res))
+        if len(res) > 0: log('Found %s matching results.' % len(res))
 
         if len(res) == 1:
-            print('Found the page\'s QID: {title} -> {qid}.'.format(title=t, qid=res[0]['id']))
-            found += 1
+            log('Found the page\'s QID: {title} -> {qid}.'.format(title=t, qid=res[0]['id']))
+            found[t] = res[0]['id']
+            result_sinks.report('qid', title=t, qid=res[0]['id'], lang=lang)
             continue
         elif len(res) == 0:
-            print('Couldn\'t find the QID for %s, Search API returns empty result.' % t)
+            log('Couldn\'t find the QID for %s, Search API returns empty result.' % t)
             continue
 
-        for i in res:
-            try:
-                page = pywikibot.Page(wiki, i['match']['text'])
-                if page.isRedirectPage():
-                    page = page.getRedirectTarget()
-                qid = page.data_item().title()
-
-            except pywikibot.NoPage:
-                print('Couldn\'t find the QID for %s, page doesn\'t exist' % t)
-                continue
+        # Only the best candidates are verified, all together below
+        pending[t] = [c['id'] for score, c in rank_candidates(t, res)[:TOP_CANDIDATES]]
 
-            if i['id'] == qid:
-                print('Found the page\'s QID: {title} -> {qid}.'.format(title=t, qid=qid))
-                found += 1
+    # The right item is the one linked to the page, or to the page the
+    # title redirects to
+    sitelinks = get_sitelinks(wikidata, [qid for qids in pending.values() for qid in qids],
+        wiki.dbName(), wait)
+    targets = resolve_redirects(wiki, pending, wait)
+    for t, qids in pending.items():
+        names = {label_index.normalize_label(t), label_index.normalize_label(targets.get(t, t))}
+        for qid in qids:
+            linked = sitelinks.get(qid)
+            if linked and label_index.normalize_label(linked) in names:
+                log('Found the page\'s QID: {title} -> {qid}.'.format(title=t, qid=qid))
+                found[t] = qid
+                result_sinks.report('qid', title=t, qid=qid, lang=lang)
                 break
+        else:
+            log('Couldn\'t verify the QID for %s among %s' % (t, ', '.join(qids)))
 
-    print('Finished! Found %s QIDs in total' % found)
+    log('Finished! Found %s QIDs in total' % len(found))
+
+    return {'name': '%s WIKIPEDIA' % langs[lang], 'total': len(titles), 'found': found}
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--parallel', action='store_true', help='Search all the wikis concurrently')
+    parser.add_argument('--rate', type=float, default=10, help='Requests per second shared by all searches')
+    parser.add_argument('--total', type=int, default=1000, help='Maximum number of unconnected pages')
+    parser.add_argument('--label-index', help='Offline label index to match unconnected pages with')
+    args = parser.parse_args()
+
+    main(args.parallel, args.rate, args.total, args.label_index)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Split category processing between processes or hosts.
+
+Every worker is given a shard (index, count) and only processes the
+pages whose title hashes to its index. The hash is stable (it doesn't
+depend on the process like hash() does), so every worker of every host
+agrees on the partition. Workers also claim each page in a shared SQLite
+store before processing it, which guarantees that no page is processed
+twice, even when two workers are given overlapping shards, and their
+per-page results go to the same store, so merging them is a query.
+
+Claims belong to a run: the same store can be used by run after run,
+each run processes every page again. Pages that were claimed but not
+processed (given up, or left when a worker stopped early) are released
+so that a later worker of the same run can take them.
+
+    python cli.py --processes 4 --shard-store run.db import-ids
+    python cli.py --shard 0/8 --run-id 2021-06-01 --shard-store /shared/run.db fix-netflix
+
+For several hosts the store must be on a filesystem they all share, and
+all the workers of a run must be given the same run id (by default, the
+current UTC date with --shard).
+"""
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+
+import result_sinks
+
+def new_run_id():
+    """Return a run id unique to this invocation, for local processes"""
+    return '%s-%s' % (time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+
+def daily_run_id():
+    """Return the default run id of workers started separately: the current UTC date"""
+    return time.strftime('%Y-%m-%d', time.gmtime())
+
+class ShardStore:
+    """
+    Shared store of the pages claimed by the workers of a run. The
+    per-page results are kept in the same database by result_sinks.SqliteSink.
+    """
+    def __init__(self, path, run_id):
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS run_claims '
+            '(run TEXT, key TEXT, shard INTEGER, worker TEXT, time REAL, PRIMARY KEY (run, key))')
+        self.conn.commit()
+        self.run_id = run_id
+        self.worker = '%s:%s' % (socket.gethostname(), os.getpid())
+
+    def claim(self, key, shard):
+        """
+        Claim a page for this worker
+
+        @param key: the key of the page (its title)
+        @param shard: index of the shard of the worker
+        @return True if the page was claimed, False if another worker of the run had it
+        """
+        cursor = self.conn.execute('INSERT OR IGNORE INTO run_claims VALUES (?, ?, ?, ?, ?)',
+            (self.run_id, key, shard, self.worker, time.time()))
+        self.conn.commit()
+        return cursor.rowcount == 1
+
+    def release(self, keys):
+        """
+        Release the claims of this worker on pages it didn't process
+
+        @param keys: iterable of the keys of the pages
+        @return number of claims released
+        """
+        cursor = self.conn.executemany('DELETE FROM run_claims WHERE run = ? AND key = ? AND worker = ?',
+            [(self.run_id, key, self.worker) for key in keys])
+        self.conn.commit()
+        return cursor.rowcount
+
+    def close(self):
+        self.conn.close()
+
+def shard_of(key, count):
+    """
+    Return the shard of a key
+
+    @param key: string key (e.g. page title)
+    @param count: number of shards
+    @return int between 0 and count - 1
+    """
+    digest = hashlib.md5(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+def select(pages, shard, store_path=None, key=lambda page: page.title(), run_id=None):
+    """
+    Filter pages, keeping those of the shard that could be claimed.
+    Pages yielded but not processed should be given back with release().
+
+    @param pages: iterable of pages
+    @param shard: (index, count) of the shard, or None to keep every page
+    @param store_path: path of the shared store, None to skip claiming
+    @param key: function returning the key of a page
+    @param run_id: id of the run the claims belong to, see daily_run_id()
+    @return generator of pages
+    """
+    if shard is None:
+        yield from pages
+        return
+
+    index, count = shard
+    store = ShardStore(store_path, run_id or daily_run_id()) if store_path else None
+    try:
+        for page in pages:
+            k = key(page)
+            if shard_of(k, count) != index:
+                continue
+            if store and not store.claim(k, index):
+                continue
+            yield page
+    finally:
+        if store:
+            store.close()
+
+def release(keys, shard, store_path=None, run_id=None):
+    """
+    Give back the pages claimed by select() that this worker didn't
+    process, so that another worker of the run can take them
+
+    @param keys: iterable of the keys of the pages (their titles)
+    @param shard: the shard given to select(), nothing is done if None
+    @param store_path: the path given to select()
+    @param run_id: the run id given to select()
+    @return number of pages released
+    """
+    keys = list(keys)
+    if shard is None or not store_path or not keys:
+        return 0
+
+    store = ShardStore(store_path, run_id or daily_run_id())
+    try:
+        released = store.release(keys)
+    finally:
+        store.close()
+
+    if released:
+        print('Released %s pages that were not processed' % released)
+    return released
+
+def parse_shard(spec):
+    """
+    Parse an 'index/count' string, e.g. '0/4'
+
+    @raises ValueError if it's not valid
+    """
+    index, sep, count = spec.partition('/')
+    index, count = int(index), int(count)
+    if not sep or count < 1 or not 0 <= index < count:
+        raise ValueError('Invalid shard: %s (expected index/count, e.g. 0/4)' % spec)
+    return index, count
+
+def run_shard(module, func, kwargs, shard, store_path, run_id, quiet=False):
+    """
+    Run a function of a module on one shard, sending its per-page
+    results to the store
+
+    @param module: name of the module
+    @param func: name of the function, it must accept 'shard',
+        'store_path' and 'run_id' keyword arguments
+    @param kwargs: other keyword arguments of the function
+    @param shard: (index, count) of the shard
+    @param store_path: path of the shared store
+    @param run_id: id of the run
+    @param quiet: Don't print the messages of the results
+    """
+    result_sinks.configure(result_sinks.SqliteSink(store_path), quiet)
+    try:
+        getattr(importlib.import_module(module), func)(shard=shard, store_path=store_path,
+            run_id=run_id, **kwargs)
+    finally:
+        result_sinks.close()
+
+def run_sharded(module, func, kwargs, processes, store_path, quiet=False, run_id=None):
+    """
+    Run a function on every shard in its own local process and
+    summarize the merged results once all of them are done.
+
+    @param processes: number of processes (and shards)
+    @param run_id: id of the run, a new one if None
+    @return dictionary of {result kind: count}
+    """
+    run_id = run_id or new_run_id()
+    workers = [multiprocessing.Process(target=run_shard,
+        args=(module, func, kwargs, (i, processes), store_path, run_id, quiet)) for i in range(processes)]
+
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    failed = [i for i, worker in enumerate(workers) if worker.exitcode]
+    if failed:
+        print('Shards %s failed' % ', '.join(map(str, failed)))
+
+    return summarize(store_path, run_id)
+
+def summarize(store_path, run_id):
+    """
+    Print the number of pages claimed and of results of each kind of a run
+
+    @param run_id: id of the run
+    @return dictionary of {result kind: count}
+    """
+    conn = sqlite3.connect(store_path, timeout=60)
+    claimed, kinds = 0, {}
+    try:
+        claimed, start = conn.execute('SELECT COUNT(*), MIN(time) FROM run_claims WHERE run = ?',
+            (run_id,)).fetchone()
+        # The results of the run are those written since its first claim
+        kinds = dict(conn.execute('SELECT kind, COUNT(*) FROM results WHERE time >= ? GROUP BY kind',
+            (start or time.time(),)))
+    except sqlite3.OperationalError:
+        pass # No page was claimed or no result was written
+    finally:
+        conn.close()
+
+    print('Processed %s pages. Results: %s' % (claimed, json.dumps(kinds, sort_keys=True)))
+    return kinds
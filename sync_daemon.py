@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Continuous synchronization driven by the recent changes feed.
+
+Instead of sweeping whole categories in batch runs, SyncDaemon polls the
+recent changes of English Wikipedia and, when a page of one of the
+TRACKED_CATEGORIES is edited, runs only the extractor or the fixer of
+that category for that page. Bursts of edits to the same page are
+debounced so the page is processed once, after it has been quiet for a
+few seconds. Pages that join a tracked category are picked up when the
+category members are refreshed.
+
+The feed, the category members and the handlers are plain functions so
+the daemon can be run against a local mock feed:
+
+    python cli.py sync-daemon --mock-feed changes.jsonl --mock-members members.json --dry-run
+
+where changes.jsonl gets one {"title": ..., "revid": ...} line per edit
+appended to it and members.json is {"category": ["title", ...], ...}.
+"""
+import os
+import sys
+# Only the real feed and handlers need pywikibot, the mock mode runs without it
+if 'PYWIKIBOT_DIR' in os.environ:
+    sys.path.append(os.environ['PYWIKIBOT_DIR'])
+
+import json
+import time
+
+import result_sinks
+
+# category: (action, property id)
+TRACKED_CATEGORIES = {
+    'Netflix title ID not in Wikidata': ('import', 'P1874'),
+    'SoundCloud ID not in Wikidata': ('import', 'P3040'),
+    'Netflix title ID different from Wikidata': ('fix', 'P1874'),
+    'SoundCloud ID different from Wikidata': ('fix', 'P3040'),
+}
+
+# Seconds a page must stay unedited before it's processed
+DEBOUNCE = 10
+# Seconds between polls of the feed
+POLL_INTERVAL = 5
+# Seconds between refreshes of the category members
+REFRESH_INTERVAL = 600
+
+class SyncDaemon:
+    """
+    Poll a feed of changes and run the handlers of the tracked
+    categories of the changed pages.
+    """
+    def __init__(self, poll, members, handlers, debounce=DEBOUNCE,
+            refresh_interval=REFRESH_INTERVAL, clock=time.monotonic):
+        """
+        @param poll: function returning the list of changes (dictionaries
+            with at least 'title') made since its previous call
+        @param members: function returning {category: set of titles}
+        @param handlers: dictionary of {category: function(title)}
+        @param debounce: seconds a page must stay unedited before it's processed
+        @param refresh_interval: seconds between calls to members()
+        @param clock: function returning the current time in seconds
+        """
+        self.poll = poll
+        self.members = members
+        self.handlers = handlers
+        self.debounce = debounce
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+
+        self.tracked = {}
+        self.pending = {}
+        self.last_refresh = None
+        self.processed = 0
+
+    def refresh(self, now):
+        """Reload the members of the tracked categories"""
+        tracked = {}
+        for category, titles in self.members().items():
+            if category not in self.handlers:
+                continue
+            for title in titles:
+                tracked.setdefault(title, set()).add(category)
+
+        # Pages that joined a category since the last refresh were
+        # most likely just edited, so process them too
+        if self.last_refresh is not None:
+            for title, categories in tracked.items():
+                if categories - self.tracked.get(title, set()):
+                    self.pending[title] = now
+
+        self.tracked = tracked
+        self.last_refresh = now
+
+    def step(self):
+        """
+        Poll the feed once and process the pages that are due
+
+        @return list of the titles processed
+        """
+        now = self.clock()
+        if self.last_refresh is None or now - self.last_refresh >= self.refresh_interval:
+            self.refresh(now)
+
+        for change in self.poll():
+            if change['title'] in self.tracked:
+                # A new edit restarts the wait for this page
+                self.pending[change['title']] = now
+
+        due = [title for title, seen in self.pending.items() if now - seen >= self.debounce]
+        for title in due:
+            del self.pending[title]
+            self.process(title)
+
+        return due
+
+    def process(self, title):
+        """Run the handlers of every tracked category of the page"""
+        for category in sorted(self.tracked.get(title, ())):
+            try:
+                self.handlers[category](title)
+            except Exception as e:
+                result_sinks.report('error', 'Error: Processing %s for "%s" failed: %s'
+                    % (title, category, str(e)), title=title, category=category, error=str(e))
+        self.processed += 1
+
+    def run(self, poll_interval=POLL_INTERVAL, max_steps=None, sleep=time.sleep):
+        """
+        Poll until interrupted
+
+        @param poll_interval: seconds between polls
+        @param max_steps: stop after this many polls, None to run forever
+        @param sleep: function used to wait between polls
+        """
+        steps = 0
+        try:
+            while max_steps is None or steps < max_steps:
+                self.step()
+                steps += 1
+                sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+
+        print('Stopped. Processed %s pages' % self.processed)
+
+def site_feed(wiki):
+    """
+    Return a poll function for the recent changes of the main
+    namespace of a site, starting from now.
+
+    @param wiki: pywikibot.Site
+    """
+    state = {'start': wiki.server_time(), 'seen': set()}
+
+    def poll():
+        changes = []
+        for change in wiki.recentchanges(start=state['start'], reverse=True,
+                namespaces=[0], changetype='edit|new'):
+            if change['rcid'] in state['seen']:
+                continue
+            state['seen'].add(change['rcid'])
+            changes.append(change)
+
+        if changes:
+            state['start'] = changes[-1]['timestamp']
+            # Only ids at the last timestamp can be returned again
+            state['seen'] = {c['rcid'] for c in changes if c['timestamp'] == state['start']}
+
+        return changes
+
+    return poll
+
+def site_members(wiki, categories=TRACKED_CATEGORIES):
+    """
+    Return a function listing the members of the tracked categories of a site
+
+    @param wiki: pywikibot.Site
+    @param categories: names of the categories
+    """
+    import pywikibot
+
+    def members():
+        return {c: {p.title() for p in pywikibot.Category(wiki, c).articles()} for c in categories}
+
+    return members
+
+def site_handlers(wiki):
+    """
+    Return the handlers running the importer or the fixer of
+    each tracked category for a single page
+
+    @param wiki: pywikibot.Site
+    """
+    import pywikibot
+    import import_enwiki_external_ids
+    import fix_netflix_id_mismatch
+    import fix_soundcloud_id_mismatch
+    import text_store
+
+    fixers = {
+        'P1874': fix_netflix_id_mismatch.check_netflix_page,
+        'P3040': fix_soundcloud_id_mismatch.check_soundcloud_page,
+    }
+
+    def handler(action, p_id):
+        def run(title):
+            # The page was just edited: check its latest revision again
+            # even if the store checked it less than FRESH_FOR seconds ago,
+            # the reads of the handler then use that revision
+            text_store.prefetch(wiki, [title], max_age=0)
+            if action == 'import':
+                return import_enwiki_external_ids.import_page_ids(wiki, title, [p_id])
+            return fixers[p_id](pywikibot.Page(wiki, title), wiki)
+        return run
+
+    return {c: handler(*spec) for c, spec in TRACKED_CATEGORIES.items()}
+
+def jsonl_feed(path):
+    """
+    Return a poll function reading the changes appended to a JSON lines
+    file since the previous poll (a local mock of the recent changes feed)
+
+    @param path: path of the file
+    """
+    state = {'offset': 0}
+
+    def poll():
+        with open(path, encoding='utf-8') as file:
+            file.seek(state['offset'])
+            lines = file.readlines()
+            # Leave a partly written last line for the next poll
+            if lines and not lines[-1].endswith('\n'):
+                lines.pop()
+            state['offset'] += sum(len(l.encode('utf-8')) for l in lines)
+        return [json.loads(l) for l in lines if l.strip()]
+
+    return poll
+
+def json_members(path):
+    """
+    Return a function reading the category members from a JSON file
+    of {category: [titles]}
+
+    @param path: path of the file
+    """
+    def members():
+        with open(path, encoding='utf-8') as file:
+            return {c: set(titles) for c, titles in json.load(file).items()}
+
+    return members
+
+def dry_run_handlers():
+    """Return handlers that only report what would be done"""
+    def handler(category):
+        action, p_id = TRACKED_CATEGORIES[category]
+        return lambda title: result_sinks.report('dry_run', 'Would %s %s of %s' % (action, p_id, title),
+            title=title, action=action, id=p_id)
+
+    return {c: handler(c) for c in TRACKED_CATEGORIES}
+
+def main(mock_feed=None, mock_members=None, dry_run=False, debounce=DEBOUNCE,
+        poll_interval=POLL_INTERVAL, refresh_interval=REFRESH_INTERVAL):
+    """
+    Run the daemon on English Wikipedia, or on the mock feed and members
+
+    @param mock_feed: path of a JSON lines file of changes to read instead of the site
+    @param mock_members: path of a JSON file of category members to read instead of the site
+    @param dry_run: Only report what would be done
+    """
+    wiki = None
+    if not (mock_feed and mock_members and dry_run):
+        import pywikibot
+        wiki = pywikibot.Site('en', 'wikipedia')
+
+    daemon = SyncDaemon(
+        jsonl_feed(mock_feed) if mock_feed else site_feed(wiki),
+        json_members(mock_members) if mock_members else site_members(wiki),
+        dry_run_handlers() if dry_run else site_handlers(wiki),
+        debounce, refresh_interval)
+
+    print('Watching recent changes for %s categories...' % len(TRACKED_CATEGORIES))
+    daemon.run(poll_interval)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Local store of the wikitext of the pages, shared by all the scripts.
+
+The importers, the mismatch fixers and add_statements read their page
+texts through get_text() and get_expanded_text() instead of page.text
+and page.expand_text(), so a text crosses the network at most once per
+revision:
+
+- texts are kept zlib-compressed in a local SQLite file, keyed by
+  (site, pageid, revid); identical texts (reverts, copies) are stored
+  once, and the older revisions of a page are dropped when a newer one
+  is stored,
+- whether the stored revision of a page is still the latest one is
+  checked with a cheap prop=info request, for up to BATCH_SIZE pages at
+  once with prefetch(), which then downloads only the missing texts; a
+  check is trusted for FRESH_FOR seconds, or less with max_age (e.g. 0
+  right after a page was edited),
+- the same requests read the id of the repo item of the pages, see
+  get_item_id(), so the claims of an item can be read without
+  downloading the whole entity with page.data_item(),
+- once the store is larger than MAX_STORE_SIZE, the texts read least
+  recently are evicted.
+
+    text_store.prefetch(wiki, titles)
+    for title in titles:
+        text = text_store.get_text(pywikibot.Page(wiki, title))
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+
+import resilience
+
+TEXT_STORE_FILE = 'text_store.sqlite'
+# Compressed bytes kept before the least recently read texts are evicted
+MAX_STORE_SIZE = 512 * 1024 * 1024
+# Seconds during which the latest revision checked for a page is trusted
+FRESH_FOR = 60
+# Maximum number of titles or revisions per API request
+BATCH_SIZE = 50
+
+WIKITEXT = 'wikitext'
+EXPANDED = 'expanded'
+
+# 'checked' pages whose latest revision was asked for, texts 'reused' from
+# the store or 'fetched' from the wiki, texts 'expanded' by the wiki and
+# texts 'evicted' from the store
+stats = {'checked': 0, 'reused': 0, 'fetched': 0, 'expanded': 0, 'evicted': 0}
+
+_connections = {}
+_sizes = {}
+_lock = threading.Lock()
+# {(site, title): (pageid, revid, time checked)}, pageid is None for missing pages
+_fresh = {}
+# {(site, title): id of the repo item or None}, recorded with _fresh
+_items = {}
+
+def _connect(store_file):
+    """Return the shared connection to the store file, creating the tables if needed"""
+    if store_file not in _connections:
+        conn = sqlite3.connect(store_file, timeout=30, check_same_thread=False)
+        conn.execute('CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, data BLOB, size INTEGER)')
+        conn.execute('CREATE TABLE IF NOT EXISTS texts (site TEXT, pageid INTEGER, revid INTEGER, '
+            'kind TEXT, digest TEXT, accessed REAL, PRIMARY KEY (site, pageid, revid, kind))')
+        conn.execute('CREATE TABLE IF NOT EXISTS pages (site TEXT, title TEXT, pageid INTEGER, '
+            'PRIMARY KEY (site, title))')
+        conn.commit()
+        _connections[store_file] = conn
+        _sizes[store_file] = conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+    return _connections[store_file]
+
+def _put(conn, store_file, site, pageid, revid, kind, text):
+    """Store a text, dropping the older revisions of the page. Call with _lock held."""
+    data = text.encode('utf-8')
+    digest = hashlib.sha1(data).hexdigest()
+    data = zlib.compress(data)
+    if conn.execute('INSERT OR IGNORE INTO blobs VALUES (?, ?, ?)', (digest, data, len(data))).rowcount:
+        _sizes[store_file] += len(data)
+    conn.execute('INSERT OR REPLACE INTO texts VALUES (?, ?, ?, ?, ?, ?)',
+        (site, pageid, revid, kind, digest, time.time()))
+    conn.execute('DELETE FROM texts WHERE site = ? AND pageid = ? AND revid < ?', (site, pageid, revid))
+
+def _get(conn, site, pageid, revid, kind):
+    """Return a stored text or None. Call with _lock held."""
+    row = conn.execute('SELECT data FROM texts JOIN blobs USING (digest) '
+        'WHERE site = ? AND pageid = ? AND revid = ? AND kind = ?', (site, pageid, revid, kind)).fetchone()
+    if row is None:
+        return None
+
+    conn.execute('UPDATE texts SET accessed = ? WHERE site = ? AND pageid = ? AND revid = ? AND kind = ?',
+        (time.time(), site, pageid, revid, kind))
+    return zlib.decompress(row[0]).decode('utf-8')
+
+def _evict(conn, store_file, max_size):
+    """Delete the least recently read texts until the store is under 90% of max_size. Call with _lock held."""
+    if _sizes[store_file] <= max_size:
+        return
+
+    conn.execute('DELETE FROM blobs WHERE digest NOT IN (SELECT digest FROM texts)')
+    size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+    while size > max_size * 0.9:
+        deleted = conn.execute('DELETE FROM texts WHERE rowid IN '
+            '(SELECT rowid FROM texts ORDER BY accessed LIMIT 1000)').rowcount
+        if not deleted:
+            break
+        stats['evicted'] += deleted
+        conn.execute('DELETE FROM blobs WHERE digest NOT IN (SELECT digest FROM texts)')
+        size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    _sizes[store_file] = size
+
+def _query(site, content, **params):
+    """
+    Query the pages (or revisions) of a site
+
+    @param content: Also get the text of the revisions
+    @return (dictionary of {requested title: normalized title}, list of pages)
+    """
+    params.update(prop='info|pageprops|revisions' if content else 'info|pageprops', ppprop='wikibase_item')
+    if content:
+        params.update(rvprop='ids|content', rvslots='main')
+
+    request = site.simple_request(action='query', **params)
+    data = resilience.call(site.hostname(), request.submit)
+    query = data.get('query', {})
+    pages = query.get('pages', {})
+    pages = list(pages.values()) if isinstance(pages, dict) else pages
+    return {move['from']: move['to'] for move in query.get('normalized', [])}, pages
+
+def _revision_text(revision):
+    """The wikitext of a revision of the API response"""
+    slot = revision.get('slots', {}).get('main', revision)
+    return slot.get('*', slot.get('content', ''))
+
+def _record(conn, store_file, site, titles, moves, pages):
+    """Remember the latest revision of the pages queried and store their texts, if any. Call with _lock held."""
+    now = time.time()
+    by_title = {page['title']: page for page in pages}
+    stale = []
+
+    for title in titles:
+        # Remember the page under the normalized title too, e.g. with
+        # spaces for underscores, as pywikibot.Page.title() gives it
+        names = {title, moves.get(title, title)}
+        page = by_title.get(moves.get(title, title))
+        if page is None or 'missing' in page or 'invalid' in page:
+            for name in names:
+                _fresh[(site.dbName(), name)] = (None, None, now)
+                _items[(site.dbName(), name)] = None
+            continue
+
+        pageid, revid = page['pageid'], page['lastrevid']
+        for name in names:
+            _fresh[(site.dbName(), name)] = (pageid, revid, now)
+            _items[(site.dbName(), name)] = page.get('pageprops', {}).get('wikibase_item')
+            conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)', (site.dbName(), name, pageid))
+
+        if page.get('revisions'):
+            _put(conn, store_file, site.dbName(), pageid, revid, WIKITEXT, _revision_text(page['revisions'][0]))
+            stats['fetched'] += 1
+        elif conn.execute('SELECT 1 FROM texts WHERE site = ? AND pageid = ? AND revid = ? AND kind = ?',
+                (site.dbName(), pageid, revid, WIKITEXT)).fetchone():
+            stats['reused'] += 1
+        else:
+            stale.append(revid)
+
+    return stale
+
+def _fetch_revisions(site, revids, store_file):
+    """Download the texts of revisions and store them"""
+    revids = list(dict.fromkeys(revids))
+    for i in range(0, len(revids), BATCH_SIZE):
+        moves, pages = _query(site, True, revids='|'.join(map(str, revids[i:i + BATCH_SIZE])))
+        with _lock:
+            conn = _connect(store_file)
+            for page in pages:
+                for revision in page.get('revisions', []):
+                    _put(conn, store_file, site.dbName(), page['pageid'], revision['revid'], WIKITEXT,
+                        _revision_text(revision))
+                    stats['fetched'] += 1
+            conn.commit()
+
+def prefetch(site, titles, store_file=TEXT_STORE_FILE, max_size=MAX_STORE_SIZE, max_age=FRESH_FOR):
+    """
+    Make sure the store has the latest revision of many pages of a site.
+    Pages never seen are downloaded in batches right away; for the
+    others, the latest revision is checked in batches and only the texts
+    that changed are downloaded. Pages checked less than max_age seconds
+    ago are left alone.
+
+    @param site: pywikibot.Site
+    @param titles: iterable of page titles
+    @param store_file: path of the SQLite store file
+    @param max_size: compressed size of the store before texts are evicted
+    @param max_age: seconds during which a check is trusted, 0 to check
+        every page again, e.g. when it's known to have just been edited
+    """
+    now = time.time()
+    titles = [title for title in dict.fromkeys(titles)
+        if now - _fresh.get((site.dbName(), title), (None, None, 0))[2] >= max_age]
+    if not titles:
+        return
+
+    with _lock:
+        conn = _connect(store_file)
+        known = set()
+        for i in range(0, len(titles), 500):
+            chunk = titles[i:i + 500]
+            known.update(row[0] for row in conn.execute('SELECT title FROM pages WHERE site = ? AND title IN (%s)'
+                % ','.join('?' * len(chunk)), [site.dbName(), *chunk]))
+
+    # The pages never seen are downloaded with their latest revision,
+    # the others are only checked first
+    unknown = [title for title in titles if title not in known]
+    stale = []
+    for content, group in ((True, unknown), (False, [title for title in titles if title in known])):
+        for i in range(0, len(group), BATCH_SIZE):
+            batch = group[i:i + BATCH_SIZE]
+            moves, pages = _query(site, content, titles='|'.join(batch))
+            with _lock:
+                conn = _connect(store_file)
+                stale += _record(conn, store_file, site, batch, moves, pages)
+                stats['checked'] += len(batch)
+                conn.commit()
+
+    _fetch_revisions(site, stale, store_file)
+
+    with _lock:
+        conn = _connect(store_file)
+        _evict(conn, store_file, max_size)
+        conn.commit()
+
+def get_revision(page, store_file=TEXT_STORE_FILE):
+    """
+    Return the latest revision id and text of a page, see prefetch()
+
+    @param page: pywikibot.Page
+    @return (revid, text), (None, '') if the page doesn't exist
+    """
+    site, title = page.site, page.title()
+    prefetch(site, [title], store_file)
+    pageid, revid, checked = _fresh[(site.dbName(), title)]
+    if pageid is None:
+        return None, ''
+
+    with _lock:
+        text = _get(_connect(store_file), site.dbName(), pageid, revid, WIKITEXT)
+    if text is None:
+        # Evicted (or dropped by another process) since it was checked
+        _fetch_revisions(site, [revid], store_file)
+        with _lock:
+            text = _get(_connect(store_file), site.dbName(), pageid, revid, WIKITEXT)
+
+    return revid, text or ''
+
+def get_text(page, store_file=TEXT_STORE_FILE):
+    """
+    Return the wikitext of the latest revision of a page, like page.text
+
+    @param page: pywikibot.Page
+    @return string text, empty if the page doesn't exist
+    """
+    return get_revision(page, store_file)[1]
+
+def get_item_id(page, store_file=TEXT_STORE_FILE):
+    """
+    Return the id of the repo item of a page, like page.data_item().getID()
+    but without downloading the entity. It comes with the latest revision
+    check of prefetch(), so it costs no request for prefetched pages.
+
+    @param page: pywikibot.Page
+    @return string item id, None if the page or its item doesn't exist
+    """
+    site, title = page.site, page.title()
+    prefetch(site, [title], store_file)
+    return _items.get((site.dbName(), title))
+
+def get_expanded_text(page, store_file=TEXT_STORE_FILE):
+    """
+    Return the text of the latest revision of a page with its templates
+    expanded, like page.expand_text(True). The expansion is stored with
+    the revision, so it's asked to the wiki once per revision.
+
+    @param page: pywikibot.Page
+    @return string expanded text
+    """
+    revid, text = get_revision(page, store_file)
+    if revid is None:
+        return ''
+
+    site = page.site.dbName()
+    pageid = _fresh[(site, page.title())][0]
+    with _lock:
+        expanded = _get(_connect(store_file), site, pageid, revid, EXPANDED)
+    if expanded is not None:
+        return expanded
+
+    expanded = resilience.call(page.site.hostname(), page.site.expand_text, text, title=page.title(),
+        includecomments=False)
+    with _lock:
+        conn = _connect(store_file)
+        _put(conn, store_file, site, pageid, revid, EXPANDED, expanded)
+        stats['expanded'] += 1
+        conn.commit()
+
+    return expanded
+
+def report():
+    """
+    Print how many texts were read from the store and from the wikis
+
+    @return stats
+    """
+    if stats['checked']:
+        print('Page texts: %s pages checked, %s texts reused from the store, %s downloaded, '
+            '%s expanded, %s evicted' % (stats['checked'], stats['reused'], stats['fetched'],
+            stats['expanded'], stats['evicted']))
+
+    return stats